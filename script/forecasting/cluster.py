@@ -9,6 +9,7 @@ TODO: clustering implementation
 from typing import Dict, List
 
 import numpy as np
+from scipy import sparse
 
 
 class QueryCluster:
@@ -18,46 +19,64 @@ class QueryCluster:
     then be converted to different query traces for a query cluster
     """
 
-    def __init__(self, traces: Dict):
+    def __init__(self, query_ids: np.ndarray, traces: sparse.csr_matrix):
         """
         NOTE(ricky): I believe this per-cluster query representation will change once we have clustering component
-        added. For now, it simply takes a map of time-series data for each query id.
+        added. For now, it simply takes the time-series data for each query id.
 
-        :param traces: Map of (id -> timeseries) for each query id
+        :param query_ids: Query ids in the cluster
+        :param traces: Sparse (query x bucket) matrix whose row i is the time-series of query_ids[i]
         """
-        self._traces = traces
-        self._aggregate()
+        self._query_ids = query_ids
+        self._aggregate(sparse.csr_matrix(traces))
 
-    def _aggregate(self) -> None:
+    def _aggregate(self, traces: sparse.csr_matrix) -> None:
         """
         Aggregate time-series of multiple queries in the same cluster into one time-series
-        It stores the aggregated times-eries at self._timeseries, and the ratio map of queries in the
-        same cluster at self._ratio_map
+        It stores the aggregated times-eries at self._timeseries, and the ratios of queries in the same cluster at
+        self._ratios (in the order of self._query_ids)
+        :param traces: Sparse (query x bucket) matrix of the time-series of the queries
         """
-        cnt_map = {}
-        total_cnt = 0
-        all_series = []
-        for qid, timeseries in self._traces.items():
-            cnt = sum(timeseries)
-            all_series.append(timeseries)
-            total_cnt += cnt
-
-            cnt_map[qid] = cnt
-
         # Sum all timeseries element-wise
-        self._timeseries = np.array([sum(x) for x in zip(*all_series)])
+        self._timeseries = np.asarray(traces.sum(axis=0)).ravel()
+        self._num_buckets = len(self._timeseries)
 
         # Compute distribution of each query id in the cluster
-        self._ratio_map = {}
-        for qid, cnt in cnt_map.items():
-            self._ratio_map[qid] = cnt / total_cnt
+        self._counts = np.asarray(traces.sum(axis=1)).ravel()
+        self._ratios = self._counts / self._counts.sum()
+
+    def append(self, query_ids: np.ndarray, counts: sparse.coo_matrix) -> None:
+        """
+        Extend the aggregated time-series and the distribution of the queries with the counts of new trace rows.
+        Only the new (query, bucket) pairs are aggregated, and the time-series grows in a buffer with spare capacity.
+        :param query_ids: Query ids in the cluster (the previous query ids followed by the new ones)
+        :param counts: Sparse (query x bucket) counts of the new rows, whose row i is of query_ids[i]
+        :return: None
+        """
+        self._query_ids = query_ids
+        counts = sparse.coo_matrix(counts)
+        num_queries, num_buckets = counts.shape
+
+        if num_buckets > len(self._timeseries):
+            # Double the capacity, so that the time-series is copied a logarithmic number of times as it grows
+            timeseries = np.zeros(max(num_buckets, 2 * len(self._timeseries)))
+            timeseries[:self._num_buckets] = self._timeseries[:self._num_buckets]
+            self._timeseries = timeseries
+        self._num_buckets = max(self._num_buckets, num_buckets)
+        np.add.at(self._timeseries, counts.col, counts.data)
+
+        query_counts = np.zeros(num_queries)
+        query_counts[:len(self._counts)] = self._counts
+        np.add.at(query_counts, counts.row, counts.data)
+        self._counts = query_counts
+        self._ratios = self._counts / self._counts.sum()
 
     def get_timeseries(self) -> np.ndarray:
         """
         Get the aggregate time-series for this cluster
-        :return: Time-series for the cluster
+        :return: Time-series for the cluster (a view that the later appends may update in place)
         """
-        return self._timeseries
+        return self._timeseries[:self._num_buckets]
 
     def segregate(self, timeseries: List[float]) -> Dict:
         """
@@ -65,7 +84,7 @@ class QueryCluster:
         :param timeseries: Aggregated time-series
         :return: Time-series for each query id, dict{query id: time-series}
         """
-        result = {}
-        for qid, ratio in self._ratio_map.items():
-            result[qid] = list([x * ratio for x in timeseries])
-        return result
+        # Scale the aggregated time-series by the ratio of each query at once (every query of the cluster has a share
+        # of every data point, so the result is dense)
+        query_series = np.outer(self._ratios, np.asarray(timeseries, dtype=np.float64))
+        return dict(zip(self._query_ids, query_series))
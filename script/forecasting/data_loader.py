@@ -2,15 +2,29 @@
 """
 This file contains data loading logic from the query trace file produced. Hardcoded CSV format needs to be synced with
 query trace producer.
+
+The trace is read in chunks and bucketed with array operations, so that traces with hundreds of millions of rows can be
+loaded with bounded memory. The time-series of all the queries are kept as a sparse (query x bucket) matrix, since most
+queries only run in a small part of the buckets. Besides the CSV format, a trace can be converted into a binary format
+of fixed-size (query_id, timestamp) records (see DataLoader.convert_to_binary), which is memory-mapped instead of
+parsed.
+
+The time-series can be extended with the rows appended to the trace after it was loaded (see DataLoader.append_csv),
+which a TraceStream reads from the tailed trace file or from a local socket.
 """
 
-import csv
-from typing import Dict
+import os
+import socket
+from typing import Iterator, Optional, Tuple
 
 import numpy as np
+from scipy import sparse
 
 from ..testing.util.constants import LOG
 
+# Powers of ten to weight the digits of the integers in a trace file with
+_POWERS_OF_TEN = 10 ** np.arange(19, dtype=np.int64)
+
 
 class DataLoader:
     # Hardcoded query_id column index in the query_trace file
@@ -18,6 +32,16 @@ class DataLoader:
     # Hardcoded timestamp column index in the query_trace file
     TS_IDX = 1
 
+    # Record type of the binary query trace files
+    BINARY_TRACE_DTYPE = np.dtype([("query_id", "<i8"), ("timestamp", "<i8")])
+    # File suffix of the binary query trace files
+    BINARY_TRACE_SUFFIX = ".bin"
+
+    # Number of bytes of the CSV query trace file to parse at a time
+    CSV_CHUNK_BYTES = 4 * 1024 * 1024
+    # Number of records of the binary query trace file to bucket at a time
+    BINARY_CHUNK_ROWS = 4 * 1024 * 1024
+
     def __init__(self,
                  interval_us: int,
                  query_trace_file: str,
@@ -26,62 +50,381 @@ class DataLoader:
         A Dataloader represents a query trace file. The format of the CSV is hardcoded as class attributes, e.g QID_IDX
         The loader transforms the timestamps in the original file into time-series for each query id.
         :param interval_us: Interval for the time-series
-        :param query_trace_file: Query trace CSV file
+        :param query_trace_file: Query trace CSV file (or binary query trace file with the BINARY_TRACE_SUFFIX)
         """
         self._query_trace_file = query_trace_file
         self._interval_us = interval_us
 
-        data = self._load_data()
-        self._to_timeseries(data)
+        # Number of bytes of the CSV query trace file that are loaded
+        self._trace_offset = 0
+        self._start_timestamp = None
+        self._end_timestamp = None
+        # Index of each query id, in the order of their first appearance
+        self._qid_index = {}
+        # Counts of the rows appended since the time-series matrix was last built (see append)
+        self._appended_counts = []
+
+        self._to_timeseries(self._load_data())
 
-    def _load_data(self) -> np.ndarray:
+    def _load_data(self) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
         """
-        Load data from csv
-        :return: Loaded 2D numpy array of [query_id, timestamp]
+        Load data from the query trace file in chunks
+        :return: Iterator of the (query ids, timestamps) arrays of the chunks
         """
         LOG.info(f"Loading data from {self._query_trace_file}")
-        # Load data from the files
-        with open(self._query_trace_file, newline='') as csvfile:
-            reader = csv.DictReader(csvfile)
-            data = np.array(
-                [[int(r['query_id']), int(r[' timestamp'])] for r in reader])
+        if self._query_trace_file.endswith(self.BINARY_TRACE_SUFFIX):
+            yield from self._load_binary_data(self._query_trace_file)
+            return
+        for qids, timestamps, offset in self._load_csv_data(self._query_trace_file):
+            self._trace_offset = offset
+            yield qids, timestamps
 
-            if len(data) == 0:
-                raise ValueError("Empty trace file")
+    @classmethod
+    def _load_binary_data(cls, binary_trace_file: str) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Load data from a memory-mapped binary query trace file
+        :param binary_trace_file: Binary query trace file
+        :return: Iterator of the (query ids, timestamps) arrays of the chunks
+        """
+        records = np.memmap(binary_trace_file, dtype=cls.BINARY_TRACE_DTYPE, mode="r")
+        for start in range(0, len(records), cls.BINARY_CHUNK_ROWS):
+            chunk = records[start:start + cls.BINARY_CHUNK_ROWS]
+            yield np.asarray(chunk["query_id"]), np.asarray(chunk["timestamp"])
 
-            return data
+    @classmethod
+    def _load_csv_data(cls, query_trace_file: str) -> Iterator[Tuple[np.ndarray, np.ndarray, int]]:
+        """
+        Load data from a CSV query trace file, parsing whole lines CSV_CHUNK_BYTES at a time
+        :param query_trace_file: Query trace CSV file
+        :return: Iterator of the (query ids, timestamps, number of bytes of the file loaded so far) of the chunks
+        """
+        with open(query_trace_file, "rb") as f:
+            # Skip the header
+            f.readline()
+            remainder = b""
+            while True:
+                block = f.read(cls.CSV_CHUNK_BYTES)
+                if not block:
+                    break
+                block = remainder + block
+                # Keep the last partial line for the next chunk
+                lines, remainder = split_lines(block)
+                if lines:
+                    yield cls._parse_csv_chunk(lines) + (f.tell() - len(remainder),)
+            if remainder.strip():
+                yield cls._parse_csv_chunk(remainder + b"\n") + (f.tell(),)
 
-    def _to_timeseries(self, data: np.ndarray) -> None:
+    @classmethod
+    def _parse_csv_chunk(cls, chunk: bytes) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Parse the query id and timestamp columns of whole CSV lines. The lines are parsed with array operations rather
+        than a CSV reader, since the parameters column that follows may itself contain commas.
+        :param chunk: Whole lines of the query trace file (ending with a newline)
+        :return: The (query ids, timestamps) arrays of the lines
         """
-        Convert the 2D array with query id and timestamps into a map of time-series for each query id
-        :param data: Loaded 2D numpy array of [query_id, timestamp]
+        buf = np.frombuffer(chunk, dtype=np.uint8)
+        line_ends = np.flatnonzero(buf == ord("\n"))
+        line_starts = np.concatenate(([0], line_ends[:-1] + 1))
+        # Skip the empty lines
+        non_empty = line_ends > line_starts
+        line_starts, line_ends = line_starts[non_empty], line_ends[non_empty]
+        if len(line_starts) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+        # The query id and timestamp columns are the text before the first comma, and between the first and the second
+        # comma (or the end of the line) of each line
+        commas = np.append(np.flatnonzero(buf == ord(",")), len(buf))
+        first = np.searchsorted(commas, line_starts)
+        if np.any(commas[first] >= line_ends):
+            raise ValueError(f"Invalid query trace line without a timestamp in {chunk[:100]}")
+        second = np.minimum(commas[np.minimum(first + 1, len(commas) - 1)], line_ends)
+
+        columns = [None, None]
+        columns[cls.QID_IDX] = cls._parse_integers(buf, line_starts, commas[first])
+        columns[cls.TS_IDX] = cls._parse_integers(buf, commas[first] + 1, second)
+        return columns[0], columns[1]
+
+    @staticmethod
+    def _parse_integers(buf: np.ndarray, starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+        """
+        Parse the non-negative decimal integers in the byte ranges of a buffer (surrounding whitespaces are ignored)
+        :param buf: Buffer of the bytes
+        :param starts: Start (inclusive) of each range
+        :param ends: End (exclusive) of each range
+        :return: The parsed integers
+        """
+        lengths = ends - starts
+        if np.any(lengths <= 0):
+            raise ValueError("Missing integer in the query trace file")
+        offsets = np.concatenate(([0], np.cumsum(lengths)))
+        # Index of every byte in the ranges, and the range of every byte
+        range_ids = np.repeat(np.arange(len(starts)), lengths)
+        values = buf[starts[range_ids] + np.arange(offsets[-1]) - offsets[range_ids]]
+
+        # The non-digit bytes wrap around to values above 9
+        digits = values - np.uint8(ord("0"))
+        is_digit = digits < 10
+        if not np.all(is_digit | (values == ord(" ")) | (values == ord("\t")) | (values == ord("\r"))):
+            raise ValueError("Invalid integer in the query trace file")
+        digit_counts = np.add.reduceat(is_digit, offsets[:-1], dtype=np.int64)
+        if np.any(digit_counts == 0) or np.any(digit_counts > len(_POWERS_OF_TEN)):
+            raise ValueError("Missing or too long integer in the query trace file")
+
+        # Each digit is weighted by 10 to the power of the number of digits after it in its range
+        digits_after = np.repeat(np.cumsum(digit_counts), lengths) - np.cumsum(is_digit)
+        weighted = digits * is_digit * _POWERS_OF_TEN[np.minimum(digits_after, len(_POWERS_OF_TEN) - 1)]
+        return np.add.reduceat(weighted, offsets[:-1])
+
+    @classmethod
+    def convert_to_binary(cls, query_trace_file: str, binary_trace_file: str) -> None:
+        """
+        Convert a CSV query trace file into the binary query trace format, so that it is memory-mapped when loaded
+        :param query_trace_file: Query trace CSV file
+        :param binary_trace_file: Binary query trace file to write (should end with the BINARY_TRACE_SUFFIX)
+        """
+        with open(binary_trace_file, "wb") as f:
+            for qids, timestamps, _ in cls._load_csv_data(query_trace_file):
+                records = np.empty(len(qids), dtype=cls.BINARY_TRACE_DTYPE)
+                records["query_id"] = qids
+                records["timestamp"] = timestamps
+                records.tofile(f)
+
+    def _count_pairs(self, chunks: Iterator[Tuple[np.ndarray, np.ndarray]]) -> sparse.coo_matrix:
+        """
+        Count the (query, bucket) pairs of the chunks of query ids and timestamps.
+
+        The (query, bucket) counts of each chunk are reduced as the chunks are loaded. The first and last timestamps
+        and the index of the query ids are extended with the chunks.
+        :param chunks: Iterator of the (query ids, timestamps) arrays of the chunks
+        :return: Sparse (query x bucket) counts of the chunks (with duplicate entries for the pairs counted in
+                 multiple chunks)
+        """
+        empty = np.zeros(0, dtype=np.int64)
+        pair_qids, pair_buckets, pair_counts = [empty], [empty], [empty]
+        for qids, timestamps in chunks:
+            if len(qids) == 0:
+                continue
+            # Query trace file is sorted by timestamps
+            if self._start_timestamp is None:
+                self._start_timestamp = timestamps[0]
+            chunk_end_timestamp = timestamps.max()
+            if self._end_timestamp is None or chunk_end_timestamp > self._end_timestamp:
+                self._end_timestamp = chunk_end_timestamp
+
+            # Bucket index
+            buckets = (timestamps - self._start_timestamp) // self._interval_us
+            if buckets.min() < 0:
+                raise ValueError("Query trace file is not sorted by timestamps.")
+
+            # Index the new query ids of the chunk
+            unique_qids, first_rows, inverse = np.unique(qids, return_index=True, return_inverse=True)
+            for i in np.argsort(first_rows):
+                self._qid_index.setdefault(unique_qids[i], len(self._qid_index))
+            chunk_qid_index = np.array([self._qid_index[qid] for qid in unique_qids])
+
+            # Count the (query, bucket) pairs of the chunk
+            min_bucket = buckets.min()
+            span = buckets.max() - min_bucket + 1
+            keys, counts = np.unique(inverse.reshape(-1) * span + (buckets - min_bucket), return_counts=True)
+            pair_qids.append(chunk_qid_index[keys // span])
+            pair_buckets.append(keys % span + min_bucket)
+            pair_counts.append(counts)
+
+        num_buckets = 0
+        if self._start_timestamp is not None:
+            num_buckets = (self._end_timestamp - self._start_timestamp) // self._interval_us + 1
+        return sparse.coo_matrix((np.concatenate(pair_counts).astype(np.float64),
+                                  (np.concatenate(pair_qids), np.concatenate(pair_buckets))),
+                                 shape=(len(self._qid_index), num_buckets))
+
+    def _to_timeseries(self, chunks: Iterator[Tuple[np.ndarray, np.ndarray]]) -> None:
+        """
+        Convert the chunks of query ids and timestamps into the sparse matrix of the time-series of all the query ids.
+
+        The matrix is built from all the (query, bucket) pairs at once (summing the pairs counted in multiple chunks).
+        :param chunks: Iterator of the (query ids, timestamps) arrays of the chunks
         :return: None
         """
-        # Query trace file is sorted by timestamps
-        start_timestamp = data[0][self.TS_IDX]
-        end_timestamp = data[-1][self.TS_IDX]
+        counts = self._count_pairs(chunks)
+
+        if self._start_timestamp is None:
+            raise ValueError("Empty trace file")
 
-        if end_timestamp - start_timestamp <= 1:
+        if self._end_timestamp - self._start_timestamp <= 1:
             raise ValueError(
                 "Empty data set with start timestamp >= end timestamp.")
 
-        # Number of data points in the new time-series
-        num_buckets = (end_timestamp - start_timestamp -
-                       1) // self._interval_us + 1
+        self._query_ids = np.array(list(self._qid_index), dtype=np.int64)
+        self._ts_data = counts.tocsr()
 
-        # Iterate through the timestamps
-        self._ts_data = {}
-        for i in range(len(data)):
-            t = data[i][self.TS_IDX]
-            qid = data[i][self.QID_IDX]
+    def append(self, chunks: Iterator[Tuple[np.ndarray, np.ndarray]]) -> sparse.coo_matrix:
+        """
+        Extend the time-series with new rows of the trace. The rows are added to the existing buckets, and the
+        time-series grow with the buckets (and the query ids) that the rows add.
 
-            # Initialize a new query's time-series
-            if self._ts_data.get(qid) is None:
-                self._ts_data[qid] = np.zeros(num_buckets)
+        Only the (query, bucket) pairs of the new rows are counted. They are merged into the time-series matrix the
+        next time it is requested (see get_ts_data), so appending does not copy the matrix.
+        :param chunks: Iterator of the (query ids, timestamps) arrays of the new rows
+        :return: Sparse (query x bucket) counts of the new rows, in the shape of the extended time-series
+        """
+        num_queries = len(self._qid_index)
+        counts = self._count_pairs(chunks)
+        if len(self._qid_index) > num_queries:
+            self._query_ids = np.array(list(self._qid_index), dtype=np.int64)
+        self._appended_counts.append(counts)
+        return counts
+
+    def append_csv(self, lines: bytes) -> sparse.coo_matrix:
+        """
+        Extend the time-series with new rows of the trace in the CSV format (see append)
+        :param lines: Whole CSV lines of the new rows (without the header)
+        :return: Sparse (query x bucket) counts of the new rows, in the shape of the extended time-series
+        """
+        return self.append([self._parse_csv_chunk(lines)])
+
+    def get_trace_offset(self) -> int:
+        """
+        :return: Number of bytes of the CSV query trace file that are loaded, where a TraceStream tailing the file
+                 starts from
+        """
+        return self._trace_offset
+
+    def get_num_complete_buckets(self) -> int:
+        """
+        :return: Number of the leading buckets of the time-series that are complete, which excludes the bucket of the
+                 latest timestamp (that may still get new rows)
+        """
+        return (self._end_timestamp - self._start_timestamp) // self._interval_us
+
+    def get_query_ids(self) -> np.ndarray:
+        """
+        :return: Query ids in the order of their first appearance in the trace (the rows of the time-series matrix)
+        """
+        return self._query_ids
+
+    def get_ts_data(self) -> Tuple[np.ndarray, sparse.csr_matrix]:
+        """
+        Get the time-series of the query ids
+        :return: (query ids in the order of their first appearance in the trace,
+                  sparse (query x bucket) matrix whose row i is the time-series of query ids[i])
+        """
+        if self._appended_counts:
+            shape = self._appended_counts[-1].shape
+            for counts in self._appended_counts:
+                counts.resize(shape)
+            self._ts_data.resize(shape)
+            self._ts_data = self._ts_data + sparse.coo_matrix(
+                (np.concatenate([counts.data for counts in self._appended_counts]),
+                 (np.concatenate([counts.row for counts in self._appended_counts]),
+                  np.concatenate([counts.col for counts in self._appended_counts]))),
+                shape=shape).tocsr()
+            self._appended_counts = []
+        return self._query_ids, self._ts_data
 
-            # Bucket index
-            bi = (t - start_timestamp) // self._interval_us
-            self._ts_data[qid][bi] += 1
 
-    def get_ts_data(self) -> Dict:
-        return self._ts_data
+def split_lines(data: bytes) -> Tuple[bytes, bytes]:
+    """
+    Split data at the end of its last whole line
+    :param data: Data with lines
+    :return: (the whole lines, the last partial line)
+    """
+    end = data.rfind(b"\n") + 1
+    return data[:end], data[end:]
+
+
+class TraceStream:
+    """
+    Reads the rows that are appended to a CSV query trace, either by tailing the query trace file or from the
+    connections to a local (Unix domain) socket that the rows are written to. Only whole lines are returned, and a
+    partial line is kept until the rest of it arrives. The reads do not block.
+    """
+
+    # Number of bytes to receive from a connection at a time
+    RECV_BYTES = 1024 * 1024
+
+    def __init__(self,
+                 query_trace_file: Optional[str] = None,
+                 offset: int = 0,
+                 socket_path: Optional[str] = None) -> None:
+        """
+        Exactly one of query_trace_file and socket_path should be given.
+        :param query_trace_file: Query trace CSV file to tail
+        :param offset: Offset of the query trace file to start reading from (after the rows that are already loaded,
+            see DataLoader.get_trace_offset)
+        :param socket_path: Path of the socket to listen on. Every connection writes CSV lines of the query trace
+            (without the header).
+        """
+        if (query_trace_file is None) == (socket_path is None):
+            raise ValueError("Exactly one of the query trace file and the socket path should be given")
+
+        self._file = None
+        self._socket_path = socket_path
+        self._server = None
+        # The partial line of the file, or of each connection
+        self._partial_lines = {}
+        if query_trace_file is not None:
+            self._file = open(query_trace_file, "rb")
+            self._file.seek(offset)
+            self._partial_lines[self._file] = b""
+        else:
+            self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._server.bind(socket_path)
+            self._server.listen()
+            self._server.setblocking(False)
+
+    def read(self) -> bytes:
+        """
+        Read the rows that have arrived since the last read
+        :return: Whole CSV lines of the rows (empty if there are no new rows)
+        """
+        if self._file is not None:
+            lines, self._partial_lines[self._file] = split_lines(self._partial_lines[self._file] + self._file.read())
+            return lines
+
+        # Accept the new connections
+        while True:
+            try:
+                conn, _ = self._server.accept()
+            except BlockingIOError:
+                break
+            conn.setblocking(False)
+            self._partial_lines[conn] = b""
+
+        all_lines = []
+        for conn in list(self._partial_lines):
+            blocks = [self._partial_lines[conn]]
+            closed = False
+            while True:
+                try:
+                    block = conn.recv(self.RECV_BYTES)
+                except BlockingIOError:
+                    break
+                if not block:
+                    closed = True
+                    break
+                blocks.append(block)
+
+            lines, partial_line = split_lines(b"".join(blocks))
+            all_lines.append(lines)
+            if closed:
+                # The last line of a closed connection is whole
+                if partial_line.strip():
+                    all_lines.append(partial_line + b"\n")
+                conn.close()
+                del self._partial_lines[conn]
+            else:
+                self._partial_lines[conn] = partial_line
+        return b"".join(all_lines)
+
+    def close(self) -> None:
+        """
+        Close the file, or the socket and its connections
+        :return: None
+        """
+        for f in self._partial_lines:
+            f.close()
+        self._partial_lines = {}
+        if self._server is not None:
+            self._server.close()
+            os.unlink(self._socket_path)
+            self._server = None
@@ -8,6 +8,10 @@ Example usage:
 - Use the trained models (LSTM) to generate predictions.
     ./forecaster --model_load_path=model.pickle --test_file=test_query.csv --test_model=LSTM
 
+- Keep generating predictions for the new sequences as the rows are appended to the test query trace file (or written
+  to a local socket with --stream_socket)
+    ./forecaster --model_load_path=model.pickle --test_file=test_query.csv --test_model=LSTM --stream
+
 
 TODO:
     - Better metrics for training and prediction (currently not focusing on models' accuracy yet)
@@ -17,10 +21,12 @@ TODO:
 import argparse
 import json
 import pickle
+import time
 from functools import lru_cache
 from typing import Dict, List, Optional, Tuple, Union
 
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 
 from ..testing.self_driving.constants import (DEFAULT_ITER_NUM,
                                               DEFAULT_QUERY_TRACE_FILE,
@@ -29,7 +35,7 @@ from ..testing.self_driving.constants import (DEFAULT_ITER_NUM,
 from ..testing.self_driving.forecast import gen_oltp_trace
 from ..testing.util.constants import LOG
 from .cluster import QueryCluster
-from .data_loader import DataLoader
+from .data_loader import DataLoader, TraceStream
 from .models import ForecastModel, get_models
 
 # Interval duration for aggregation in microseconds
@@ -114,6 +120,20 @@ argp.add_argument(
     type=str,
     help="Model to be used for forecasting"
 )
+argp.add_argument(
+    "--stream",
+    default=False,
+    action="store_true",
+    help="If specified, keep forecasting the new sequences as new rows are appended to the test query trace file")
+argp.add_argument(
+    "--stream_socket",
+    metavar="FILE",
+    help="Path of a local socket to stream the new rows of the test query trace from instead of the test file")
+argp.add_argument(
+    "--stream_interval",
+    type=float,
+    default=INTERVAL_MICRO_SEC / MICRO_SEC_PER_SEC,
+    help="Number of seconds between reading the new rows when streaming")
 
 
 class Forecaster:
@@ -151,6 +171,9 @@ class Forecaster:
 
         self._make_clusters()
 
+        # Start index of the next new sequence of each cluster (see new_seqs)
+        self._seq_offsets = [0] * len(self._clusters)
+
     def _make_clusters(self) -> None:
         """
         Extract data from the DataLoader and put them into different clusters.
@@ -160,7 +183,14 @@ class Forecaster:
         # Assuming all the queries in the current trace file are from
         # the same cluster for now. A future TODO would have a clustering
         # process that separates traces into multiple clusters
-        self._clusters = [QueryCluster(self._data_loader.get_ts_data())]
+        self._clusters = [QueryCluster(*self._data_loader.get_ts_data())]
+        self._split_clusters()
+
+    def _split_clusters(self) -> None:
+        """
+        Split the aggregated time-series of the clusters into the training and testing sets
+        :return: None
+        """
         self._cluster_data = []
         for cluster in self._clusters:
             # Aggregated time-series from the cluster
@@ -195,17 +225,18 @@ class Forecaster:
                    input_data: np.ndarray,
                    start: int,
                    end: int,
-                   with_label: bool = False) -> List[Union[Tuple[np.ndarray,
-                                                                 np.ndarray],
-                                                           np.ndarray]]:
+                   with_label: bool = False) -> Union[Tuple[np.ndarray, np.ndarray], np.ndarray]:
         """
         Create time-series sequences of fixed sequence length from a continuous range of time-series.
+
+        The sequences are the windows of a strided view over the time-series, which are copied into one contiguous
+        array at once.
         :param input_data: Input time-series
         :param start: Start index (inclusive) of the first sequence to be made
         :param end:  End index (exclusive) of the last sequence to be made
         :param with_label: True if label in a certain horizon is added
-        :return: Sequences of fixed length if with_label is False,
-                or List of fixed length sequence and label if with_label is True
+        :return: Sequences of fixed length (of shape (N, seq_len, 1)) if with_label is False,
+                or Tuple of the sequences and their labels (of shape (N, 1)) if with_label is True
         """
         seq_len = self._seq_len
         horizon = self._horizon_len
@@ -221,34 +252,30 @@ class Forecaster:
         if seq_end <= seq_start:
             raise IndexError(f"Not enough data points to make sequences")
 
-        seqs = []
-        for i in range(seq_start, seq_end):
-            seq = input_data[i:i + seq_len].reshape(-1, 1)
+        # Window i of the view is the sequence starting at seq_start + i
+        windows = sliding_window_view(input_data[seq_start:seq_end + seq_len - 1], seq_len)
+        seqs = np.ascontiguousarray(windows)[:, :, np.newaxis]
 
-            # Look beyond the horizon to get the label
-            if with_label:
-                label_i = i + seq_len + horizon
-                label = input_data[label_i: label_i + 1].reshape(1, -1)
-                seqs.append((seq, label))
-            else:
-                seqs.append(seq)
+        if with_label:
+            # Look beyond the horizon to get the labels
+            label_start = seq_start + seq_len + horizon
+            labels = np.array(input_data[label_start:label_start + len(seqs)]).reshape(-1, 1)
+            return seqs, labels
         return seqs
 
     @lru_cache(maxsize=32)
     def _cluster_seqs(self,
                       cluster_id: int,
                       test_mode: bool = False,
-                      with_label: bool = False) -> List[Union[Tuple[np.ndarray,
-                                                                    np.ndarray],
-                                                              np.ndarray]]:
+                      with_label: bool = False) -> Union[Tuple[np.ndarray, np.ndarray], np.ndarray]:
         """
         Create time-series sequences of fixed sequence length from a continuous range of time-series. A cached wrapper
         over _make_seqs with different options.
         :param cluster_id: Cluster id
         :param test_mode: True if using test dataset, otherwise use the training dataset
         :param with_label: True if label (time-series data in a horizon from the sequence) is also added.
-        :return: Sequences of fixed length if with_label is False,
-                or List of fixed length sequence and label if with_label is True
+        :return: Sequences of fixed length (of shape (N, seq_len, 1)) if with_label is False,
+                or Tuple of the sequences and their labels (of shape (N, 1)) if with_label is True
         """
         if test_mode:
             input_data = self._cluster_data[cluster_id][self.TEST_DATA_IDX]
@@ -262,6 +289,49 @@ class Forecaster:
             with_label=with_label)
         return seqs
 
+    def append(self, lines: bytes) -> None:
+        """
+        Extend the time-series of the clusters with new rows of the trace, without reloading the trace file. Only the
+        (query, bucket) pairs of the new rows are added to the clusters.
+        :param lines: Whole CSV lines of the new rows
+        :return: None
+        """
+        if not lines:
+            return
+        counts = self._data_loader.append_csv(lines)
+        # FIXME:
+        # Assuming all the queries are from the same cluster for now (see _make_clusters)
+        for cluster in self._clusters:
+            cluster.append(self._data_loader.get_query_ids(), counts)
+        self._split_clusters()
+        self._cluster_seqs.cache_clear()
+
+    def get_trace_offset(self) -> int:
+        """
+        :return: Number of bytes of the trace file that are loaded (see DataLoader.get_trace_offset)
+        """
+        return self._data_loader.get_trace_offset()
+
+    def new_seqs(self, cid: int) -> np.ndarray:
+        """
+        Create the sequences that have not been created by new_seqs yet. Only the complete buckets of the time-series
+        are used, so a sequence is created once all of its data points are final.
+        :param cid: Cluster id
+        :return: New sequences of fixed length, of shape (N, seq_len, 1) (N is 0 if there are not enough new data
+                 points)
+        """
+        if not self._test_mode:
+            raise ValueError("New sequences are only made in the test mode.")
+
+        input_data = self._cluster_data[cid][self.TEST_DATA_IDX]
+        end = self._data_loader.get_num_complete_buckets()
+        try:
+            seqs = self._make_seqs(input_data, self._seq_offsets[cid], end, with_label=False)
+        except IndexError:
+            return np.zeros((0, self._seq_len, 1))
+        self._seq_offsets[cid] = end - self._seq_len
+        return seqs
+
     def train(self, models_kwargs: Dict) -> List[List[ForecastModel]]:
         """
         :param models_kwargs: A dictionary of models' init arguments
@@ -286,17 +356,13 @@ class Forecaster:
         :param cid: Cluster id
         :param model: Model to use
         """
-        eval_seqs = self._cluster_seqs(cid, test_mode=True, with_label=True)
-        preds = []
-        gts = []
-        for seq, label in eval_seqs:
-            pred = model.predict(seq)
-            preds.append(pred)
-            gts.append(label.item())
+        eval_seqs, eval_labels = self._cluster_seqs(cid, test_mode=True, with_label=True)
+        preds = model.predict(eval_seqs)
+        gts = eval_labels.reshape(-1)
 
         # FIXME:
         # simple L2 norm for comparing the prediction and results
-        l2norm = np.linalg.norm(np.array(preds) - np.array(gts))
+        l2norm = np.linalg.norm(preds - gts)
         LOG.info(
             f"[{model.name}] has L2 norm(prediction, ground truth) = {l2norm}")
 
@@ -308,11 +374,25 @@ class Forecaster:
         :return: Dict of {query_id -> time-series}
         """
         test_seqs = self._cluster_seqs(cid, test_mode=True, with_label=False)
-        preds = list([model.predict(seq) for seq in test_seqs])
+        preds = model.predict(test_seqs)
         query_preds = self._clusters[cid].segregate(preds)
 
         return query_preds
 
+    def predict_new(self, cid: int, model: ForecastModel) -> Dict:
+        """
+        Output prediction on the new sequences (see new_seqs), and segregate the predicted cluster time-series into
+        individual queries
+        :param cid: Cluser id
+        :param model: Model to use
+        :return: Dict of {query_id -> time-series} (empty if there are no new sequences)
+        """
+        new_seqs = self.new_seqs(cid)
+        if len(new_seqs) == 0:
+            return {}
+        preds = model.predict(new_seqs)
+        return self._clusters[cid].segregate(preds)
+
 
 def parse_model_config(model_names: Optional[List[str]],
                        models_config: Optional[str]) -> Dict:
@@ -380,12 +460,32 @@ if __name__ == "__main__":
             eval_size=args.eval_size,
             horizon_len=args.horizon_len)
 
-        # FIXME:
-        # Assuming all the queries in the current trace file are from
-        # the same cluster for now
-        query_pred = forecaster.predict(0, models[0][args.test_model])
+        if not args.stream:
+            # FIXME:
+            # Assuming all the queries in the current trace file are from
+            # the same cluster for now
+            query_pred = forecaster.predict(0, models[0][args.test_model])
 
-        # TODO:
-        # How are we consuming predictions?
-        for qid, ts in query_pred.items():
-            LOG.info(f"[Query: {qid}] pred={ts[:10]}")
+            # TODO:
+            # How are we consuming predictions?
+            for qid, ts in query_pred.items():
+                LOG.info(f"[Query: {qid}] pred={ts[:10]}")
+        else:
+            if args.stream_socket is not None:
+                stream = TraceStream(socket_path=args.stream_socket)
+            elif args.test_file.endswith(DataLoader.BINARY_TRACE_SUFFIX):
+                raise ValueError("Binary query trace files cannot be streamed.")
+            else:
+                stream = TraceStream(query_trace_file=args.test_file, offset=forecaster.get_trace_offset())
+
+            try:
+                while True:
+                    forecaster.append(stream.read())
+                    query_pred = forecaster.predict_new(0, models[0][args.test_model])
+                    for qid, ts in query_pred.items():
+                        LOG.info(f"[Query: {qid}] pred={ts[:10]}")
+                    time.sleep(args.stream_interval)
+            except KeyboardInterrupt:
+                pass
+            finally:
+                stream.close()
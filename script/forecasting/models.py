@@ -5,12 +5,14 @@ ForecastModel, and override the _do_fit and _do_predict abstract methods
 """
 
 from abc import ABC, abstractmethod
-from typing import Dict, List, Tuple
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional, Tuple
 
 import numpy as np
 import torch
 import torch.nn as nn
 from sklearn.preprocessing import MinMaxScaler
+from torch.utils.data import DataLoader, TensorDataset
 
 from ..testing.util.constants import LOG
 
@@ -46,62 +48,56 @@ class ForecastModel(ABC):
     def name(self):
         return self.__class__.__name__
 
-    def fit(self, train_seqs: List[Tuple[np.ndarray, np.ndarray]]) -> None:
+    def fit(self, train_seqs: Tuple[np.ndarray, np.ndarray]) -> None:
         """
         Fit the model with sequences
-        :param train_seqs: List of training sequences and the expected output label in a certain horizon
+        :param train_seqs: Training sequences (of shape (N, seq_len, 1)) and the expected output labels in a certain
+            horizon (of shape (N, 1))
         :return:
         """
-        data = []
-        for seq, _label in train_seqs:
-            data = np.append(data, seq)
-        data = data.reshape(-1, 1)
+        seqs, labels = train_seqs
+        data = seqs.reshape(-1, 1)
         self._x_transformer, self._y_transformer = self._get_transformers(data)
 
-        if self._x_transformer or self._y_transformer:
-            def norm_data(x):
-                seq, label = x
-                if self._x_transformer:
-                    seq = self._x_transformer.transform(seq)
-                if self._y_transformer:
-                    label = self._y_transformer.transform(label)
-                return seq, label
-            # Use Map to save memory copy
-            train_seqs = list(map(norm_data, train_seqs))
+        # The transformers work on single columns of data points
+        if self._x_transformer:
+            seqs = self._x_transformer.transform(data).reshape(seqs.shape)
+        if self._y_transformer:
+            labels = self._y_transformer.transform(labels)
 
-        self._do_fit(train_seqs)
+        self._do_fit((seqs, labels))
 
     @abstractmethod
     def _do_fit(
-            self, trains_seqs: List[Tuple[np.ndarray, np.ndarray]]) -> None:
+            self, trains_seqs: Tuple[np.ndarray, np.ndarray]) -> None:
         """
         Perform fitting.
         Should be overloaded by a specific model implementation.
-        :param train_seqs: List of training sequences and the expected output label in a certain horizon. Normalization
-            would have been done if needed
+        :param train_seqs: Training sequences (of shape (N, seq_len, 1)) and the expected output labels in a certain
+            horizon (of shape (N, 1)). Normalization would have been done if needed
         :return:
         """
         raise NotImplementedError("Should be implemented by child classes")
 
-    def predict(self, test_seq: np.ndarray) -> float:
+    def predict(self, test_seqs: np.ndarray) -> np.ndarray:
         """
-        Test a fitted model with a sequence.
-        :param test_seq:  1D Test sequence
-        :return: Predicted value at certain horizon
+        Test a fitted model with sequences.
+        :param test_seqs: Test sequences (of shape (N, seq_len, 1))
+        :return: Predicted values at certain horizon (of shape (N,))
         """
 
         if self._x_transformer:
-            test_seq = self._x_transformer.transform(test_seq)
+            test_seqs = self._x_transformer.transform(test_seqs.reshape(-1, 1)).reshape(test_seqs.shape)
 
-        return self._do_predict(test_seq)
+        return self._do_predict(test_seqs)
 
     @abstractmethod
-    def _do_predict(self, test_seq: np.ndarray) -> float:
+    def _do_predict(self, test_seqs: np.ndarray) -> np.ndarray:
         """
         Perform testing.
         Should be overloaded by a specific model implementation.
-        :param test_seq:  1D Test sequence
-        :return: Predicted value at certain horizon
+        :param test_seqs: Test sequences (of shape (N, seq_len, 1)). Normalization would have been done if needed
+        :return: Predicted values at certain horizon (of shape (N,))
         """
         raise NotImplementedError("Should be implemented by child classes")
 
@@ -128,6 +124,8 @@ class LSTM(nn.Module, ForecastModel):
             output_size: int = 1,
             lr: float = 0.001,
             epochs: int = 10,
+            batch_size: int = 32,
+            num_threads: Optional[int] = None,
     ):
         """
         :param input_size: One data point that is fed into the LSTM each time
@@ -135,88 +133,119 @@ class LSTM(nn.Module, ForecastModel):
         :param output_size: One output data point
         :param lr: learning rate while fitting
         :param epochs: number of epochs for fitting
-        :param x_transformer: To transform the seq input
-        :param y_transformer: To transform the label
+        :param batch_size: number of sequences in a mini-batch while fitting
+        :param num_threads: number of threads for torch to use while fitting and predicting (the torch default if None)
         """
         nn.Module.__init__(self)
         ForecastModel.__init__(self)
 
         self._hidden_layer_size = hidden_layer_size
 
-        self._lstm = nn.LSTM(input_size, hidden_layer_size)
+        self._lstm = nn.LSTM(input_size, hidden_layer_size, batch_first=True)
 
         self._linear = nn.Linear(hidden_layer_size, output_size)
 
-        self._hidden_cell = (torch.zeros(1, 1, self._hidden_layer_size),
-                             torch.zeros(1, 1, self._hidden_layer_size))
-
         self._epochs = epochs
         self._lr = lr
+        self._batch_size = batch_size
+        self._num_threads = num_threads
+
+    def forward(self, input_seqs: torch.FloatTensor) -> torch.FloatTensor:
+        """
+        Forward propogation. Every sequence starts from zero hidden and cell states.
+        :param input_seqs: FloatTensor of a batch of sequences (of shape (batch, seq_len, input_size))
+        :return: A single value prediction for each sequence (of shape (batch, output_size))
+        """
+        lstm_out, _ = self._lstm(input_seqs)
+        return self._linear(lstm_out[:, -1, :])
 
-    def forward(self, input_seq: torch.FloatTensor) -> float:
+    def __setstate__(self, state: Dict) -> None:
+        """
+        Restore a pickled model. Models pickled before the batched training carry the hidden state of the
+        single-sequence predictions, lack the batch_size and num_threads settings, and have an LSTM layer that takes
+        (seq_len, batch, input_size) inputs
+        :param state: Pickled attributes
+        :return: None
+        """
+        state.pop('_hidden_cell', None)
+        state.setdefault('_batch_size', 32)
+        state.setdefault('_num_threads', None)
+        super().__setstate__(state)
+        # The parameters do not depend on the input layout, so switching it keeps the trained weights
+        self._lstm.batch_first = True
+
+    @contextmanager
+    def _torch_num_threads(self) -> Iterator[None]:
         """
-        Forward propogation
-        :param input_seq:  1D FloatTensor
-        :return: A single value prediction
+        Set the number of threads for torch to use, if the model is configured with one, and restore the previous
+        number on exit (the setting applies to the whole process)
+        :return: None
+        """
+        if self._num_threads is None:
+            yield
+            return
+
+        previous_num_threads = torch.get_num_threads()
+        torch.set_num_threads(self._num_threads)
+        try:
+            yield
+        finally:
+            torch.set_num_threads(previous_num_threads)
+
+    def _do_fit(self, train_seqs: Tuple[np.ndarray, np.ndarray]) -> None:
+        """
+        Perform training on the time series trace data, in shuffled mini-batches of the sequences.
+        :param train_seqs: Training (sequences, labels)
+        :return: None
         """
-        lstm_out, self._hidden_cell = self._lstm(
-            input_seq.view(len(input_seq), 1, -1), self._hidden_cell)
-        predictions = self._linear(lstm_out.view(len(input_seq), -1))
-        return predictions[-1]
+        with self._torch_num_threads():
+            self._fit_batches(train_seqs)
 
-    def _do_fit(self, train_seqs: List[Tuple[np.ndarray, np.ndarray]]) -> None:
+    def _fit_batches(self, train_seqs: Tuple[np.ndarray, np.ndarray]) -> None:
         """
-        Perform training on the time series trace data.
-        :param train_seqs: Training sequences of (seq, label)
+        Run the training epochs over the shuffled mini-batches of the sequences.
+        :param train_seqs: Training (sequences, labels)
         :return: None
         """
         epochs = self._epochs
         lr = self._lr
 
+        seqs, labels = train_seqs
+        batches = DataLoader(TensorDataset(torch.FloatTensor(seqs), torch.FloatTensor(labels)),
+                             batch_size=self._batch_size,
+                             shuffle=True)
+
         # Training specifics
         loss_function = nn.MSELoss()
         optimizer = torch.optim.Adam(self.parameters(), lr=lr)
-        LOG.info(f"Training with {len(train_seqs)} samples, {epochs} epochs:")
+        LOG.info(f"Training with {len(seqs)} samples, {epochs} epochs, batch size {self._batch_size}:")
         for i in range(epochs):
-            for seq, labels in train_seqs:
+            for batch_seqs, batch_labels in batches:
                 optimizer.zero_grad()
 
-                self._hidden_cell = (
-                    torch.zeros(
-                        1, 1, self._hidden_layer_size), torch.zeros(
-                        1, 1, self._hidden_layer_size))
-
-                seq = torch.FloatTensor(seq).view(-1)
-                labels = torch.FloatTensor(labels).view(-1)
+                y_pred = self(batch_seqs)
 
-                y_pred = self(seq)
-
-                single_loss = loss_function(y_pred, labels)
-                single_loss.backward()
+                batch_loss = loss_function(y_pred, batch_labels)
+                batch_loss.backward()
                 optimizer.step()
 
             if i % 25 == 0:
                 LOG.info(
-                    f'[LSTM FIT]epoch: {i+1:3} loss: {single_loss.item():10.8f}')
+                    f'[LSTM FIT]epoch: {i+1:3} loss: {batch_loss.item():10.8f}')
 
         LOG.info(
-            f'[LSTM FIT]epoch: {epochs:3} loss: {single_loss.item():10.10f}')
+            f'[LSTM FIT]epoch: {epochs:3} loss: {batch_loss.item():10.10f}')
 
-    def _do_predict(self, seq: np.ndarray) -> float:
+    def _do_predict(self, seqs: np.ndarray) -> np.ndarray:
         """
-        Perform inference on a dataset. Returns a list of prediction results
-        :param seq: Sequence for testing
+        Perform inference on all the sequences in one forward pass.
+        :param seqs: Sequences for testing
         :return: Prediction results
         """
-        # To tensor
-        seq = torch.FloatTensor(seq).view(-1)
-
-        with torch.no_grad():
-            self._hidden = (torch.zeros(1, 1, self._hidden_layer_size),
-                            torch.zeros(1, 1, self._hidden_layer_size))
-            pred = self(seq)
+        with self._torch_num_threads(), torch.no_grad():
+            preds = self(torch.FloatTensor(seqs))
 
-        return pred.item()
+        return preds.numpy().reshape(-1)
 
     def _get_transformers(self, data: np.ndarray) -> Tuple:
         """
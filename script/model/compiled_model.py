@@ -0,0 +1,310 @@
+"""Compiled fast-path inference for the trained mini models.
+
+Model.predict runs the input transformer, the log transform, the StandardScaler, the base model, and the inverse
+transforms as separate steps with fresh allocations. compile_model precomputes the whole pipeline for the supported
+base models:
+
+- Linear models ('lr', and the per-output linear models of 'huber' and 'svr'): the input and output scalers are folded
+  into the weights, so the prediction is a single matrix multiply on the (log transformed) input.
+- Tree ensembles ('rf', and the per-output LightGBM boosters of 'gbm'): the trees are flattened into node arrays that
+  are evaluated for all the rows at once, with the output scaler folded into the leaf values.
+
+The tree evaluation steps every (tree, row) pair through the depth of the trees, so it only beats the native
+prediction of the base model on small batches (e.g., single-row requests). Batches with more than
+_MAX_TREE_ROW_PAIRS (tree, row) pairs are predicted by Model.predict instead (see CompiledModel.max_rows).
+
+The numerical result matches Model.predict (up to floating point rounding).
+"""
+
+import numpy as np
+
+from sklearn import ensemble
+from sklearn import linear_model
+from sklearn import multioutput
+from sklearn import svm
+
+import lightgbm as lgb
+
+# Base estimators that are linear in the (transformed) input
+_LINEAR_ESTIMATORS = (linear_model.LinearRegression, linear_model.HuberRegressor, svm.LinearSVR)
+
+# Maximum number of (tree, row) pairs that the compiled tree ensembles evaluate in a prediction. Above it the native
+# prediction of LightGBM (and of sklearn) is faster, and the per-step arrays would grow with the batch size.
+_MAX_TREE_ROW_PAIRS = 32768
+
+
+def compile_model(model, log_eps):
+    """Compile a trained Model into a CompiledModel
+
+    :param model: the trained model.Model
+    :param log_eps: the epsilon added to the data before the log transformation
+    :return: the CompiledModel, or None if the base model is not supported
+    """
+    x_mean, x_scale, y_mean, y_scale = _get_scaler_params(model)
+
+    base_model = model._base_model
+    evaluator = None
+    if isinstance(base_model, _LINEAR_ESTIMATORS):
+        evaluator = _compile_linear([base_model], x_mean, x_scale, y_mean, y_scale)
+    elif isinstance(base_model, ensemble.RandomForestRegressor):
+        evaluator = _compile_random_forest(base_model, x_mean, x_scale, y_mean, y_scale)
+    elif isinstance(base_model, multioutput.MultiOutputRegressor):
+        estimators = base_model.estimators_
+        if all(isinstance(e, _LINEAR_ESTIMATORS) for e in estimators):
+            evaluator = _compile_linear(estimators, x_mean, x_scale, y_mean, y_scale)
+        elif all(isinstance(e, lgb.LGBMRegressor) for e in estimators):
+            evaluator = _compile_lightgbm(estimators, x_mean, x_scale, y_mean, y_scale)
+
+    if evaluator is None:
+        return None
+    return CompiledModel(model._log_transform, log_eps, model._x_transformer, model._y_transformer, evaluator)
+
+
+def _get_scaler_params(model):
+    """Get the (x mean, x scale, y mean, y scale) of the StandardScalers, or identities if not normalized
+    """
+    if not model._normalize:
+        return 0.0, 1.0, 0.0, 1.0
+
+    x_scaler = model._xscaler
+    y_scaler = model._yscaler
+    x_mean = x_scaler.mean_ if x_scaler.with_mean else 0.0
+    x_scale = x_scaler.scale_ if x_scaler.with_std else 1.0
+    y_mean = y_scaler.mean_ if y_scaler.with_mean else 0.0
+    y_scale = y_scaler.scale_ if y_scaler.with_std else 1.0
+    return x_mean, x_scale, y_mean, y_scale
+
+
+def _compile_linear(estimators, x_mean, x_scale, y_mean, y_scale):
+    """Fold the scalers into the weights of the linear estimators (one estimator per output, or a single estimator
+    for all the outputs)
+    """
+    coef = np.vstack([np.atleast_2d(e.coef_) for e in estimators])
+    intercept = np.hstack([np.atleast_1d(e.intercept_) for e in estimators])
+
+    # y = ((z - x_mean) / x_scale) @ coef.T + intercept) * y_scale + y_mean
+    weight = coef / x_scale
+    bias = intercept - weight @ np.broadcast_to(x_mean, (weight.shape[1],))
+    weight = weight * np.reshape(y_scale, (-1, 1))
+    bias = bias * y_scale + y_mean
+    return _LinearEvaluator(np.ascontiguousarray(weight.T), bias)
+
+
+def _compile_random_forest(forest, x_mean, x_scale, y_mean, y_scale):
+    """Flatten the trees of the random forest, folding the averaging and the output scaler into the leaf values
+    """
+    num_trees = len(forest.estimators_)
+    trees = []
+    for estimator in forest.estimators_:
+        tree = estimator.tree_
+        left = tree.children_left.astype(np.int64)
+        right = tree.children_right.astype(np.int64)
+        feature = tree.feature.astype(np.int64)
+        threshold = tree.threshold.astype(np.float64)
+        value = tree.value[:, :, 0].astype(np.float64)
+
+        # The prediction of a tree is the node value of the leaf it ends at
+        is_leaf = left == -1
+        leaf_value = np.where(is_leaf[:, np.newaxis], value, 0.0)
+        trees.append((left, right, feature, threshold, is_leaf, leaf_value))
+
+    leaf_scale = np.asarray(y_scale, dtype=np.float64) / num_trees
+    # sklearn evaluates the trees on float32 inputs
+    return _TreeEvaluator(trees, x_mean, x_scale, leaf_scale, y_mean, np.float32)
+
+
+def _compile_lightgbm(estimators, x_mean, x_scale, y_mean, y_scale):
+    """Flatten the trees of the LightGBM boosters (one booster per output), folding the output scaler into the leaf
+    values
+    """
+    num_outputs = len(estimators)
+    trees = []
+    for output, estimator in enumerate(estimators):
+        for tree_info in estimator.booster_.dump_model()["tree_info"]:
+            flat_tree = _flatten_lightgbm_tree(tree_info["tree_structure"], output, num_outputs)
+            if flat_tree is None:
+                return None
+            trees.append(flat_tree)
+
+    return _TreeEvaluator(trees, x_mean, x_scale, np.asarray(y_scale, dtype=np.float64), y_mean, np.float64)
+
+
+def _flatten_lightgbm_tree(root, output, num_outputs):
+    """Flatten a tree from the LightGBM model dump into node arrays
+
+    :return: (left, right, feature, threshold, is_leaf, leaf_value), or None if the tree has unsupported splits
+    """
+    left, right, feature, threshold, is_leaf, leaf_value = [], [], [], [], [], []
+    stack = [(root, -1, False)]
+    while len(stack) > 0:
+        node, parent, is_left = stack.pop()
+        node_id = len(left)
+        if parent >= 0:
+            if is_left:
+                left[parent] = node_id
+            else:
+                right[parent] = node_id
+
+        value = np.zeros(num_outputs)
+        if "leaf_value" in node:
+            value[output] = node["leaf_value"]
+            left.append(-1)
+            right.append(-1)
+            feature.append(-2)
+            threshold.append(0.0)
+            is_leaf.append(True)
+        else:
+            # Only the numerical splits without missing values (the mini-model features) are supported
+            if node["decision_type"] != "<=" or node["missing_type"] == "Zero":
+                return None
+            left.append(-1)
+            right.append(-1)
+            feature.append(node["split_feature"])
+            threshold.append(node["threshold"])
+            is_leaf.append(False)
+            stack.append((node["right_child"], node_id, False))
+            stack.append((node["left_child"], node_id, True))
+        leaf_value.append(value)
+
+    return (np.array(left, dtype=np.int64), np.array(right, dtype=np.int64), np.array(feature, dtype=np.int64),
+            np.array(threshold, dtype=np.float64), np.array(is_leaf), np.array(leaf_value))
+
+
+class _LinearEvaluator:
+    """
+    y = z @ weight + bias
+    """
+
+    def __init__(self, weight, bias):
+        self._weight = weight
+        self._bias = bias
+        # Any number of rows is cheaper to multiply than to predict natively
+        self.max_rows = None
+
+    def predict(self, z):
+        y = z @ self._weight
+        y += self._bias
+        return y
+
+
+class _TreeEvaluator:
+    """
+    Evaluates an ensemble of flattened trees on all the rows at once: y = sum(leaf values) * leaf_scale + y_mean
+    """
+
+    def __init__(self, trees, x_mean, x_scale, leaf_scale, y_mean, input_dtype):
+        """
+        :param trees: list of (left, right, feature, threshold, is_leaf, leaf_value) node arrays per tree
+        :param x_mean: mean of the input scaler
+        :param x_scale: scale of the input scaler
+        :param leaf_scale: scale to apply to the summed leaf values
+        :param y_mean: mean of the output scaler
+        :param input_dtype: dtype that the trees compare the inputs in
+        """
+        self._x_mean = x_mean
+        self._x_scale = x_scale
+        self._input_dtype = input_dtype
+
+        # Concatenate the node arrays of all the trees, with the child indexes offset to the global node ids.
+        # A leaf points to itself with an always-true split, so that all the rows can take the same number of steps.
+        offsets = np.cumsum([0] + [len(tree[0]) for tree in trees])
+        self._roots = offsets[:-1]
+        left, right, feature, threshold, leaf_value = [], [], [], [], []
+        for offset, (t_left, t_right, t_feature, t_threshold, t_is_leaf, t_leaf_value) in zip(offsets, trees):
+            node_ids = np.arange(len(t_left)) + offset
+            left.append(np.where(t_is_leaf, node_ids, t_left + offset))
+            right.append(np.where(t_is_leaf, node_ids, t_right + offset))
+            feature.append(np.where(t_is_leaf, 0, t_feature))
+            threshold.append(np.where(t_is_leaf, np.inf, t_threshold))
+            leaf_value.append(t_leaf_value)
+        self._left = np.concatenate(left)
+        self._right = np.concatenate(right)
+        self._feature = np.concatenate(feature)
+        self._threshold = np.concatenate(threshold)
+        self._leaf_value = np.concatenate(leaf_value) * leaf_scale
+        self._bias = np.asarray(y_mean, dtype=np.float64)
+        self._max_depth = max(_get_depth(tree[0], tree[1]) for tree in trees)
+        self.max_rows = max(1, _MAX_TREE_ROW_PAIRS // len(trees))
+
+    def predict(self, z):
+        n = z.shape[0]
+        x = ((z - self._x_mean) / self._x_scale).astype(self._input_dtype)
+
+        # Current node of every (tree, row)
+        nodes = np.repeat(self._roots[:, np.newaxis], n, axis=1)
+        rows = np.broadcast_to(np.arange(n), nodes.shape)
+        for _ in range(self._max_depth):
+            go_left = x[rows, self._feature[nodes]] <= self._threshold[nodes]
+            nodes = np.where(go_left, self._left[nodes], self._right[nodes])
+
+        y = self._leaf_value[nodes].sum(axis=0)
+        y += self._bias
+        return y
+
+
+def _get_depth(left, right):
+    """Get the depth of a tree given its children arrays (leaves have -1 children)
+    """
+    depth = np.zeros(len(left), dtype=np.int64)
+    max_depth = 0
+    stack = [0]
+    while len(stack) > 0:
+        node = stack.pop()
+        if left[node] != -1:
+            depth[left[node]] = depth[right[node]] = depth[node] + 1
+            max_depth = max(max_depth, depth[node] + 1)
+            stack.append(left[node])
+            stack.append(right[node])
+    return max_depth
+
+
+class CompiledModel:
+    """
+    The precomputed prediction pipeline of a trained Model
+    """
+
+    def __init__(self, log_transform, log_eps, x_transformer, y_transformer, evaluator):
+        """
+        :param log_transform: whether the model is trained with the log transformation
+        :param log_eps: the epsilon added to the data before the log transformation
+        :param x_transformer: the customized data transformer for input
+        :param y_transformer: the customized data transformer for output
+        :param evaluator: the evaluator of the base model with the scalers folded in
+        """
+        self._log_transform = log_transform
+        self._log_eps = log_eps
+        self._x_transformer = x_transformer
+        self._y_transformer = y_transformer
+        self._evaluator = evaluator
+
+    @property
+    def max_rows(self):
+        """
+        :return: the maximum number of rows that the compiled pipeline should predict at once (None if unbounded),
+                 larger batches are faster with Model.predict
+        """
+        # Models compiled before the limit was introduced do not have the attribute
+        return getattr(self._evaluator, 'max_rows', None)
+
+    def predict(self, x):
+        original_x = x
+
+        if self._x_transformer is not None:
+            x = self._x_transformer(x)
+
+        z = np.asarray(x, dtype=np.float64)
+        if self._log_transform:
+            z = z + self._log_eps
+            np.log(z, out=z)
+
+        y = self._evaluator.predict(z)
+
+        if self._log_transform:
+            np.exp(y, out=y)
+            y -= self._log_eps
+            np.clip(y, 0, None, out=y)
+
+        if self._y_transformer is not None:
+            y = self._y_transformer[1](original_x, y)
+
+        return y
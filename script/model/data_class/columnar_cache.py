@@ -0,0 +1,394 @@
+#!/usr/bin/env python3
+"""Columnar cache for the runner CSV files.
+
+Parsing the runner CSV files (and the ";" separated feature vectors in them) dominates the data loading time, and the
+same files are parsed again on every MiniTrainer/GlobalTrainer run. The first load of a CSV file converts it into
+one .npy file per column in a cache directory next to the file, and later loads memory-map those columns instead.
+
+A column is stored in one of three kinds:
+- scalar: every value is a number (float64 array)
+- vector: some values are ";" separated numbers (float64 values of all the rows plus the row offsets)
+- string: anything else, like the opunit names of the features column (unicode array)
+
+A file is parsed in chunks of rows, so that files larger than the memory can be converted. The parsed chunks of a
+column are written to temporary part files, and then merged into the .npy files of the column.
+
+The cache of a file is keyed by the content hash of the file, so an edited or replaced file is converted again. The
+manifest is written last and atomically replaced, so a concurrent reader always sees a complete version.
+"""
+
+import argparse
+import csv
+import glob
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+from util import logging_util
+
+# Name of the cache directory created next to the CSV files
+CACHE_DIR_NAME = ".columnar_cache"
+
+# Name of the manifest file in the cache directory of a CSV file
+MANIFEST_FILE = "manifest.json"
+
+# Version of the cache layout (caches with other versions are converted again)
+_CACHE_VERSION = 1
+
+# Size of the chunks to read when hashing a file (bytes)
+_HASH_CHUNK_SIZE = 1 << 20
+
+# Number of rows to parse at a time when converting a file
+_CONVERT_CHUNK_ROWS = 100000
+
+
+def _get_cache_dir(filename):
+    return os.path.join(os.path.dirname(os.path.abspath(filename)), CACHE_DIR_NAME, os.path.basename(filename))
+
+
+def _hash_file(filename):
+    sha = hashlib.sha1()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(_HASH_CHUNK_SIZE), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _parse_column(values):
+    """Parse the raw string values of a column (same conversion as data_util.convert_string_to_numeric)
+
+    :param values: numpy array of strings
+    :return: (kind, dict from the array name to the array)
+    """
+    try:
+        return "scalar", {"values": values.astype(np.float64)}
+    except ValueError:
+        pass
+
+    parts = np.char.split(values, ";")
+    lengths = np.fromiter((len(p) for p in parts), dtype=np.int64, count=len(parts))
+    try:
+        flat = np.array([v for p in parts for v in p]).astype(np.float64)
+    except ValueError:
+        return "string", {"values": values.astype(np.str_)}
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return "vector", {"values": flat, "offsets": offsets}
+
+
+def _read_header(filename):
+    with open(filename, "r") as f:
+        return next(csv.reader(f, delimiter=",", skipinitialspace=True))
+
+
+def _read_chunks(filename, usecols=None):
+    return pd.read_csv(filename, dtype=str, skipinitialspace=True, keep_default_na=False, usecols=usecols,
+                       chunksize=_CONVERT_CHUNK_ROWS)
+
+
+def _parse_chunks(filename, num_columns, store_part):
+    """Parse the columns of the CSV file in chunks of rows
+
+    The kind of a column is decided per chunk (see _parse_column). A column with a string chunk is a string column as a
+    whole, so its chunks are parsed again as strings if any was parsed as numbers.
+
+    :param filename: the CSV file
+    :param num_columns: number of columns in the file
+    :param store_part: function called with (chunk index, column index, arrays) of every parsed chunk of a column,
+           which returns the arrays to keep for the chunk
+    :return: (number of rows, list of the (kind, arrays) of the chunks of each column)
+    """
+    num_rows = 0
+    parts = [[] for _ in range(num_columns)]
+    for chunk_index, df in enumerate(_read_chunks(filename)):
+        for i in range(num_columns):
+            kind, arrays = _parse_column(df.iloc[:, i].to_numpy(dtype=np.str_))
+            parts[i].append((kind, store_part(chunk_index, i, arrays)))
+        num_rows += df.shape[0]
+
+    mixed_columns = [i for i in range(num_columns)
+                     if any(kind == "string" for kind, _ in parts[i]) and any(kind != "string" for kind, _ in parts[i])]
+    if len(mixed_columns) > 0:
+        for chunk_index, df in enumerate(_read_chunks(filename, mixed_columns)):
+            for j, i in enumerate(mixed_columns):
+                arrays = {"values": df.iloc[:, j].to_numpy(dtype=np.str_)}
+                parts[i][chunk_index] = ("string", store_part(chunk_index, i, arrays))
+
+    return num_rows, parts
+
+
+def _merge_parts(parts, num_rows, allocate):
+    """Merge the parsed chunks of a column into the arrays of the whole column
+
+    A column is a string column if any chunk is, else a vector column if any chunk is (the scalar chunks are vectors of
+    single values), and else a scalar column.
+
+    :param parts: list of the (kind, arrays) of the chunks of the column
+    :param num_rows: number of rows in the column
+    :param allocate: function called with (array name, dtype, shape), which returns the array to fill in
+    :return: (kind, dict from the array name to the array)
+    """
+    kinds = {kind for kind, _ in parts}
+    if "string" in kinds:
+        width = max([arrays["values"].dtype.itemsize // np.dtype("<U1").itemsize for _, arrays in parts] + [1])
+        values = allocate("values", "<U{}".format(width), (num_rows,))
+        start = 0
+        for _, arrays in parts:
+            values[start:start + len(arrays["values"])] = arrays["values"]
+            start += len(arrays["values"])
+        return "string", {"values": values}
+
+    if "vector" in kinds:
+        num_values = sum(len(arrays["values"]) for _, arrays in parts)
+        values = allocate("values", np.float64, (num_values,))
+        offsets = allocate("offsets", np.int64, (num_rows + 1,))
+        offsets[0] = 0
+        row_start = value_start = 0
+        for kind, arrays in parts:
+            part_values = arrays["values"]
+            part_offsets = arrays["offsets"] if kind == "vector" else np.arange(len(part_values) + 1)
+            num_part_rows = len(part_offsets) - 1
+            values[value_start:value_start + len(part_values)] = part_values
+            offsets[row_start + 1:row_start + num_part_rows + 1] = part_offsets[1:] + value_start
+            row_start += num_part_rows
+            value_start += len(part_values)
+        return "vector", {"values": values, "offsets": offsets}
+
+    values = allocate("values", np.float64, (num_rows,))
+    start = 0
+    for _, arrays in parts:
+        values[start:start + len(arrays["values"])] = arrays["values"]
+        start += len(arrays["values"])
+    return "scalar", {"values": values}
+
+
+def _convert(filename, cache_dir, content_hash, stat):
+    """Convert the CSV file into the columnar cache
+
+    :return: the manifest of the cache
+    """
+    header = _read_header(filename)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    part_files = []
+
+    def store_part(chunk_index, column_index, arrays):
+        # The parsed chunks are kept on disk until merged, so that only a chunk is in the memory at a time
+        part_arrays = {}
+        for name, array in arrays.items():
+            part_file = os.path.join(cache_dir, "{}.{}.{}.{}.{}.part.tmp".format(content_hash, os.getpid(),
+                                                                                 chunk_index, column_index, name))
+            with open(part_file, "wb") as f:
+                np.save(f, array)
+            part_files.append(part_file)
+            part_arrays[name] = np.load(part_file, mmap_mode="r")
+        return part_arrays
+
+    columns = []
+    current_files = {MANIFEST_FILE}
+    try:
+        num_rows, parts = _parse_chunks(filename, len(header), store_part)
+        for i in range(len(header)):
+            files = {}
+
+            def allocate(name, dtype, shape):
+                files[name] = "{}.{}.{}.npy".format(content_hash, i, name)
+                path = os.path.join(cache_dir, files[name])
+                if np.prod(shape) == 0:
+                    # An empty array cannot be memory-mapped
+                    np.save(path, np.empty(shape, dtype=dtype))
+                    return np.empty(shape, dtype=dtype)
+                return np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=shape)
+
+            kind, arrays = _merge_parts(parts[i], num_rows, allocate)
+            for array in arrays.values():
+                if isinstance(array, np.memmap):
+                    array.flush()
+            current_files.update(files.values())
+            columns.append({"kind": kind, "files": files})
+    finally:
+        for part_file in part_files:
+            if os.path.exists(part_file):
+                os.remove(part_file)
+
+    manifest = {"version": _CACHE_VERSION, "hash": content_hash, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns,
+                "num_rows": num_rows, "header": header, "columns": columns}
+    tmp_manifest = os.path.join(cache_dir, "{}.{}.tmp".format(MANIFEST_FILE, os.getpid()))
+    with open(tmp_manifest, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_manifest, os.path.join(cache_dir, MANIFEST_FILE))
+
+    # Remove the files of the previous versions
+    for file in os.listdir(cache_dir):
+        if file not in current_files and not file.endswith(".tmp"):
+            os.remove(os.path.join(cache_dir, file))
+
+    return manifest
+
+
+def _read_manifest(cache_dir):
+    try:
+        with open(os.path.join(cache_dir, MANIFEST_FILE), "r") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return manifest if manifest.get("version") == _CACHE_VERSION else None
+
+
+def get_content_hash(filename):
+    """Get the content hash of a CSV file, reusing the hash in its cache manifest if the file has not changed
+
+    :param filename: the CSV file
+    :return: the hex digest of the file content
+    """
+    stat = os.stat(filename)
+    manifest = _read_manifest(_get_cache_dir(filename))
+    if manifest is not None and manifest["size"] == stat.st_size and manifest["mtime_ns"] == stat.st_mtime_ns:
+        return manifest["hash"]
+    return _hash_file(filename)
+
+
+def convert_csv(filename):
+    """Convert a CSV file into the columnar cache if it is not cached or has changed
+
+    Converting the files ahead in worker processes makes the later load_csv calls only memory-map the columns. The
+    same file should not be converted by two processes at once.
+
+    :param filename: the CSV file
+    :return: the manifest of the cache, or None if the file cannot be cached
+    """
+    cache_dir = _get_cache_dir(filename)
+    stat = os.stat(filename)
+    manifest = _read_manifest(cache_dir)
+
+    # Only hash the file if its size or mtime has changed since it was cached
+    if manifest is None or manifest["size"] != stat.st_size or manifest["mtime_ns"] != stat.st_mtime_ns:
+        content_hash = _hash_file(filename)
+        if manifest is None or manifest["hash"] != content_hash:
+            logging.info("Converting {} into the columnar cache".format(filename))
+            try:
+                manifest = _convert(filename, cache_dir, content_hash, stat)
+            except OSError as e:
+                # E.g., the input directory is read-only
+                logging.warning("Failed to cache {}: {}".format(filename, e))
+                return None
+
+    return manifest
+
+
+def load_csv(filename):
+    """Load a CSV file through the columnar cache, converting it first if it is not cached or has changed
+
+    :param filename: the CSV file
+    :return: the ColumnarTable of the file
+    """
+    manifest = convert_csv(filename)
+    if manifest is None:
+        return ColumnarTable.from_csv(filename)
+    return ColumnarTable(_get_cache_dir(filename), manifest)
+
+
+class ColumnarTable:
+    """
+    The columns of a CSV file, loaded from the columnar cache
+    """
+
+    def __init__(self, cache_dir, manifest):
+        """
+
+        :param cache_dir: the cache directory of the file (None if the columns are not cached)
+        :param manifest: the manifest of the cache (see _convert), with the arrays of the columns if not cached
+        """
+        self.header = manifest["header"]
+        self.num_rows = manifest["num_rows"]
+        self._columns = []
+        for column in manifest["columns"]:
+            if cache_dir is None:
+                arrays = column["arrays"]
+            else:
+                arrays = {name: np.load(os.path.join(cache_dir, file), mmap_mode="r")
+                          for name, file in column["files"].items()}
+            self._columns.append((column["kind"], arrays))
+
+    @staticmethod
+    def from_csv(filename):
+        """Parse the CSV file without the cache
+
+        :param filename: the CSV file
+        :return: the ColumnarTable of the file
+        """
+        header = _read_header(filename)
+        num_rows, parts = _parse_chunks(filename, len(header), lambda chunk_index, column_index, arrays: arrays)
+        columns = []
+        for i in range(len(header)):
+            kind, arrays = _merge_parts(parts[i], num_rows, lambda name, dtype, shape: np.empty(shape, dtype=dtype))
+            # The chunks of the column are no longer needed once merged
+            parts[i] = None
+            columns.append({"kind": kind, "arrays": arrays})
+        return ColumnarTable(None, {"header": header, "num_rows": num_rows, "columns": columns})
+
+    def column(self, index):
+        """Get a scalar or string column
+
+        :param index: the column index
+        :return: the numpy array of the column
+        """
+        kind, arrays = self._columns[index]
+        if kind == "vector":
+            raise ValueError("Column {} has vector values".format(self.header[index]))
+        return arrays["values"]
+
+    def column_values(self, index, start_row=0, end_row=None):
+        """Get the values of a column as python objects, with the same conversion as
+        data_util.convert_string_to_numeric (a float, or a list of floats for the ";" separated values)
+
+        :param index: the column index
+        :param start_row: the first row to include
+        :param end_row: the row to stop at (None for all the rows)
+        :return: the list of values in the column
+        """
+        end_row = self.num_rows if end_row is None else min(end_row, self.num_rows)
+        kind, arrays = self._columns[index]
+        if kind != "vector":
+            return arrays["values"][start_row:end_row].tolist()
+
+        offsets = arrays["offsets"][start_row:end_row + 1]
+        lengths = np.diff(offsets)
+        values = np.split(np.asarray(arrays["values"][offsets[0]:offsets[-1]]), offsets[1:-1] - offsets[0])
+        return [v[0].item() if n == 1 else v.tolist() for v, n in zip(values, lengths)]
+
+    def rows(self, start_index=0, start_row=0, end_row=None):
+        """Get the converted values of the rows (see column_values)
+
+        :param start_index: the first column to include
+        :param start_row: the first row to include
+        :param end_row: the row to stop at (None for all the rows)
+        :return: the list of the rows, each a tuple of the values from start_index
+        """
+        return list(zip(*[self.column_values(i, start_row, end_row) for i in range(start_index, len(self.header))]))
+
+    def to_dataframe(self):
+        """
+        :return: the pandas DataFrame of the scalar and string columns (the numbers are all float64)
+        """
+        df = pd.DataFrame({i: np.asarray(self.column(i)) for i in range(len(self.header))})
+        df.columns = self.header
+        return df
+
+
+# ==============================================
+# main
+# ==============================================
+if __name__ == '__main__':
+    aparser = argparse.ArgumentParser(description='Convert the runner CSV files into the columnar cache')
+    aparser.add_argument('input_path', help='Directory of the CSV files')
+    aparser.add_argument('--log', default='info', help='The logging level')
+    args = aparser.parse_args()
+
+    logging_util.init_logging(args.log)
+    for csv_file in sorted(glob.glob(os.path.join(args.input_path, '*.csv'))):
+        convert_csv(csv_file)
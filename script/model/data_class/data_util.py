@@ -1,5 +1,7 @@
 import math
 
+import numpy as np
+
 
 def convert_string_to_numeric(value):
     """Break up a string that contains ";" to a list of values
@@ -25,3 +27,54 @@ def round_to_interval(time, interval):
     """
     return time - time % interval
 
+
+def group_by_interval(times, interval):
+    """Group rows by the interval that their timestamps round to (see round_to_interval)
+
+    The groups are numbered in the order of their first rows, and the rows of a group keep their original order.
+
+    :param times: array of the timestamps of the rows in us
+    :param interval: in us
+    :return: (group id of each row, rounded time of each group, the row indexes sorted by group, the start offset of
+             each group in the sorted row indexes, the number of rows in each group)
+    """
+    rounded_times = round_to_interval(np.asarray(times), interval)
+    unique_times, first_rows, inverse = np.unique(rounded_times, return_index=True, return_inverse=True)
+
+    # Renumber the groups from the sorted time order to the order of their first rows
+    group_order = np.argsort(first_rows, kind="stable")
+    group_rank = np.empty_like(group_order)
+    group_rank[group_order] = np.arange(len(group_order))
+    group_ids = group_rank[inverse.reshape(-1)]
+
+    sorted_rows = np.argsort(group_ids, kind="stable")
+    counts = np.bincount(group_ids, minlength=len(group_order))
+    offsets = np.zeros(len(counts), dtype=np.int64)
+    np.cumsum(counts[:-1], out=offsets[1:])
+    return group_ids, unique_times[group_order], sorted_rows, offsets, counts
+
+
+def sum_by_group(values, sorted_rows, offsets):
+    """Sum the rows of each group
+
+    :param values: 2D array of the rows
+    :param sorted_rows: the row indexes sorted by group (see group_by_interval)
+    :param offsets: the start offset of each group in the sorted row indexes
+    :return: 2D array of the sums of each group
+    """
+    if len(offsets) == 0:
+        return np.zeros((0,) + values.shape[1:])
+    return np.add.reduceat(values[sorted_rows], offsets, axis=0)
+
+
+def count_distinct_by_group(group_ids, values, num_groups):
+    """Count the distinct values in each group
+
+    :param group_ids: the group id of each row
+    :param values: the value of each row
+    :param num_groups: the number of groups
+    :return: array of the number of distinct values in each group
+    """
+    pairs = np.unique(np.stack((group_ids, np.asarray(values, dtype=np.float64)), axis=1), axis=0)
+    return np.bincount(pairs[:, 0].astype(np.int64), minlength=num_groups)
+
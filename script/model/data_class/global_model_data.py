@@ -1,34 +1,141 @@
 import numpy as np
+from collections.abc import Sequence
 
-from info import hardware_info
+import global_model_config
+from info import data_info, hardware_info
+from type import Target
 
 
-class GlobalImpactData:
+class GlobalImpactDataStore(Sequence):
     """
-    The class used to store the information for the global impact model training and prediction
+    Stores the GlobalImpactData of all the GroupedOpUnitData. The GlobalResourceData intervals of the targets are in a
+    ragged (CSR) layout, so the features averaged over the intervals are derived for all the targets with array
+    operations. Indexing the store returns lightweight GlobalImpactData views.
     """
 
-    def __init__(self, data, resource_data_list):
+    def __init__(self, data_list, resource_data_list, interval_offsets, interval_indexes):
         """
-        :param data: The target GroupedOpUnitData to measure and predict
-        :param resource_data_list: The GlobalResourceData list in the interval that the target GroupedOpUnitData
-                overlap with
+        :param data_list: The GroupedOpUnitDataStore of the targets to measure and predict
+        :param resource_data_list: The GlobalResourceData list
+        :param interval_offsets: the intervals of target i are
+               interval_indexes[interval_offsets[i]:interval_offsets[i + 1]]
+        :param interval_indexes: the indexes in resource_data_list of the intervals that the targets overlap with
         """
-        self.target_grouped_op_unit_data = data
+        self.data_list = data_list
         self.resource_data_list = resource_data_list
+        self.interval_offsets = np.asarray(interval_offsets, dtype=np.int64)
+        self.interval_indexes = np.asarray(interval_indexes, dtype=np.int64)
+        self.interval_nums = np.diff(self.interval_offsets)
+        # The target of each (target, interval) pair
+        self._pair_target_indexes = np.repeat(np.arange(len(self.interval_nums)), self.interval_nums)
 
         # Derive the same_core_x feature
-        cpu_id = data.cpu_id
         physical_core_num = hardware_info.PHYSICAL_CORE_NUM
-        same_core_x_list = [d.x_list[cpu_id - physical_core_num if cpu_id > physical_core_num else cpu_id] for d
-                            in resource_data_list]
-        same_core_x = np.average(same_core_x_list, axis=0)
-        self.resource_util_same_core_x = same_core_x
+        cpu_ids = data_list.cpu_id
+        core_ids = np.where(cpu_ids > physical_core_num, cpu_ids - physical_core_num, cpu_ids)
+        x_lists = np.array([d.x_list for d in resource_data_list])
+        self.resource_util_same_core_x = self._average(x_lists[self.interval_indexes,
+                                                               core_ids[self._pair_target_indexes]])
 
         # Derive the x feature
-        x_list = [d.x for d in resource_data_list]
-        x = np.average(x_list, axis=0)
-        self.x = x
+        self.x = self._average(np.array([d.x for d in resource_data_list])[self.interval_indexes])
+
+    def _average(self, values):
+        """Average the values of the (target, interval) pairs per target
+
+        :param values: one row per (target, interval) pair
+        :return: one row per target (NaN for the targets without intervals)
+        """
+        sums = np.empty((len(self.interval_nums), values.shape[1]))
+        # bincount adds the pairs in the interval order
+        for i in range(values.shape[1]):
+            sums[:, i] = np.bincount(self._pair_target_indexes, weights=values[:, i], minlength=len(sums))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return sums / self.interval_nums[:, np.newaxis]
+
+    def get_y_preds(self):
+        """
+        :return: the predicted global resource util of the targets (averaged over the GlobalResourceData y_pred of
+                 their intervals)
+        """
+        return self._average(np.array([d.y_pred for d in self.resource_data_list])[self.interval_indexes])
+
+    def get_derived_x(self, predicted_resource_util, indexes):
+        """Construct the input features of the global impact (or direct) model
+
+        The input feature is (normalized mini model prediction, predicted global resource util, the predicted
+        resource util on the same core that the opunit group runs), where the resource util of the OU group itself is
+        removed from the global resource util.
+
+        :param predicted_resource_util: the predicted (impact model) or estimated (direct model) global resource util
+               of all the targets
+        :param indexes: the index array of the targets to construct the features for
+        :return: the input features (one row per target)
+        """
+        mini_model_y_pred = self.data_list.y_pred[indexes]
+        predicted_elapsed_us = mini_model_y_pred[:, data_info.instance.target_csv_index[Target.ELAPSED_US]]
+        concurrencies = np.maximum(1, self.data_list.concurrency[indexes])
+
+        # Remove the OU group itself from the total resource data
+        self_resource = (mini_model_y_pred * concurrencies[:, np.newaxis] /
+                         self.interval_nums[indexes][:, np.newaxis] / global_model_config.INTERVAL_SIZE)
+        predicted_resource_util = predicted_resource_util[indexes]
+        predicted_resource_util[:, :mini_model_y_pred.shape[1]] -= self_resource
+        predicted_resource_util[predicted_resource_util < 0] = 0
+
+        return np.concatenate((mini_model_y_pred / predicted_elapsed_us[:, np.newaxis], predicted_resource_util,
+                               self.resource_util_same_core_x[indexes]), axis=1)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [GlobalImpactData(self, i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return GlobalImpactData(self, index)
+
+    def __iter__(self):
+        return (GlobalImpactData(self, i) for i in range(len(self)))
+
+    def __len__(self):
+        return len(self.interval_nums)
+
+
+class GlobalImpactData:
+    """
+    The class used to store the information for the global impact model training and prediction (a view of a target
+    in a GlobalImpactDataStore)
+    """
+    __slots__ = ("_store", "_index")
+
+    def __init__(self, store, index):
+        """
+        :param store: the GlobalImpactDataStore of the target
+        :param index: the index of the target in the store
+        """
+        self._store = store
+        self._index = index
+
+    @property
+    def target_grouped_op_unit_data(self):
+        """The target GroupedOpUnitData to measure and predict"""
+        return self._store.data_list[self._index]
+
+    @property
+    def resource_data_list(self):
+        """The GlobalResourceData list in the interval that the target GroupedOpUnitData overlap with"""
+        store = self._store
+        indexes = store.interval_indexes[store.interval_offsets[self._index]:store.interval_offsets[self._index + 1]]
+        return [store.resource_data_list[i] for i in indexes]
+
+    @property
+    def resource_util_same_core_x(self):
+        return self._store.resource_util_same_core_x[self._index]
+
+    @property
+    def x(self):
+        return self._store.x[self._index]
 
     def get_y_pred(self):
         y_pred_list = [d.y_pred for d in self.resource_data_list]
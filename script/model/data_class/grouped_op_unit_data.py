@@ -1,17 +1,19 @@
-import csv
 import numpy as np
 import copy
-import tqdm
 import pandas as pd
 import os
 import logging
+from collections.abc import Sequence
 
-from data_class import data_util
+from data_class import columnar_cache, data_util
 from info import data_info
 import global_model_config
 
 from type import ConcurrentCountingMode, OpUnit, Target, ExecutionFeature
 
+# Number of the pipeline CSV rows to convert at a time
+PIPELINE_CHUNK_ROWS = 1 << 16
+
 
 def get_grouped_op_unit_data(filename, warmup_period, ee_sample_interval, txn_sample_interval,
                              network_sample_interval):
@@ -22,45 +24,58 @@ def get_grouped_op_unit_data(filename, warmup_period, ee_sample_interval, txn_sa
     :param ee_sample_interval: sampling interval for the EE OUs
     :param txn_sample_interval: sampling interval for the transaction OUs
     :param network_sample_interval: sampling interval for the network OUs
-    :return: the list of global model data
+    :return: the GroupedOpUnitDataStore of the global model data
+    """
+    return GroupedOpUnitDataStore.concatenate(list(iter_grouped_op_unit_data(filename, warmup_period,
+                                                                             ee_sample_interval, txn_sample_interval,
+                                                                             network_sample_interval)))
+
+
+def iter_grouped_op_unit_data(filename, warmup_period, ee_sample_interval, txn_sample_interval,
+                              network_sample_interval):
+    """Get the training data from the global model in chunks, so that a large pipeline file is converted with bounded
+    memory
+
+    :param filename: the input data file
+    :param warmup_period: warmup period for pipeline data
+    :param ee_sample_interval: sampling interval for the EE OUs
+    :param txn_sample_interval: sampling interval for the transaction OUs
+    :param network_sample_interval: sampling interval for the network OUs
+    :return: the generator of the GroupedOpUnitDataStore chunks of the global model data
     """
 
     if "txn" in filename:
         # Cannot handle the transaction manager data yet
-        return _txn_get_mini_runner_data(filename, txn_sample_interval)
-    if "pipeline" in filename:
+        yield _txn_get_mini_runner_data(filename, txn_sample_interval)
+    elif "pipeline" in filename:
         # Special handle of the pipeline execution data
-        return _pipeline_get_grouped_op_unit_data(filename, warmup_period, ee_sample_interval)
-    if "gc" in filename or "log" in filename:
+        yield from _pipeline_iter_grouped_op_unit_data(filename, warmup_period, ee_sample_interval)
+    elif "gc" in filename or "log" in filename:
         # Handle of the gc or log data with interval-based conversion
-        return _interval_get_grouped_op_unit_data(filename)
-    if "command" in filename:
+        yield _interval_get_grouped_op_unit_data(filename)
+    elif "command" in filename:
         # Handle networking OUs
-        return _default_get_global_data(filename, network_sample_interval)
-
-    return _default_get_global_data(filename)
+        yield _default_get_global_data(filename, network_sample_interval)
+    else:
+        yield _default_get_global_data(filename)
 
 
 def _default_get_global_data(filename, sample_interval=0):
     # In the default case, the data does not need any pre-processing and the file name indicates the opunit
-    df = pd.read_csv(filename)
+    df = columnar_cache.load_csv(filename).to_dataframe()
     file_name = os.path.splitext(os.path.basename(filename))[0]
 
     x = df.iloc[:, :-data_info.instance.METRICS_OUTPUT_NUM].values
-    y = df.iloc[:, -data_info.instance.MINI_MODEL_TARGET_NUM:].values
+    metrics = df.iloc[:, -data_info.instance.METRICS_OUTPUT_NUM:].values
 
     # Construct the new data
     opunit = OpUnit[file_name.upper()]
-    data_list = []
-
-    for i in range(x.shape[0]):
-        data_list.append(GroupedOpUnitData("{}".format(file_name), [(opunit, x[i])], y[i], sample_interval))
-    return data_list
+    return GroupedOpUnitDataStore.from_single_opunit("{}".format(file_name), opunit, x, metrics, sample_interval)
 
 
 def _txn_get_mini_runner_data(filename, txn_sample_interval):
     # In the default case, the data does not need any pre-processing and the file name indicates the opunit
-    df = pd.read_csv(filename)
+    df = columnar_cache.load_csv(filename).to_dataframe()
     file_name = os.path.splitext(os.path.basename(filename))[0]
 
     # prepending a column of ones as the base transaction data feature
@@ -68,86 +83,69 @@ def _txn_get_mini_runner_data(filename, txn_sample_interval):
     df = pd.concat([base_x, df], axis=1)
     x = df.iloc[:, :-data_info.instance.METRICS_OUTPUT_NUM].values
     y = df.iloc[:, -data_info.instance.MINI_MODEL_TARGET_NUM:].values
-    start_times = df.iloc[:, data_info.instance.target_csv_index[data_info.instance.Target.START_TIME]].values
-    cpu_ids = df.iloc[:, data_info.instance.target_csv_index[data_info.instance.Target.CPU_ID]].values
+    start_times = df.iloc[:, data_info.instance.target_csv_index[Target.START_TIME]].values
+    cpu_ids = df.iloc[:, data_info.instance.target_csv_index[Target.CPU_ID]].values
 
     logging.info("Loaded file: {}".format(OpUnit[file_name.upper()]))
 
     interval = data_info.instance.CONTENDING_OPUNIT_INTERVAL
 
-    # Map from interval start time to the data in this interval
-    interval_x_map = {}
-    interval_y_map = {}
-    interval_cpu_id_map = {}
-    interval_start_time_map = {}
-    n = x.shape[0]
-    for i in tqdm.tqdm(list(range(n)), desc="Group data by interval"):
-        rounded_time = data_util.round_to_interval(start_times[i], interval)
-        if rounded_time not in interval_x_map:
-            interval_x_map[rounded_time] = []
-            interval_y_map[rounded_time] = []
-            interval_cpu_id_map[rounded_time] = []
-            interval_start_time_map[rounded_time] = []
-        interval_x_map[rounded_time].append(x[i])
-        interval_y_map[rounded_time].append(y[i])
-        interval_cpu_id_map[rounded_time].append(cpu_ids[i])
-        interval_start_time_map[rounded_time].append(start_times[i])
+    # Group the data by interval start time
+    group_ids, _, sorted_rows, offsets, counts = data_util.group_by_interval(start_times, interval)
 
     # Construct the new data
+    # Sum the features
+    x_new = data_util.sum_by_group(x, sorted_rows, offsets)
+    # Concatenate the number of different threads
+    num_threads = data_util.count_distinct_by_group(group_ids, cpu_ids, len(counts))
+    x_new = np.concatenate((x_new, num_threads[:, np.newaxis]), axis=1)
+    x_new *= txn_sample_interval + 1
+    # The prediction is the average behavior
+    y_new = data_util.sum_by_group(y, sorted_rows, offsets) / counts[:, np.newaxis]
+
+    # Change all the opunits in the group for this interval to be the new feature
     opunit = OpUnit[file_name.upper()]
-    data_list = []
-    for rounded_time in interval_x_map:
-        # Sum the features
-        x_new = np.sum(interval_x_map[rounded_time], axis=0)
-        # Concatenate the number of different threads
-        x_new = np.concatenate((x_new, [len(set(interval_cpu_id_map[rounded_time]))]))
-        x_new *= txn_sample_interval + 1
-        # Change all the opunits in the group for this interval to be the new feature
-        opunits = [(opunit, x_new)]
-        # The prediction is the average behavior
-        y_new = np.average(interval_y_map[rounded_time], axis=0)
-        n = len(interval_x_map[rounded_time])
-        for i in range(n):
-            metrics = np.concatenate(([interval_start_time_map[rounded_time][i]],
-                                      [interval_cpu_id_map[rounded_time][i]],
-                                      y_new))
-            data_list.append(GroupedOpUnitData("{}".format(file_name), opunits, metrics, txn_sample_interval))
-
-    return data_list
-
-
-def _pipeline_get_grouped_op_unit_data(filename, warmup_period, ee_sample_interval):
-    # Get the global running data for the execution engine
-    start_time = None
+    sorted_group_ids = group_ids[sorted_rows]
+    metrics = np.concatenate((start_times[sorted_rows, np.newaxis], cpu_ids[sorted_rows, np.newaxis],
+                              y_new[sorted_group_ids]), axis=1)
+    return GroupedOpUnitDataStore.from_single_opunit("{}".format(file_name), opunit, x_new[sorted_group_ids],
+                                                     metrics, txn_sample_interval)
+
 
-    data_list = []
-    with open(filename, "r") as f:
-        reader = csv.reader(f, delimiter=",", skipinitialspace=True)
-        next(reader)
-        features_vector_index = data_info.instance.raw_features_csv_index[ExecutionFeature.FEATURES]
-        input_output_boundary = data_info.instance.raw_features_csv_index[data_info.instance.INPUT_OUTPUT_BOUNDARY]
-        input_end_boundary = len(data_info.instance.input_csv_index)
+def _pipeline_iter_grouped_op_unit_data(filename, warmup_period, ee_sample_interval):
+    # Get the global running data for the execution engine, converting PIPELINE_CHUNK_ROWS rows at a time
+    start_time = None
 
-        for line in reader:
+    table = columnar_cache.load_csv(filename)
+    features_vector_index = data_info.instance.raw_features_csv_index[ExecutionFeature.FEATURES]
+    input_output_boundary = data_info.instance.raw_features_csv_index[data_info.instance.INPUT_OUTPUT_BOUNDARY]
+    input_end_boundary = len(data_info.instance.input_csv_index)
+    query_ids = table.column(0)
+    pipeline_ids = table.column(1)
+    start_times = table.column(data_info.instance.raw_target_csv_index[Target.START_TIME])
+    features_vectors = table.column(features_vector_index)
+
+    for chunk_start in range(0, table.num_rows, PIPELINE_CHUNK_ROWS):
+        builder = GroupedOpUnitDataBuilder()
+        # drop query_id, pipeline_id, num_features, features_vector
+        rows = table.rows(input_output_boundary, chunk_start, chunk_start + PIPELINE_CHUNK_ROWS)
+        for i, data in enumerate(rows, chunk_start):
             # extract the time
-            cpu_time = line[data_info.instance.raw_target_csv_index[Target.START_TIME]]
+            cpu_time = int(start_times[i])
             if start_time is None:
                 start_time = cpu_time
 
-            if int(cpu_time) - int(start_time) < warmup_period * 1000000:
+            if cpu_time - start_time < warmup_period * 1000000:
                 continue
 
             sample_interval = ee_sample_interval
 
-            # drop query_id, pipeline_id, num_features, features_vector
-            record = [d for i,d in enumerate(line) if i >= input_output_boundary]
-            data = list(map(data_util.convert_string_to_numeric, record))
             x_multiple = data[:input_end_boundary]
             metrics = np.array(data[-data_info.instance.METRICS_OUTPUT_NUM:])
 
             # Get the opunits located within
             opunits = []
-            features = line[features_vector_index].split(';')
+            features = features_vectors[i].split(';')
             concurrency = 0
             for idx, feature in enumerate(features):
                 opunit = OpUnit[feature]
@@ -173,18 +171,21 @@ def _pipeline_get_grouped_op_unit_data(filename, warmup_period, ee_sample_interv
 
             # TODO(lin): Again, we won't do sampling for TPCH queries (with the assumption that the query id < 10).
             #  Should encapsulate this wit the metrics
-            if int(line[0]) < 10:
+            query_id = int(query_ids[i])
+            if query_id < 10:
                 sample_interval = 0
 
-            data_list.append(GroupedOpUnitData("q{} p{}".format(line[0], line[1]), opunits, np.array(metrics),
-                                               sample_interval, concurrency))
+            builder.append("q{} p{}".format(query_id, int(pipeline_ids[i])), opunits, metrics, sample_interval,
+                           concurrency)
 
-    return data_list
+        store = builder.build()
+        if len(store) > 0:
+            yield store
 
 
 def _interval_get_grouped_op_unit_data(filename):
     # In the default case, the data does not need any pre-processing and the file name indicates the opunit
-    df = pd.read_csv(filename, skipinitialspace=True)
+    df = columnar_cache.load_csv(filename).to_dataframe()
     file_name = os.path.splitext(os.path.basename(filename))[0]
 
     x = df.iloc[:, :-data_info.instance.METRICS_OUTPUT_NUM].values
@@ -193,63 +194,307 @@ def _interval_get_grouped_op_unit_data(filename):
     cpu_ids = df.iloc[:, data_info.instance.target_csv_index[Target.CPU_ID]].values
     interval = data_info.instance.PERIODIC_OPUNIT_INTERVAL
 
-    # Map from interval start time to the data in this interval
-    interval_x_map = {}
-    interval_y_map = {}
-    interval_cpu_map = {}
-    n = x.shape[0]
-    for i in tqdm.tqdm(list(range(n)), desc="Group data by interval"):
-        rounded_time = data_util.round_to_interval(start_times[i], interval)
-        if rounded_time not in interval_x_map:
-            interval_x_map[rounded_time] = []
-            interval_y_map[rounded_time] = []
-        interval_x_map[rounded_time].append(x[i])
-        interval_y_map[rounded_time].append(y[i])
-        interval_cpu_map[rounded_time] = cpu_ids[i]
+    # Group the data by interval start time
+    group_ids, rounded_times, sorted_rows, offsets, counts = data_util.group_by_interval(start_times, interval)
 
     # Construct the new data
+    # Sum the features
+    x_new = data_util.sum_by_group(x, sorted_rows, offsets)
+    # Keep the interval parameter the same
+    # TODO: currently the interval parameter is always the last. Change the hard-coding later
+    x_new[:, -1] /= counts
+    # The prediction is the average behavior
+    y_new = data_util.sum_by_group(y, sorted_rows, offsets) / counts[:, np.newaxis]
+    # The cpu of an interval is the one of its last data
+    group_cpu_ids = cpu_ids[sorted_rows[offsets + counts - 1]]
+
+    # Change all the opunits in the group for this interval to be the new feature
     opunit = OpUnit[file_name.upper()]
-    data_list = []
-    for rounded_time in interval_x_map:
-        # Sum the features
-        x_new = np.sum(interval_x_map[rounded_time], axis=0)
-        # Keep the interval parameter the same
-        # TODO: currently the interval parameter is always the last. Change the hard-coding later
-        x_new[-1] /= len(interval_x_map[rounded_time])
-        # Change all the opunits in the group for this interval to be the new feature
-        opunits = [(opunit, x_new)]
-        # The prediction is the average behavior
-        y_new = np.average(interval_y_map[rounded_time], axis=0)
-        n = len(interval_x_map[rounded_time])
-        for i in range(n):
-            metrics = np.concatenate(([rounded_time + i * interval // n], [interval_cpu_map[rounded_time]], y_new))
-            data_list.append(GroupedOpUnitData("{}".format(file_name), opunits, metrics))
-
-    return data_list
+    # Spread the data of an interval evenly across the interval
+    sorted_group_ids = group_ids[sorted_rows]
+    index_in_group = np.arange(len(sorted_rows)) - offsets[sorted_group_ids]
+    row_times = rounded_times[sorted_group_ids] + index_in_group * interval // counts[sorted_group_ids]
+    metrics = np.concatenate((row_times[:, np.newaxis], group_cpu_ids[sorted_group_ids, np.newaxis],
+                              y_new[sorted_group_ids]), axis=1)
+    return GroupedOpUnitDataStore.from_single_opunit("{}".format(file_name), opunit, x_new[sorted_group_ids],
+                                                     metrics)
 
 
-class GroupedOpUnitData:
+class GroupedOpUnitDataStore(Sequence):
     """
-    The class that stores the information about a group of operating units measured together
+    Struct-of-arrays store of the GroupedOpUnitData. Each field of the groups is a typed numpy column, and the
+    opunits of the groups and their features are in a two-level ragged (CSR) layout. Indexing the store returns
+    lightweight GroupedOpUnitData views.
     """
-    def __init__(self, name, opunit_features, metrics, sample_interval=0, concurrency=0):
+
+    def __init__(self, names, name_ids, opunit_offsets, opunits, feature_offsets, feature_values, y, start_times,
+                 cpu_ids, sample_intervals, concurrencies):
+        """
+        :param names: the distinct names of the groups
+        :param name_ids: the index in names of each group
+        :param opunit_offsets: the opunits of group i are opunits[opunit_offsets[i]:opunit_offsets[i + 1]]
+        :param opunits: the OpUnit values of all the groups
+        :param feature_offsets: the features of opunit j are feature_values[feature_offsets[j]:feature_offsets[j + 1]]
+        :param feature_values: the features of all the opunits
+        :param y: the measured metrics of each group
+        :param start_times: the start time of each group
+        :param cpu_ids: the cpu of each group
+        :param sample_intervals: the sampling interval of each group
+        :param concurrencies: the number of concurrency of each group
+        """
+        self.names = names
+        self.name_ids = np.asarray(name_ids, dtype=np.int32)
+        self.opunit_offsets = np.asarray(opunit_offsets, dtype=np.int64)
+        self.opunits = np.asarray(opunits, dtype=np.int16)
+        self.feature_offsets = np.asarray(feature_offsets, dtype=np.int64)
+        self.feature_values = np.asarray(feature_values, dtype=np.float64)
+
+        self.y = np.asarray(y, dtype=np.float64).reshape(len(self.name_ids), data_info.instance.MINI_MODEL_TARGET_NUM)
+        self.y_pred = None
+        self.start_time = np.asarray(start_times, dtype=np.float64)
+        self.end_time = self.start_time + self.y[:, data_info.instance.target_csv_index[Target.ELAPSED_US]] - 1
+        self.cpu_id = np.asarray(cpu_ids, dtype=np.int64)
+        self.sample_interval = np.broadcast_to(np.asarray(sample_intervals, dtype=np.int64), self.name_ids.shape).copy()
+        self.concurrency = np.broadcast_to(np.asarray(concurrencies, dtype=np.float64), self.name_ids.shape).copy()
+
+    @staticmethod
+    def split_metrics(metrics):
+        """Split the runtime metrics into the measured metrics, the start time, and the cpu
+
+        :param metrics: the runtime metrics (one row per group, with the targets at the end)
+        :return: (the measured metrics, the start times, the cpus)
+        """
+        index_map = data_info.instance.target_csv_index
+        metrics = np.asarray(metrics, dtype=np.float64)
+        return (metrics[:, -data_info.instance.MINI_MODEL_TARGET_NUM:], metrics[:, index_map[Target.START_TIME]],
+                metrics[:, index_map[Target.CPU_ID]])
+
+    @staticmethod
+    def from_single_opunit(name, opunit, x, metrics, sample_interval=0):
+        """Create the store of groups that each have one opunit
+
+        :param name: the name of all the groups
+        :param opunit: the OpUnit of all the groups
+        :param x: the features of the opunit in each group (one row per group)
+        :param metrics: the runtime metrics of each group (one row per group)
+        :param sample_interval: the sampling interval of all the groups
+        :return: the GroupedOpUnitDataStore
+        """
+        num_groups, num_features = x.shape
+        return GroupedOpUnitDataStore([name], np.zeros(num_groups), np.arange(num_groups + 1),
+                                      np.full(num_groups, opunit.value), np.arange(num_groups + 1) * num_features,
+                                      np.ravel(x), *GroupedOpUnitDataStore.split_metrics(metrics), sample_interval, 0)
+
+    @staticmethod
+    def concatenate(stores):
+        """Concatenate the stores
+
+        :param stores: the list of GroupedOpUnitDataStore
+        :return: the GroupedOpUnitDataStore with the groups of all the stores in order
+        """
+        builder = GroupedOpUnitDataBuilder()
+        for store in stores:
+            builder.extend(store)
+        return builder.build()
+
+    def get_start_times(self, concurrent_counting_mode):
+        """Get the start times of all the groups (see GroupedOpUnitData.get_start_time)
+
+        :param concurrent_counting_mode: ConcurrentCountingMode type
+        :return: the start times
+        """
+        start_times = None
+        if concurrent_counting_mode is ConcurrentCountingMode.EXACT:
+            start_times = self.start_time
+        if concurrent_counting_mode is ConcurrentCountingMode.ESTIMATED:
+            start_times = self.start_time
+        if concurrent_counting_mode is ConcurrentCountingMode.INTERVAL:
+            start_times = self.start_time + global_model_config.INTERVAL_START
+        return start_times
+
+    def get_end_times(self, concurrent_counting_mode):
+        """Get the end times of all the groups (see GroupedOpUnitData.get_end_time)
+
+        :param concurrent_counting_mode: ConcurrentCountingMode type
+        :return: the end times
         """
+        end_times = None
+        if concurrent_counting_mode is ConcurrentCountingMode.EXACT:
+            end_times = self.end_time
+        if concurrent_counting_mode is ConcurrentCountingMode.ESTIMATED:
+            end_times = self.start_time + self.y_pred[:, data_info.instance.target_csv_index[Target.ELAPSED_US]] - 1
+        if concurrent_counting_mode is ConcurrentCountingMode.INTERVAL:
+            end_times = self.start_time + global_model_config.INTERVAL_START + global_model_config.INTERVAL_SIZE
+        return end_times
+
+    def set_y_pred(self, index, y_pred):
+        """Set the predicted metrics of a group (the predictions of the other groups are NaN until set)
+
+        :param index: the index of the group
+        :param y_pred: the predicted metrics
+        """
+        if self.y_pred is None:
+            self.y_pred = np.full(self.y.shape, np.nan)
+        self.y_pred[index] = y_pred
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [GroupedOpUnitData(self, i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return GroupedOpUnitData(self, index)
+
+    def __iter__(self):
+        return (GroupedOpUnitData(self, i) for i in range(len(self)))
+
+    def __len__(self):
+        return len(self.name_ids)
+
+
+class GroupedOpUnitDataBuilder:
+    """
+    Builds a GroupedOpUnitDataStore by appending groups one at a time (or whole stores)
+    """
+
+    def __init__(self):
+        self._name_ids = {}
+        self._group_name_ids = []
+        self._group_opunit_nums = []
+        self._opunits = []
+        self._feature_nums = []
+        self._feature_values = []
+        self._y = []
+        self._start_times = []
+        self._cpu_ids = []
+        self._sample_intervals = []
+        self._concurrencies = []
+
+    def _get_name_id(self, name):
+        return self._name_ids.setdefault(name, len(self._name_ids))
+
+    def append(self, name, opunit_features, metrics, sample_interval=0, concurrency=0):
+        """Append a group
+
         :param name: The name of the data point (e.g., could be the pipeline identifier)
         :param opunit_features: The list of opunits and their inputs for this event
         :param metrics: The runtime metrics
         :param sample_interval: The sampling interval for this OU group
         :param concurrency: The number of concurrency for this contending (parallel) OU group
         """
-        self.name = name
-        self.opunit_features = opunit_features
-        self.y = metrics[-data_info.instance.MINI_MODEL_TARGET_NUM:]
-        self.y_pred = None
-        index_map = data_info.instance.target_csv_index
-        self.start_time = metrics[index_map[Target.START_TIME]]
-        self.end_time = self.start_time + self.y[index_map[Target.ELAPSED_US]] - 1
-        self.cpu_id = int(metrics[index_map[Target.CPU_ID]])
-        self.sample_interval = sample_interval
-        self.concurrency = concurrency
+        self._group_name_ids.append([self._get_name_id(name)])
+        self._group_opunit_nums.append([len(opunit_features)])
+        for opunit, feature in opunit_features:
+            self._opunits.append([opunit.value])
+            self._feature_nums.append([len(feature)])
+            self._feature_values.append(np.asarray(feature, dtype=np.float64))
+        y, start_times, cpu_ids = GroupedOpUnitDataStore.split_metrics(np.reshape(metrics, (1, -1)))
+        self._y.append(y)
+        self._start_times.append(start_times)
+        self._cpu_ids.append(cpu_ids)
+        self._sample_intervals.append([sample_interval])
+        self._concurrencies.append([concurrency])
+
+    def extend(self, store):
+        """Append all the groups of a store
+
+        :param store: the GroupedOpUnitDataStore
+        """
+        name_map = np.array([self._get_name_id(name) for name in store.names], dtype=np.int32)
+        self._group_name_ids.append(name_map[store.name_ids])
+        self._group_opunit_nums.append(np.diff(store.opunit_offsets))
+        self._opunits.append(store.opunits)
+        self._feature_nums.append(np.diff(store.feature_offsets))
+        self._feature_values.append(store.feature_values)
+        self._y.append(store.y)
+        self._start_times.append(store.start_time)
+        self._cpu_ids.append(store.cpu_id)
+        self._sample_intervals.append(store.sample_interval)
+        self._concurrencies.append(store.concurrency)
+
+    def build(self):
+        """
+        :return: the GroupedOpUnitDataStore of the appended groups
+        """
+        names = list(self._name_ids)
+        if len(self._y) == 0:
+            return GroupedOpUnitDataStore(names, [], [0], [], [0], [], [], [], [], [], [])
+
+        opunit_offsets = np.concatenate(([0], np.cumsum(np.concatenate(self._group_opunit_nums))))
+        feature_offsets = np.concatenate(([0], np.cumsum(np.concatenate(self._feature_nums))))
+        return GroupedOpUnitDataStore(names, np.concatenate(self._group_name_ids), opunit_offsets,
+                                      np.concatenate(self._opunits), feature_offsets,
+                                      np.concatenate(self._feature_values), np.concatenate(self._y),
+                                      np.concatenate(self._start_times), np.concatenate(self._cpu_ids),
+                                      np.concatenate(self._sample_intervals), np.concatenate(self._concurrencies))
+
+
+class GroupedOpUnitData:
+    """
+    The class that stores the information about a group of operating units measured together (a view of a group in a
+    GroupedOpUnitDataStore)
+    """
+    __slots__ = ("_store", "_index")
+
+    def __init__(self, store, index):
+        """
+        :param store: the GroupedOpUnitDataStore of the group
+        :param index: the index of the group in the store
+        """
+        self._store = store
+        self._index = index
+
+    @property
+    def name(self):
+        """The name of the data point (e.g., could be the pipeline identifier)"""
+        return self._store.names[self._store.name_ids[self._index]]
+
+    @property
+    def opunit_features(self):
+        """The list of opunits and their inputs for this event"""
+        store = self._store
+        opunit_features = []
+        for j in range(store.opunit_offsets[self._index], store.opunit_offsets[self._index + 1]):
+            feature = store.feature_values[store.feature_offsets[j]:store.feature_offsets[j + 1]]
+            opunit_features.append((OpUnit(store.opunits[j]), feature))
+        return opunit_features
+
+    @property
+    def y(self):
+        return self._store.y[self._index]
+
+    @property
+    def y_pred(self):
+        if self._store.y_pred is None:
+            return None
+        return self._store.y_pred[self._index]
+
+    @y_pred.setter
+    def y_pred(self, y_pred):
+        self._store.set_y_pred(self._index, y_pred)
+
+    @property
+    def start_time(self):
+        return self._store.start_time[self._index]
+
+    @property
+    def end_time(self):
+        return self._store.end_time[self._index]
+
+    @property
+    def cpu_id(self):
+        return int(self._store.cpu_id[self._index])
+
+    @property
+    def sample_interval(self):
+        """The sampling interval for this OU group"""
+        return int(self._store.sample_interval[self._index])
+
+    @property
+    def concurrency(self):
+        """The number of concurrency for this contending (parallel) OU group"""
+        return self._store.concurrency[self._index]
 
     def get_start_time(self, concurrent_counting_mode):
         """Get the start time for this group for counting the concurrent operations
@@ -1,14 +1,13 @@
 #!/usr/bin/env python3
 
-import csv
 import numpy as np
 import pandas as pd
 import os
 import logging
-import tqdm
 import math
+from collections import ChainMap
 
-from data_class import data_util
+from data_class import columnar_cache, data_util
 from info import data_info
 from util import io_util
 
@@ -24,7 +23,8 @@ def write_extended_data(output_path, symbol, index_value_list, data_map):
         io_util.write_csv_result(output_path, key, value)
 
 
-def get_mini_runner_data(filename, model_results_path, txn_sample_interval, model_map={}, predict_cache={}, trim=0.2):
+def get_mini_runner_data(filename, model_results_path, txn_sample_interval, model_map={}, predict_cache={}, trim=0.2,
+                         fallback_model_map=None):
     """Get the training data from the mini runner
 
     :param filename: the input data file
@@ -33,6 +33,8 @@ def get_mini_runner_data(filename, model_results_path, txn_sample_interval, mode
     :param model_map: the map from OpUnit to the mini model
     :param predict_cache: cache for the mini model prediction
     :param trim: % of too high/too low anomalies to prune
+    :param fallback_model_map: the map from OpUnit to the previously trained mini model (in the order that they were
+           trained), used for the execution opunits that are not in model_map (see _execution_get_mini_runner_data)
     :return: the list of Data for execution operating units
     """
 
@@ -41,7 +43,7 @@ def get_mini_runner_data(filename, model_results_path, txn_sample_interval, mode
         return _txn_get_mini_runner_data(filename, model_results_path, txn_sample_interval)
     if "execution" in filename:
         # Handle the execution data
-        return _execution_get_mini_runner_data(filename, model_map, predict_cache, trim)
+        return _execution_get_mini_runner_data(filename, model_map, predict_cache, trim, fallback_model_map)
     if "gc" in filename or "log" in filename:
         # Handle of the gc or log data with interval-based conversion
         return _interval_get_mini_runner_data(filename, model_results_path)
@@ -51,7 +53,7 @@ def get_mini_runner_data(filename, model_results_path, txn_sample_interval, mode
 
 def _default_get_mini_runner_data(filename):
     # In the default case, the data does not need any pre-processing and the file name indicates the opunit
-    df = pd.read_csv(filename, skipinitialspace=True)
+    df = columnar_cache.load_csv(filename).to_dataframe()
     headers = list(df.columns.values)
     data_info.instance.parse_csv_header(headers, False)
     file_name = os.path.splitext(os.path.basename(filename))[0]
@@ -64,7 +66,7 @@ def _default_get_mini_runner_data(filename):
 
 def _txn_get_mini_runner_data(filename, model_results_path, txn_sample_interval):
     # In the default case, the data does not need any pre-processing and the file name indicates the opunit
-    df = pd.read_csv(filename)
+    df = columnar_cache.load_csv(filename).to_dataframe()
     file_name = os.path.splitext(os.path.basename(filename))[0]
 
     # prepending a column of ones as the base transaction data feature
@@ -72,8 +74,8 @@ def _txn_get_mini_runner_data(filename, model_results_path, txn_sample_interval)
     df = pd.concat([base_x, df], axis=1)
     x = df.iloc[:, :-data_info.instance.METRICS_OUTPUT_NUM].values
     y = df.iloc[:, -data_info.instance.MINI_MODEL_TARGET_NUM:].values
-    start_times = df.iloc[:, data_info.instance.TARGET_CSV_INDEX[data_info.instance.Target.START_TIME]].values
-    cpu_ids = df.iloc[:, data_info.instance.TARGET_CSV_INDEX[data_info.instance.Target.CPU_ID]].values
+    start_times = df.iloc[:, data_info.instance.target_csv_index[Target.START_TIME]].values
+    cpu_ids = df.iloc[:, data_info.instance.target_csv_index[Target.CPU_ID]].values
 
     logging.info("Loaded file: {}".format(OpUnit[file_name.upper()]))
 
@@ -83,48 +85,33 @@ def _txn_get_mini_runner_data(filename, model_results_path, txn_sample_interval)
 
     interval = data_info.instance.CONTENDING_OPUNIT_INTERVAL
 
-    # Map from interval start time to the data in this interval
-    interval_x_map = {}
-    interval_y_map = {}
-    interval_id_map = {}
-    n = x.shape[0]
-    for i in tqdm.tqdm(list(range(n)), desc="Group data by interval"):
-        rounded_time = data_util.round_to_interval(start_times[i], interval)
-        if rounded_time not in interval_x_map:
-            interval_x_map[rounded_time] = []
-            interval_y_map[rounded_time] = []
-            interval_id_map[rounded_time] = set()
-        interval_x_map[rounded_time].append(x[i])
-        interval_y_map[rounded_time].append(y[i])
-        interval_id_map[rounded_time].add(cpu_ids[i])
+    # Group the data by interval start time
+    group_ids, rounded_times, sorted_rows, offsets, counts = data_util.group_by_interval(start_times, interval)
 
     # Construct the new data
-    x_list = []
-    y_list = []
-    for rounded_time in interval_x_map:
-        # Sum the features
-        x_new = np.sum(interval_x_map[rounded_time], axis=0)
-        # Concatenate the number of different threads
-        x_new = np.concatenate((x_new, [len(interval_id_map[rounded_time])]))
-        x_new *= txn_sample_interval + 1
-        x_list.append(x_new)
-        # The prediction is the average behavior
-        y_list.append(np.average(interval_y_map[rounded_time], axis=0))
-        io_util.write_csv_result(prediction_path, rounded_time, np.concatenate((x_list[-1], y_list[-1])))
-
-    return [OpUnitData(OpUnit[file_name.upper()], np.array(x_list), np.array(y_list))]
+    # Sum the features
+    x_new = data_util.sum_by_group(x, sorted_rows, offsets)
+    # Concatenate the number of different threads
+    num_threads = data_util.count_distinct_by_group(group_ids, cpu_ids, len(counts))
+    x_new = np.concatenate((x_new, num_threads[:, np.newaxis]), axis=1)
+    x_new *= txn_sample_interval + 1
+    # The prediction is the average behavior
+    y_new = data_util.sum_by_group(y, sorted_rows, offsets) / counts[:, np.newaxis]
+    io_util.write_csv_results(prediction_path, rounded_times.tolist(), np.concatenate((x_new, y_new), axis=1).tolist())
+
+    return [OpUnitData(OpUnit[file_name.upper()], x_new, y_new)]
 
 
 def _interval_get_mini_runner_data(filename, model_results_path):
     # In the default case, the data does not need any pre-processing and the file name indicates the opunit
-    df = pd.read_csv(filename, skipinitialspace=True)
+    df = columnar_cache.load_csv(filename).to_dataframe()
     headers = list(df.columns.values)
     data_info.instance.parse_csv_header(headers, False)
     file_name = os.path.splitext(os.path.basename(filename))[0]
 
     x = df.iloc[:, :-data_info.instance.METRICS_OUTPUT_NUM].values
     y = df.iloc[:, -data_info.instance.MINI_MODEL_TARGET_NUM:].values
-    start_times = df.iloc[:, data_info.instance.RAW_TARGET_CSV_INDEX[Target.START_TIME]].values
+    start_times = df.iloc[:, data_info.instance.raw_target_csv_index[Target.START_TIME]].values
     logging.info("Loaded file: {}".format(OpUnit[file_name.upper()]))
 
     # change the data based on the interval for the periodically invoked operating units
@@ -133,94 +120,90 @@ def _interval_get_mini_runner_data(filename, model_results_path):
 
     interval = data_info.instance.PERIODIC_OPUNIT_INTERVAL
 
-    # Map from interval start time to the data in this interval
-    interval_x_map = {}
-    interval_y_map = {}
-    n = x.shape[0]
-    for i in tqdm.tqdm(list(range(n)), desc="Group data by interval"):
-        rounded_time = data_util.round_to_interval(start_times[i], interval)
-        if rounded_time not in interval_x_map:
-            interval_x_map[rounded_time] = []
-            interval_y_map[rounded_time] = []
-        interval_x_map[rounded_time].append(x[i])
-        interval_y_map[rounded_time].append(y[i])
+    # Group the data by interval start time
+    _, rounded_times, sorted_rows, offsets, counts = data_util.group_by_interval(start_times, interval)
 
     # Construct the new data
-    x_list = []
-    y_list = []
-    for rounded_time in interval_x_map:
-        # Sum the features
-        x_new = np.sum(interval_x_map[rounded_time], axis=0)
-        # Keep the interval parameter the same
-        # TODO: currently the interval parameter is always the last. Change the hard-coding later
-        x_new[-1] /= len(interval_x_map[rounded_time])
-        x_list.append(x_new)
-        # The prediction is the average behavior
-        y_list.append(np.average(interval_y_map[rounded_time], axis=0))
-        io_util.write_csv_result(prediction_path, rounded_time, np.concatenate((x_list[-1], y_list[-1])))
-
-    return [OpUnitData(OpUnit[file_name.upper()], np.array(x_list), np.array(y_list))]
-
-
-def _execution_get_mini_runner_data(filename, model_map, predict_cache, trim):
+    # Sum the features
+    x_new = data_util.sum_by_group(x, sorted_rows, offsets)
+    # Keep the interval parameter the same
+    # TODO: currently the interval parameter is always the last. Change the hard-coding later
+    x_new[:, -1] /= counts
+    # The prediction is the average behavior
+    y_new = data_util.sum_by_group(y, sorted_rows, offsets) / counts[:, np.newaxis]
+    io_util.write_csv_results(prediction_path, rounded_times.tolist(), np.concatenate((x_new, y_new), axis=1).tolist())
+
+    return [OpUnitData(OpUnit[file_name.upper()], x_new, y_new)]
+
+
+def _execution_get_mini_runner_data(filename, model_map, predict_cache, trim, fallback_model_map=None):
     """Get the training data from the mini runner
 
+    The opunit of a row that is not in model_map is the one that the row is training data for. With fallback_model_map,
+    a row can have several such opunits: the one trained last in the fallback_model_map order (or not trained at all)
+    is the one that the row is training data for, and the others are predicted with their fallback models.
+
     :param filename: the input data file
     :param model_map: the map from OpUnit to the mini model
     :param predict_cache: cache for the mini model prediction
     :param trim: % of too high/too low anomalies to prune
+    :param fallback_model_map: the map from OpUnit to the previously trained mini model, in the order that they were
+           trained
     :return: the list of Data for execution operating units
     """
 
     # Get the mini runner data for the execution engine
     data_map = {}
     raw_data_map = {}
-    input_output_boundary = math.nan
-    with open(filename, "r") as f:
-        reader = csv.reader(f, delimiter=",", skipinitialspace=True)
-        indexes = next(reader)
-        data_info.instance.parse_csv_header(indexes, True)
-        features_vector_index = data_info.instance.raw_features_csv_index[ExecutionFeature.FEATURES]
-        raw_boundary = data_info.instance.raw_features_csv_index[data_info.instance.INPUT_OUTPUT_BOUNDARY]
-        input_output_boundary = len(data_info.instance.input_csv_index)
-
-        for line in reader:
-            # drop query_id, pipeline_id, num_features, features_vector
-            record = [d for i, d in enumerate(line) if i >= raw_boundary]
-            data = list(map(data_util.convert_string_to_numeric, record))
-            x_multiple = data[:input_output_boundary]
-            y_merged = np.array(data[-data_info.instance.MINI_MODEL_TARGET_NUM:])
-
-            # Get the opunits located within
-            opunits = []
-            features = line[features_vector_index].split(';')
-            for idx, feature in enumerate(features):
-                opunit = OpUnit[feature]
-                x_loc = [v[idx] if type(v) == list else v for v in x_multiple]
-                if opunit in model_map:
-                    key = [opunit] + x_loc
-                    if tuple(key) not in predict_cache:
-                        predict = model_map[opunit].predict(np.array(x_loc).reshape(1, -1))[0]
-                        predict_cache[tuple(key)] = predict
-                        assert len(predict) == len(y_merged)
-                        y_merged = y_merged - predict
-                    else:
-                        predict = predict_cache[tuple(key)]
-                        assert len(predict) == len(y_merged)
-                        y_merged = y_merged - predict
-
-                    y_merged = np.clip(y_merged, 0, None)
+    table = columnar_cache.load_csv(filename)
+    data_info.instance.parse_csv_header(table.header, True)
+    features_vector_index = data_info.instance.raw_features_csv_index[ExecutionFeature.FEATURES]
+    raw_boundary = data_info.instance.raw_features_csv_index[data_info.instance.INPUT_OUTPUT_BOUNDARY]
+    input_output_boundary = len(data_info.instance.input_csv_index)
+    fallback_order = {} if fallback_model_map is None else {opunit: i for i, opunit in enumerate(fallback_model_map)}
+
+    # drop query_id, pipeline_id, num_features, features_vector
+    for features_vector, data in zip(table.column(features_vector_index), table.rows(raw_boundary)):
+        x_multiple = data[:input_output_boundary]
+        y_merged = np.array(data[-data_info.instance.MINI_MODEL_TARGET_NUM:])
+
+        # Get the opunits located within
+        opunits = []
+        features = features_vector.split(';')
+        row_model_map = model_map
+        if len(fallback_order) > 0:
+            unmodelled = [OpUnit[feature] for feature in features if OpUnit[feature] not in model_map]
+            if len(unmodelled) > 1:
+                target = max(unmodelled, key=lambda opunit: fallback_order.get(opunit, len(fallback_order)))
+                row_model_map = ChainMap(model_map, {opunit: fallback_model_map[opunit] for opunit in unmodelled
+                                                     if opunit != target and opunit in fallback_model_map})
+        for idx, feature in enumerate(features):
+            opunit = OpUnit[feature]
+            x_loc = [v[idx] if type(v) == list else v for v in x_multiple]
+            if opunit in row_model_map:
+                key = [opunit] + x_loc
+                if tuple(key) not in predict_cache:
+                    predict = row_model_map[opunit].predict(np.array(x_loc).reshape(1, -1))[0]
+                    predict_cache[tuple(key)] = predict
+                    assert len(predict) == len(y_merged)
+                    y_merged = y_merged - predict
                 else:
-                    opunits.append((opunit, x_loc))
-
-            if len(opunits) > 1:
-                raise Exception('Unmodelled OperatingUnits detected: {}'.format(opunits))
-
-            # Record into predict_cache
-            key = tuple([opunits[0][0]] + opunits[0][1])
-            if key not in raw_data_map:
-                raw_data_map[key] = []
-            raw_data_map[key].append(y_merged)
+                    predict = predict_cache[tuple(key)]
+                    assert len(predict) == len(y_merged)
+                    y_merged = y_merged - predict
+
+                y_merged = np.clip(y_merged, 0, None)
+            else:
+                opunits.append((opunit, x_loc))
+
+        if len(opunits) > 1:
+            raise Exception('Unmodelled OperatingUnits detected: {}'.format(opunits))
+
+        # Record into predict_cache
+        key = tuple([opunits[0][0]] + opunits[0][1])
+        if key not in raw_data_map:
+            raw_data_map[key] = []
+        raw_data_map[key].append(y_merged)
 
     # Postprocess the raw_data_map -> data_map
     # We need to do this here since we need to have seen all the data
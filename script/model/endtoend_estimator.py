@@ -4,13 +4,12 @@ import numpy as np
 import argparse
 import pickle
 import logging
-import tqdm
 
 import global_model_config
+import model_store
 from util import io_util, logging_util
 from training_util import global_data_constructing_util, result_writing_util
 from info import data_info
-from type import Target
 
 np.set_printoptions(precision=4)
 np.set_printoptions(edgeitems=10)
@@ -77,40 +76,22 @@ class EndtoendEstimator:
 
     def _model_prediction_with_derived_data(self, impact_data_list, model_name, model):
         # Then apply the global impact model
-        x = []
-        y = []
-        mini_model_y_pred = []  # The labels directly predicted from the mini models
-        raw_y = []  # The actual labels
-        data_list = []
+        data_list = impact_data_list.data_list
+        mini_model_y_pred = data_list.y_pred  # The labels directly predicted from the mini models
+        raw_y = data_list.y  # The actual labels
+        predicted_resource_util = None
+        if model_name == "impact":
+            predicted_resource_util = impact_data_list.get_y_preds()
+        if model_name == "direct":
+            predicted_resource_util = impact_data_list.x
         # The input feature is (normalized mini model prediction, predicted global resource util, the predicted
         # resource util on the same core that the opunit group runs)
         # The output target is the ratio between the actual resource util (including the elapsed time) and the
         # normalized mini model prediction
-        for d in tqdm.tqdm(impact_data_list, desc="Construct data for the {} model".format(model_name)):
-            data_list.append(d.target_grouped_op_unit_data)
-            mini_model_y_pred.append(d.target_grouped_op_unit_data.y_pred)
-            raw_y.append(d.target_grouped_op_unit_data.y)
-            predicted_elapsed_us = mini_model_y_pred[-1][data_info.instance.target_csv_index[Target.ELAPSED_US]]
-            predicted_resource_util = None
-            if model_name == "impact":
-                predicted_resource_util = d.get_y_pred()
-            if model_name == "direct":
-                predicted_resource_util = d.x
-            # Remove the OU group itself from the total resource data
-            self_resource = (mini_model_y_pred[-1] * max(1, d.target_grouped_op_unit_data.concurrency) /
-                             len(d.resource_data_list) / global_model_config.INTERVAL_SIZE)
-            predicted_resource_util[:mini_model_y_pred[-1].shape[0]] -= self_resource
-            predicted_resource_util[predicted_resource_util < 0] = 0
-            x.append(np.concatenate((mini_model_y_pred[-1] / predicted_elapsed_us,
-                                     predicted_resource_util,
-                                     d.resource_util_same_core_x)))
-            # x.append(np.concatenate((mini_model_y_pred[-1] / predicted_elapsed_us, predicted_resource_util)))
-            y.append(d.target_grouped_op_unit_data.y / (d.target_grouped_op_unit_data.y_pred +
-                                                        global_model_config.RATIO_DIVISION_EPSILON))
+        x = impact_data_list.get_derived_x(predicted_resource_util, np.arange(len(impact_data_list)))
+        y = raw_y / (mini_model_y_pred + global_model_config.RATIO_DIVISION_EPSILON)
 
         # Predict
-        x = np.array(x)
-        y = np.array(y)
         y_pred = model.predict(x)
 
         # Record results
@@ -122,7 +103,10 @@ class EndtoendEstimator:
         :param x: the input data
         :param y: the actual output
         :param y_pred: the predicted output
-        :param label: the result label ("resource" or "impact")
+        :param raw_y: the actual labels (not used for the "resource" label)
+        :param mini_model_y_pred: the labels directly predicted from the mini models (not used for the "resource" label)
+        :param label: the result label ("resource", "impact", or "direct")
+        :param data_list: the GroupedOpUnitDataStore of the targets (not used for the "resource" label)
         """
         # Result files
         metrics_path = "{}/global_{}_model_metrics.csv".format(self.model_results_path, label)
@@ -176,46 +160,38 @@ class EndtoendEstimator:
             if label == 'direct':
                 prediction_path = "{}/grouped_opunit_prediction.csv".format(self.model_results_path)
                 io_util.create_csv_file(prediction_path, ["Pipeline", "", "Actual", "", "Predicted", "", "Ratio Error"])
-                for i, data in enumerate(data_list):
-                    io_util.write_csv_result(prediction_path, data.name, [""] + list(raw_y[i]) + [""] +
-                                             list(raw_y_pred[i]) + [""] + list(ratio_error[i]))
+                io_util.write_csv_results(prediction_path, [data_list.names[i] for i in data_list.name_ids],
+                                          ([""] + list(y) + [""] + list(y_pred) + [""] + list(error)
+                                           for y, y_pred, error in zip(raw_y, raw_y_pred, ratio_error)))
 
                 average_result_path = "{}/interval_average_prediction.csv".format(self.model_results_path)
                 io_util.create_csv_file(average_result_path,
                                         ["Timestamp", "Actual Average", "Predicted Average"])
 
-                interval_y_map = {}
-                interval_y_pred_map = {}
                 mark_list = None
                 # mark_list = _generate_mark_list(data_list)
-                for i, data in enumerate(data_list):
-                    # Don't count the create index OU
-                    # TODO(lin): needs better way to evaluate... maybe add a id_query field to GroupedOpunitData
-                    if data.concurrency > 0:
-                        continue
-                    if mark_list is not None and not mark_list[i]:
-                        continue
-                    interval_time = _round_to_interval(data.start_time, global_model_config.AVERAGING_INTERVAL)
-                    if interval_time not in interval_y_map:
-                        interval_y_map[interval_time] = []
-                        interval_y_pred_map[interval_time] = []
-                    interval_y_map[interval_time].append(raw_y[i][-5])
-                    interval_y_pred_map[interval_time].append(raw_y_pred[i][-5])
-
-                for time in sorted(interval_y_map.keys()):
-                    if mark_list is None:
-                        io_util.write_csv_result(average_result_path, time,
-                                                 [np.average(interval_y_map[time]),
-                                                  np.average(interval_y_pred_map[time])])
-                    else:
-                        io_util.write_csv_result(average_result_path, time,
-                                                 [np.sum(interval_y_map[time]),
-                                                  np.sum(interval_y_pred_map[time])])
+                # Don't count the create index OU
+                # TODO(lin): needs better way to evaluate... maybe add a id_query field to GroupedOpunitData
+                selected = data_list.concurrency <= 0
+                if mark_list is not None:
+                    selected &= np.array(mark_list)
+                interval_times = _round_to_interval(data_list.start_time[selected],
+                                                    global_model_config.AVERAGING_INTERVAL)
+
+                # Group the selected data by the interval (in the data order within each interval)
+                order = np.argsort(interval_times, kind='stable')
+                times, group_starts = np.unique(interval_times[order], return_index=True)
+                interval_ys = np.split(raw_y[selected][order, -5], group_starts[1:])
+                interval_y_preds = np.split(raw_y_pred[selected][order, -5], group_starts[1:])
+                aggregate = np.average if mark_list is None else np.sum
+                io_util.write_csv_results(average_result_path, times,
+                                          ([aggregate(interval_y), aggregate(interval_y_pred)]
+                                           for interval_y, interval_y_pred in zip(interval_ys, interval_y_preds)))
 
 
 def _round_to_interval(time, interval):
     """
-    :param time: in us
+    :param time: in us (a number or a numpy array)
     :return: time in us rounded to the earliest interval
     """
     return time - time % interval
@@ -248,7 +224,7 @@ if __name__ == '__main__':
     aparser.add_argument('--model_results_path', default='endtoend_estimation_results',
                          help='Prediction results of the mini models')
     aparser.add_argument('--mini_model_file', default='trained_model/mini_model_map.pickle',
-                         help='File of the saved mini models')
+                         help='File (or sharded model store directory) of the saved mini models')
     aparser.add_argument('--global_resource_model_file',
                          default='trained_model/global_resource_model.pickle',
                          help='File of the saved global resource model')
@@ -269,8 +245,7 @@ if __name__ == '__main__':
 
     logging_util.init_logging(args.log)
 
-    with open(args.mini_model_file, 'rb') as pickle_file:
-        model_map, data_info.instance = pickle.load(pickle_file)
+    model_map, data_info.instance = model_store.load_model_map(args.mini_model_file)
     with open(args.global_resource_model_file, 'rb') as pickle_file:
         resource_model = pickle.load(pickle_file)
     with open(args.global_impact_model_file, 'rb') as pickle_file:
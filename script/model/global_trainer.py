@@ -4,11 +4,11 @@ import numpy as np
 import argparse
 import pickle
 import logging
-import tqdm
 import random
 from sklearn import model_selection
 
 import model
+import model_store
 import global_model_config
 from info import data_info
 from util import io_util, logging_util
@@ -89,7 +89,11 @@ class GlobalTrainer:
 
     def __init__(self, input_path, model_results_path, ml_models, test_ratio, impact_model_ratio, mini_model_map,
                  warmup_period, use_query_predict_cache, add_noise, predict_ou_only, ee_sample_interval,
-                 txn_sample_interval, network_sample_interval):
+                 txn_sample_interval, network_sample_interval, num_workers=None):
+        """
+        :param num_workers: number of worker processes to load the input files with (defaults to a small number sized by
+               the input files, and 1 loads the files in the current process)
+        """
         self.input_path = input_path
         self.model_results_path = model_results_path
         self.ml_models = ml_models
@@ -103,6 +107,7 @@ class GlobalTrainer:
         self.ee_sample_interval = ee_sample_interval
         self.txn_sample_interval = txn_sample_interval
         self.network_sample_interval = network_sample_interval
+        self.num_workers = num_workers
 
         self.resource_data_list = None
         self.impact_data_list = None
@@ -120,7 +125,8 @@ class GlobalTrainer:
                                                             self.predict_ou_only,
                                                             self.ee_sample_interval,
                                                             self.txn_sample_interval,
-                                                            self.network_sample_interval)
+                                                            self.network_sample_interval,
+                                                            self.num_workers)
 
         self.resource_data_list = data_lists[0]
         self.impact_data_list = data_lists[1]
@@ -154,53 +160,38 @@ class GlobalTrainer:
 
     def _train_model_with_derived_data(self, impact_data_list, model_name):
         # Then train the global impact model
-        x = []
-        y = []
-        mini_model_y_pred = []  # The labels directly predicted from the mini models
-        raw_y = []  # The actual labels
         data_len = len(impact_data_list)
-        sample_list = random.sample(range(data_len), k=int(data_len * self.impact_model_ratio))
+        sample_list = np.array(random.sample(range(data_len), k=int(data_len * self.impact_model_ratio)),
+                               dtype=np.int64)
         epsilon = global_model_config.RATIO_DIVISION_EPSILON
+        data_list = impact_data_list.data_list
+        mini_model_y_pred = data_list.y_pred[sample_list]  # The labels directly predicted from the mini models
+        raw_y = data_list.y[sample_list]  # The actual labels
+        predicted_resource_util = None
+        if model_name == "impact":
+            predicted_resource_util = impact_data_list.get_y_preds()
+        if model_name == "direct":
+            predicted_resource_util = impact_data_list.x
         # The input feature is (normalized mini model prediction, predicted global resource util, the predicted
         # resource util on the same core that the opunit group runs)
         # The output target is the ratio between the actual resource util (including the elapsed time) and the
         # normalized mini model prediction
-        for idx in tqdm.tqdm(sample_list, desc="Construct data for the {} model".format(model_name)):
-            d = impact_data_list[idx]
-            mini_model_y_pred.append(d.target_grouped_op_unit_data.y_pred)
-            predicted_elapsed_us = mini_model_y_pred[-1][data_info.instance.target_csv_index[Target.ELAPSED_US]]
-            predicted_resource_util = None
-            if model_name == "impact":
-                predicted_resource_util = d.get_y_pred().copy()
-            if model_name == "direct":
-                predicted_resource_util = d.x.copy()
-            # Remove the OU group itself from the total resource data
-            self_resource = (mini_model_y_pred[-1] * max(1, d.target_grouped_op_unit_data.concurrency) /
-                             len(d.resource_data_list) / global_model_config.INTERVAL_SIZE)
-            predicted_resource_util[:mini_model_y_pred[-1].shape[0]] -= self_resource
-            predicted_resource_util[predicted_resource_util < 0] = 0
-            x.append(np.concatenate((mini_model_y_pred[-1] / predicted_elapsed_us,
-                                     predicted_resource_util,
-                                     d.resource_util_same_core_x)))
-            # x.append(np.concatenate((mini_model_y_pred[-1] / predicted_elapsed_us, predicted_resource_util)))
-            raw_y.append(d.target_grouped_op_unit_data.y)
-            y.append(raw_y[-1] / (mini_model_y_pred[-1] + epsilon))
-            # Do not adjust memory consumption since it shouldn't change
-            y[-1][data_info.instance.target_csv_index[Target.MEMORY_B]] = 1
+        x = impact_data_list.get_derived_x(predicted_resource_util, sample_list)
+        y = raw_y / (mini_model_y_pred + epsilon)
+        # Do not adjust memory consumption since it shouldn't change
+        y[:, data_info.instance.target_csv_index[Target.MEMORY_B]] = 1
 
         # Training
         metrics_path = "{}/global_{}_model_metrics.csv".format(self.model_results_path, model_name)
         prediction_path = "{}/global_{}_model_prediction.csv".format(self.model_results_path, model_name)
-        x = np.array(x)
-        y = np.array(y)
         trained_model, test_indices = _global_model_training_process(x, y, self.ml_models, self.test_ratio,
                                                                      metrics_path, prediction_path)
 
         # Calculate the accumulated ratio error
-        mini_model_y_pred = np.array(mini_model_y_pred)[test_indices]
+        mini_model_y_pred = mini_model_y_pred[test_indices]
         y_pred = trained_model.predict(x)[test_indices]
         raw_y_pred = (mini_model_y_pred + epsilon) * y_pred
-        raw_y = np.array(raw_y)[test_indices]
+        raw_y = raw_y[test_indices]
         accumulated_raw_y = np.sum(raw_y, axis=0)
         accumulated_raw_y_pred = np.sum(raw_y_pred, axis=0)
         original_ratio_error = np.average(np.abs(raw_y - mini_model_y_pred) / (raw_y + epsilon), axis=0)
@@ -229,7 +220,7 @@ if __name__ == '__main__':
                          help='Prediction results of the mini models')
     aparser.add_argument('--save_path', default='trained_model', help='Path to save the trained models')
     aparser.add_argument('--mini_model_file', default='trained_model/mini_model_map.pickle',
-                         help='File of the saved mini models')
+                         help='File (or sharded model store directory) of the saved mini models')
     aparser.add_argument('--ml_models', nargs='*', type=str, default=["nn"],
                          help='ML models for the mini trainer to evaluate')
     aparser.add_argument('--test_ratio', type=float, default=0.2, help='Test data split ratio')
@@ -246,6 +237,9 @@ if __name__ == '__main__':
                          help='Sampling interval for the transaction OUs')
     aparser.add_argument('--network_sample_interval', type=int, default=49,
                          help='Sampling interval for the network OUs')
+    aparser.add_argument('--num_workers', type=int, default=None,
+                         help='Number of worker processes to load the input files (defaults to a small number sized '
+                              'by the input files)')
     aparser.add_argument('--log', default='info', help='The logging level')
     args = aparser.parse_args()
 
@@ -253,12 +247,11 @@ if __name__ == '__main__':
 
     logging.info("Global trainer starts.")
 
-    with open(args.mini_model_file, 'rb') as pickle_file:
-        model_map, data_info.instance = pickle.load(pickle_file)
+    model_map, data_info.instance = model_store.load_model_map(args.mini_model_file)
     trainer = GlobalTrainer(args.input_path, args.model_results_path, args.ml_models, args.test_ratio,
                             args.impact_model_ratio, model_map, args.warmup_period, args.use_query_predict_cache,
                             args.add_noise, args.predict_ou_only, args.ee_sample_interval, args.txn_sample_interval,
-                            args.network_sample_interval)
+                            args.network_sample_interval, args.num_workers)
     trainer.predict_ou_data()
     if not args.predict_ou_only:
         resource_model, impact_model, direct_model = trainer.train()
@@ -69,28 +69,42 @@ class DataInfo:
     def parse_csv_header(self, header, raw_boundary=False):
         """Parses a CSV header for ExecutionFeature indexes
 
+        The indexes are parsed into new maps that replace the current ones only once the whole header is parsed, so
+        an invalid header leaves the instance unchanged. The instance is per process: the worker processes of the
+        trainers are given the instance of the parent, and parsing in a worker does not affect the parent.
+
         :param header: array of CSV column headers
         :param raw_boundary: whether there is a raw boundary or not
         """
+        raw_target_csv_index = dict(self.raw_target_csv_index)
+        raw_features_csv_index = dict(self.raw_features_csv_index)
+        target_csv_index = dict(self.target_csv_index)
+        input_csv_index = dict(self.input_csv_index)
+
         for i, index in enumerate(header):
             if index.upper() not in ExecutionFeature.__members__:
-                self.raw_target_csv_index[Target[index.upper()]] = i
+                raw_target_csv_index[Target[index.upper()]] = i
             else:
-                self.raw_features_csv_index[ExecutionFeature[index.upper()]] = i
+                raw_features_csv_index[ExecutionFeature[index.upper()]] = i
 
         input_output_boundary = None
         if raw_boundary:
             # Computes the index that divides the unnecessary fields and the input/output
-            input_output_boundary = self.raw_features_csv_index[self.INPUT_OUTPUT_BOUNDARY]
+            input_output_boundary = raw_features_csv_index[self.INPUT_OUTPUT_BOUNDARY]
 
         # Computes the index within input/output of where input splits from output
-        output_boundary = self.raw_target_csv_index[self.INPUT_END_BOUNDARY]
+        output_boundary = raw_target_csv_index[self.INPUT_END_BOUNDARY]
 
         for i, index in enumerate(header):
             if i >= output_boundary:
-                self.target_csv_index[Target[index.upper()]] = i - len(header)
+                target_csv_index[Target[index.upper()]] = i - len(header)
             elif input_output_boundary is not None and i >= input_output_boundary:
-                self.input_csv_index[ExecutionFeature[index.upper()]] = i - input_output_boundary
+                input_csv_index[ExecutionFeature[index.upper()]] = i - input_output_boundary
+
+        self.raw_target_csv_index = raw_target_csv_index
+        self.raw_features_csv_index = raw_features_csv_index
+        self.target_csv_index = target_csv_index
+        self.input_csv_index = input_csv_index
 
 
 instance = DataInfo()
@@ -6,12 +6,17 @@ import numpy as np
 import argparse
 import pickle
 import logging
+import multiprocessing
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from contextlib import nullcontext
 
 from sklearn import model_selection
 
 import model
+import model_store
 from util import io_util, logging_util
-from data_class import opunit_data
+from data_class import columnar_cache, opunit_data
 from info import data_info
 from training_util import data_transforming_util, result_writing_util
 from type import Target
@@ -21,42 +26,227 @@ np.set_printoptions(edgeitems=10)
 np.set_printoptions(suppress=True)
 
 
+def _fit_model(opunit, method, y_transformer_idx, x, y, evaluate_x_list, n_jobs, data_info_instance):
+    """Fit a mini model (runs in the worker processes of the MiniTrainer)
+
+    :param opunit: the opunit of the model
+    :param method: the ML method to use
+    :param y_transformer_idx: 0 for no output transformer, 1 for the output transformer of the opunit
+    :param x: input feature
+    :param y: labels
+    :param evaluate_x_list: the inputs to predict with the trained model
+    :param n_jobs: number of threads for the ML method, None for its default
+    :param data_info_instance: the DataInfo that the data is parsed with
+    :return: (the trained model, the predictions for evaluate_x_list, the training time in seconds)
+    """
+    data_info.instance = data_info_instance
+
+    y_transformers = [None, data_transforming_util.OPUNIT_Y_TRANSFORMER_MAP[opunit]]
+    x_transformer = data_transforming_util.OPUNIT_X_TRANSFORMER_MAP[opunit]
+    start = time.perf_counter()
+    regressor = model.Model(method, y_transformer=y_transformers[y_transformer_idx], x_transformer=x_transformer,
+                            n_jobs=n_jobs)
+    regressor.train(x, y)
+    elapsed = time.perf_counter() - start
+
+    return regressor, [regressor.predict(evaluate_x) for evaluate_x in evaluate_x_list], elapsed
+
+
+def _continue_fit(regressor, x, y, data_info_instance):
+    """Continue training a fitted mini model with more data (runs in the worker processes of the MiniTrainer)
+
+    :param regressor: the fitted model
+    :param x: input feature
+    :param y: labels
+    :param data_info_instance: the DataInfo that the data is parsed with
+    :return: (the trained model, no predictions, the training time in seconds)
+    """
+    data_info.instance = data_info_instance
+
+    start = time.perf_counter()
+    if not regressor.train_incremental(x, y):
+        # Methods without incremental training (like lr) are cheap to train from scratch
+        regressor.train(x, y)
+    elapsed = time.perf_counter() - start
+
+    return regressor, [], elapsed
+
+
+def _update_fit(regressor, x, y, refit_x, refit_y, data_info_instance):
+    """Update a trained mini model with new data (runs in the worker processes of the MiniTrainer)
+
+    :param regressor: the trained model
+    :param x: input feature of the new data
+    :param y: labels of the new data
+    :param refit_x: input feature of the cached training data and the new data, to refit the methods without
+           incremental training with
+    :param refit_y: labels of the cached training data and the new data
+    :param data_info_instance: the DataInfo that the data is parsed with
+    :return: (the updated model, the predictions for x, the training time in seconds, whether the model is trained
+             incrementally rather than refit)
+    """
+    data_info.instance = data_info_instance
+
+    start = time.perf_counter()
+    incremental = regressor.train_incremental(x, y)
+    if not incremental:
+        regressor.train(refit_x, refit_y)
+    elapsed = time.perf_counter() - start
+
+    return regressor, [regressor.predict(x)], elapsed, incremental
+
+
+def _get_percentage_error(y, y_pred):
+    """
+    :param y: the actual labels
+    :param y_pred: the predicted labels
+    :return: the average percentage error of each label
+    """
+    # In order to avoid the percentage error to explode when the actual label is very small, we omit the data point
+    # with the actual label <= 5 when calculating the percentage error (by essentially giving the data points with
+    # small labels a very small weight)
+    error_bias = 1
+    evaluate_threshold = 5
+    weights = np.where(y > evaluate_threshold, np.ones(y.shape), np.full(y.shape, 1e-6))
+    return np.average(np.abs(y - y_pred) / (y + error_bias), axis=0, weights=weights)
+
+
 class MiniTrainer:
     """
     Trainer for the mini models
     """
 
-    def __init__(self, input_path, model_metrics_path, ml_models, test_ratio, trim, expose_all, txn_sample_interval):
+    # How the selected model of an opunit is finalized with expose_all:
+    # refit: train the selected method from scratch on all the data
+    # reuse: use the selected candidate that is trained on the train split as is
+    # warm_start: continue training the selected candidate on all the data (see Model.train_incremental)
+    FINALIZE_MODES = ("refit", "reuse", "warm_start")
+
+    # Maximum number of the most recent data rows of each opunit kept as the training data (see train_incremental)
+    MAX_TRAINING_DATA_ROWS = 1000000
+
+    def __init__(self, input_path, model_metrics_path, ml_models, test_ratio, trim, expose_all, txn_sample_interval,
+                 num_workers=None, finalize_mode="refit"):
+        """
+        :param num_workers: number of worker processes to fit the models with (defaults to the number of CPUs, and
+               1 fits the models in the current process)
+        :param finalize_mode: how the selected models are finalized with expose_all (see FINALIZE_MODES)
+        """
+        if finalize_mode not in MiniTrainer.FINALIZE_MODES:
+            raise ValueError("Unknown finalize mode {}".format(finalize_mode))
+
         self.input_path = input_path
         self.model_metrics_path = model_metrics_path
         self.ml_models = ml_models
         self.test_ratio = test_ratio
         self.model_map = {}
+        self.training_data = {}
         self.stats_map = {}
         self.trim = trim
         self.expose_all = expose_all
         self.txn_sample_interval = txn_sample_interval
+        self.num_workers = os.cpu_count() if num_workers is None else num_workers
+        self.finalize_mode = finalize_mode
+
+        self._pool = None
+        # The best candidate model of each opunit from train_data, kept for the finalization
+        self._best_candidates = {}
 
     def get_model_map(self):
         return self.model_map
 
-    def train_specific_model(self, data, y_transformer_idx, method_idx):
+    def get_training_data(self):
+        """
+        :return: the map from OpUnit to the (x, y) data that its model is trained with (at most the
+                 MAX_TRAINING_DATA_ROWS most recent rows)
+        """
+        return self.training_data
+
+    def _set_training_data(self, opunit, x, y):
+        self.training_data[opunit] = (x[-MiniTrainer.MAX_TRAINING_DATA_ROWS:], y[-MiniTrainer.MAX_TRAINING_DATA_ROWS:])
+
+    def _submit(self, fn, *args):
+        """Run fn(*args, data_info.instance) in the worker pool (or in the current process without a pool)
+
+        :return: the future of the result
+        """
+        if self._pool is not None:
+            return self._pool.submit(fn, *args, data_info.instance)
+
+        future = Future()
+        future.set_result(fn(*args, data_info.instance))
+        return future
+
+    def _submit_fit(self, data, method_idx, y_transformer_idx, x, y, evaluate_x_list):
+        """Fit a model in the worker pool (or in the current process without a pool)
+
+        :return: the future of the _fit_model result
+        """
+        # Each worker fits with a single thread so that the workers do not oversubscribe the CPUs
+        n_jobs = 1 if self._pool is not None else None
+        return self._submit(_fit_model, data.opunit, self.ml_models[method_idx], y_transformer_idx, x, y,
+                            evaluate_x_list, n_jobs)
+
+    def _submit_final(self, data, y_transformer_idx, method_idx):
+        """Submit the finalization of the selected model of the opunit according to the finalize mode
+
+        :return: the future of the (model, predictions, training time) result
+        """
+        candidate = self._best_candidates.pop(data.opunit, None)
+        if candidate is None or self.finalize_mode == "refit":
+            return self._submit_fit(data, method_idx, y_transformer_idx, data.x, data.y, [])
+
+        if self.finalize_mode == "warm_start":
+            return self._submit(_continue_fit, candidate, data.x, data.y)
+
+        future = Future()
+        future.set_result((candidate, [], 0.0))
+        return future
+
+    def _split_data(self, data):
+        return model_selection.train_test_split(data.x, data.y, test_size=self.test_ratio, random_state=0)
+
+    def _submit_candidates(self, data):
+        """Submit the fits of all the (output transformer, method) candidates of the opunit on the train split
+
+        :param data: the OpUnitData
+        :return: list of the candidate fit futures in the evaluation order of train_data
+        """
+        x_train, x_test, y_train, y_test = self._split_data(data)
+        return [self._submit_fit(data, m, i, x_train, y_train, [x_train, x_test])
+                for i in range(2) for m in range(len(self.ml_models))]
+
+    def train_specific_model(self, data, y_transformer_idx, method_idx, future=None):
+        """Fit the selected model on all the data of the opunit
+
+        :param data: the OpUnitData
+        :param y_transformer_idx: the selected output transformer
+        :param method_idx: the selected method
+        :param future: the already submitted finalization of the model (submitted here if not given)
+        """
         methods = self.ml_models
         method = methods[method_idx]
         label = method if y_transformer_idx == 0 else method + " transform"
         logging.info("Finalizing model {} {}".format(data.opunit.name, label))
 
-        y_transformers = [None, data_transforming_util.OPUNIT_Y_TRANSFORMER_MAP[data.opunit]]
-        x_transformer = data_transforming_util.OPUNIT_X_TRANSFORMER_MAP[data.opunit]
-        regressor = model.Model(methods[method_idx], y_transformer=y_transformers[y_transformer_idx],
-                                x_transformer=x_transformer)
-        regressor.train(data.x, data.y)
+        if future is None:
+            future = self._submit_final(data, y_transformer_idx, method_idx)
+        regressor, _, elapsed = future.result()
+        logging.info("Finalized model {} {} in {:.2f}s".format(data.opunit.name, label, elapsed))
         self.model_map[data.opunit] = regressor
 
-    def train_data(self, data, summary_file):
-        x_train, x_test, y_train, y_test = model_selection.train_test_split(data.x, data.y,
-                                                                            test_size=self.test_ratio,
-                                                                            random_state=0)
+    def train_data(self, data, summary_file, candidate_futures=None):
+        """Fit all the candidate models on the train split of the opunit data and evaluate them on the test split
+
+        :param data: the OpUnitData
+        :param summary_file: the file to write the test errors of all the opunits to
+        :param candidate_futures: the already submitted candidate fits (see _submit_candidates, submitted here if not
+               given)
+        :return: (the best output transformer index, the best method index), only set with expose_all
+        """
+        x_train, x_test, y_train, y_test = self._split_data(data)
+        if candidate_futures is None:
+            candidate_futures = self._submit_candidates(data)
 
         # Write the first header rwo to the result file
         metrics_path = "{}/{}.csv".format(self.model_metrics_path, data.opunit.name.lower())
@@ -70,9 +260,7 @@ class MiniTrainer:
         # modeling_transformer = data_transforming_util.OPUNIT_MODELING_TRANSFORMER_MAP[data.opunit]
         # if modeling_transformer is not None:
         #    transformers.append(modeling_transformer)
-        x_transformer = data_transforming_util.OPUNIT_X_TRANSFORMER_MAP[data.opunit]
 
-        error_bias = 1
         min_percentage_error = 2
         pred_results = None
         elapsed_us_index = data_info.instance.target_csv_index[Target.ELAPSED_US]
@@ -82,11 +270,10 @@ class MiniTrainer:
         best_method = -1
         for i, y_transformer in enumerate(y_transformers):
             for m, method in enumerate(methods):
-                # Train the model
+                # Get the trained model
                 label = method if i == 0 else method + " transform"
-                logging.info("{} {}".format(data.opunit.name, label))
-                regressor = model.Model(method, y_transformer=y_transformer, x_transformer=x_transformer)
-                regressor.train(x_train, y_train)
+                regressor, y_preds, elapsed = candidate_futures[i * len(methods) + m].result()
+                logging.info("{} {} trained in {:.2f}s".format(data.opunit.name, label, elapsed))
 
                 # Evaluate on both the training and test set
                 results = []
@@ -96,16 +283,10 @@ class MiniTrainer:
                     evaluate_x = d[0]
                     evaluate_y = d[1]
 
-                    y_pred = regressor.predict(evaluate_x)
+                    y_pred = y_preds[j]
                     logging.debug("x shape: {}".format(evaluate_x.shape))
                     logging.debug("y shape: {}".format(y_pred.shape))
-                    # In order to avoid the percentage error to explode when the actual label is very small,
-                    # we omit the data point with the actual label <= 5 when calculating the percentage error (by
-                    # essentially giving the data points with small labels a very small weight)
-                    evaluate_threshold = 5
-                    weights = np.where(evaluate_y > evaluate_threshold, np.ones(evaluate_y.shape), np.full(evaluate_y.shape, 1e-6))
-                    percentage_error = np.average(np.abs(evaluate_y - y_pred) / (evaluate_y + error_bias), axis=0,
-                                                  weights=weights)
+                    percentage_error = _get_percentage_error(evaluate_y, y_pred)
                     results += list(percentage_error) + [""]
 
                     logging.info('{} Percentage Error: {}'.format(train_test_label[j], percentage_error))
@@ -127,6 +308,7 @@ class MiniTrainer:
                         if self.expose_all:
                             best_y_transformer = i
                             best_method = m
+                            self._best_candidates[data.opunit] = regressor
                         else:
                             self.model_map[data.opunit] = regressor
                         pred_results = (evaluate_x, y_pred, evaluate_y)
@@ -145,30 +327,179 @@ class MiniTrainer:
         result_writing_util.record_predictions(pred_results, prediction_path)
         return best_y_transformer, best_method
 
-    def train(self):
+    def train(self, progress_callback=None):
         """Train the mini-models
 
+        :param progress_callback: optional function called with (number of files trained, total number of files)
         :return: the map of the trained models
         """
 
         self.model_map = {}
+        self.training_data = {}
+        self._best_candidates = {}
+
+        summary_file = self._create_summary_file()
+        self._run_in_pool(self._train_files, summary_file, progress_callback)
 
+        return self.model_map
+
+    def train_incremental(self, model_map, training_data=None, progress_callback=None):
+        """Update the trained mini models with the data of the (new) input files instead of training from scratch
+
+        The model of an opunit in the data continues training on the new data if its method supports it (see
+        Model.train_incremental), and is otherwise refit on its cached training data together with the new data. The
+        opunits without a model are trained from scratch like in train.
+
+        Like in train, the execution data of a file is derived with the models of the opunits updated from the
+        previous new input files. The other opunits of an execution row fall back to their models in model_map, except
+        for the one trained last in the model_map order, which the row is training data for (see
+        opunit_data.get_mini_runner_data). The new input files therefore do not need to cover all the opunits (e.g.,
+        only the execution files of some of the mini runners).
+
+        :param model_map: the map from OpUnit to the trained mini model
+        :param training_data: the map from OpUnit to the (x, y) data that its model is trained with (see
+               get_training_data), None if not cached
+        :param progress_callback: optional function called with (number of files trained, total number of files)
+        :return: the map of the updated models
+        """
+        self.model_map = dict(model_map)
+        self.training_data = dict(training_data) if training_data is not None else {}
+        # The cached predictions are of the models before the update
+        self.stats_map = {}
+        self._best_candidates = {}
+
+        summary_file = self._create_summary_file()
+        self._run_in_pool(self._update_files, summary_file, progress_callback)
+
+        return self.model_map
+
+    def _create_summary_file(self):
         # Create the results files for the paper
         header = ["OpUnit", "Method"] + [target.name for target in data_info.instance.MINI_MODEL_TARGET_LIST]
         summary_file = "{}/mini_runner.csv".format(self.model_metrics_path)
         io_util.create_csv_file(summary_file, header)
+        return summary_file
+
+    def _run_in_pool(self, fn, *args):
+        """Run fn(*args) with the worker pool (or without a pool with a single worker)
+        """
+        # Workers are spawned rather than forked since LightGBM may hang in forked processes
+        pool = None
+        if self.num_workers > 1:
+            pool = ProcessPoolExecutor(max_workers=self.num_workers, mp_context=multiprocessing.get_context("spawn"))
+
+        with pool if pool is not None else nullcontext():
+            self._pool = pool
+            try:
+                fn(*args)
+            finally:
+                self._pool = None
+
+    def _iter_mini_runner_data(self, model_map, progress_callback, fallback_model_map=None):
+        """Get the OpUnitData of the input files in order
+
+        The data of a file depends on the models trained from the previous files, so the data of the next file is only
+        loaded once the data of the current file is trained.
+
+        :param model_map: the map from OpUnit to the models trained from the previous files
+        :param progress_callback: optional function called with (number of files trained, total number of files)
+        :param fallback_model_map: the map from OpUnit to the previously trained models for the opunits that are not
+               in model_map (see opunit_data.get_mini_runner_data)
+        :return: generator of the OpUnitData list of each file
+        """
+        filenames = sorted(glob.glob(os.path.join(self.input_path, '*.csv')))
+        # Parse the next files into the columnar cache in the worker pool while the current file is trained
+        conversion_futures = {}
+        for i, filename in enumerate(filenames):
+            if self._pool is not None:
+                for ahead_filename in filenames[i:i + self.num_workers]:
+                    if ahead_filename not in conversion_futures:
+                        conversion_futures[ahead_filename] = self._pool.submit(columnar_cache.convert_csv,
+                                                                               ahead_filename)
+                conversion_futures.pop(filename).result()
 
-        # First get the data for all mini runners
-        for filename in sorted(glob.glob(os.path.join(self.input_path, '*.csv'))):
             print(filename)
-            data_list = opunit_data.get_mini_runner_data(filename, self.model_metrics_path, self.txn_sample_interval,
-                                                         self.model_map, self.stats_map, self.trim)
+            if progress_callback is not None:
+                progress_callback(i, len(filenames))
+            yield opunit_data.get_mini_runner_data(filename, self.model_metrics_path, self.txn_sample_interval,
+                                                   model_map, self.stats_map, self.trim, fallback_model_map)
+
+        if progress_callback is not None:
+            progress_callback(len(filenames), len(filenames))
+
+    def _train_files(self, summary_file, progress_callback):
+        # First get the data for all mini runners. The files are trained in order, while all the fits within a file
+        # run in parallel
+        for data_list in self._iter_mini_runner_data(self.model_map, progress_callback):
+            self._train_data_list(data_list, summary_file)
+
+    def _train_data_list(self, data_list, summary_file):
+        """Train the models of the OpUnitData of a file from scratch
+        """
+        candidate_futures = [self._submit_candidates(data) for data in data_list]
+
+        final_futures = []
+        for data, futures in zip(data_list, candidate_futures):
+            best_y_transformer, best_method = self.train_data(data, summary_file, futures)
+            if self.expose_all:
+                future = self._submit_final(data, best_y_transformer, best_method)
+                final_futures.append((data, best_y_transformer, best_method, future))
+
+        for data, best_y_transformer, best_method, future in final_futures:
+            self.train_specific_model(data, best_y_transformer, best_method, future)
+
+        for data in data_list:
+            self._set_training_data(data.opunit, data.x, data.y)
+
+    def _update_files(self, summary_file, progress_callback):
+        # The models trained (or updated) from the previous input files
+        updated_model_map = {}
+        # The models before the update, in the order that they were trained
+        fallback_model_map = dict(self.model_map)
+        for data_list in self._iter_mini_runner_data(updated_model_map, progress_callback, fallback_model_map):
+            update_futures = []
+            new_data_list = []
             for data in data_list:
-                best_y_transformer, best_method = self.train_data(data, summary_file)
-                if self.expose_all:
-                    self.train_specific_model(data, best_y_transformer, best_method)
-
-        return self.model_map
+                if data.opunit not in self.model_map:
+                    new_data_list.append(data)
+                    continue
+
+                regressor = self.model_map[data.opunit]
+                refit_x, refit_y = data.x, data.y
+                if data.opunit in self.training_data:
+                    cached_x, cached_y = self.training_data[data.opunit]
+                    refit_x = np.concatenate((cached_x, data.x))
+                    refit_y = np.concatenate((cached_y, data.y))
+                else:
+                    logging.warning("No cached training data for {}".format(data.opunit.name))
+                # Evaluate the current model before the update, which may change it in place without a worker pool
+                y_pred = regressor.predict(data.x)
+                future = self._submit(_update_fit, regressor, data.x, data.y, refit_x, refit_y)
+                update_futures.append((data, y_pred, refit_x, refit_y, future))
+
+            # The opunits without a model are trained from scratch
+            self._train_data_list(new_data_list, summary_file)
+            for data in new_data_list:
+                if data.opunit in self.model_map:
+                    updated_model_map[data.opunit] = self.model_map[data.opunit]
+
+            for data, y_pred, refit_x, refit_y, future in update_futures:
+                regressor, (updated_y_pred,), elapsed, incremental = future.result()
+                label = "incremental" if incremental else "refit"
+                logging.info("{} updated ({}) in {:.2f}s".format(data.opunit.name, label, elapsed))
+                io_util.write_csv_result(summary_file, data.opunit.name,
+                                         ["before update"] + list(_get_percentage_error(data.y, y_pred)))
+                io_util.write_csv_result(summary_file, data.opunit.name,
+                                         ["{} update".format(label)] +
+                                         list(_get_percentage_error(data.y, updated_y_pred)))
+                self.model_map[data.opunit] = regressor
+                updated_model_map[data.opunit] = regressor
+                self._set_training_data(data.opunit, refit_x, refit_y)
+
+            # The cached predictions of the updated opunits may be of their fallback models
+            updated_opunits = {data.opunit for data in data_list}
+            for key in [key for key in self.stats_map if key[0] in updated_opunits]:
+                del self.stats_map[key]
 
 
 # ==============================================
@@ -189,12 +520,21 @@ if __name__ == '__main__':
     aparser.add_argument('--expose_all', default=True, help='Should expose all data to the model')
     aparser.add_argument('--txn_sample_interval', type=int, default=49,
                          help='Sampling interval for the transaction OUs')
+    aparser.add_argument('--sharded', action='store_true',
+                         help='Save the mini models as a sharded model store (one file per opunit)')
+    aparser.add_argument('--num_workers', type=int, default=None,
+                         help='Number of worker processes to fit the models with (defaults to the number of CPUs)')
+    aparser.add_argument('--finalize_mode', default='refit', choices=MiniTrainer.FINALIZE_MODES,
+                         help='How to finalize the selected model of each opunit on all the data')
     aparser.add_argument('--log', default='info', help='The logging level')
     args = aparser.parse_args()
 
     logging_util.init_logging(args.log)
     trainer = MiniTrainer(args.input_path, args.model_results_path, args.ml_models, args.test_ratio, args.trim,
-                          args.expose_all, args.txn_sample_interval)
+                          args.expose_all, args.txn_sample_interval, args.num_workers, args.finalize_mode)
     trained_model_map = trainer.train()
-    with open(args.save_path + '/mini_model_map.pickle', 'wb') as file:
-        pickle.dump((trained_model_map, data_info.instance), file)
+    if args.sharded:
+        model_store.save_model_store(args.save_path + '/mini_model_map', trained_model_map, data_info.instance)
+    else:
+        with open(args.save_path + '/mini_model_map.pickle', 'wb') as file:
+            pickle.dump((trained_model_map, data_info.instance), file)
@@ -12,6 +12,8 @@ from sklearn import neural_network
 from sklearn import multioutput
 from sklearn import svm
 
+import compiled_model
+
 # import warnings filter
 from warnings import simplefilter
 
@@ -20,8 +22,17 @@ simplefilter(action='ignore', category=FutureWarning)
 
 _LOGTRANS_EPS = 1e-4
 
+# Default number of threads for the random forest
+_RF_DEFAULT_N_JOBS = 8
+
+# Number of trees that incremental training adds to a random forest
+_INCREMENTAL_RF_TREES = 10
+
+# Number of boosting rounds that incremental training adds to a gradient boosting model
+_INCREMENTAL_GBM_ROUNDS = 20
+
 
-def _get_base_ml_model(method):
+def _get_base_ml_model(method, n_jobs=None):
     regressor = None
     if method == 'lr':
         regressor = linear_model.LinearRegression()
@@ -34,10 +45,13 @@ def _get_base_ml_model(method):
     if method == 'kr':
         regressor = kernel_ridge.KernelRidge(kernel='rbf')
     if method == 'rf':
-        regressor = ensemble.RandomForestRegressor(n_estimators=50, n_jobs=8)
+        regressor = ensemble.RandomForestRegressor(n_estimators=50,
+                                                   n_jobs=_RF_DEFAULT_N_JOBS if n_jobs is None else n_jobs)
     if method == 'gbm':
         regressor = lgb.LGBMRegressor(max_depth=20, num_leaves=1000, n_estimators=100, min_child_samples=5,
                                       random_state=42)
+        if n_jobs is not None:
+            regressor.set_params(n_jobs=n_jobs)
         regressor = multioutput.MultiOutputRegressor(regressor)
     if method == 'nn':
         regressor = neural_network.MLPRegressor(hidden_layer_sizes=(25, 25), early_stopping=True,
@@ -52,7 +66,8 @@ class Model:
     With the implementation for different normalization handlings
     """
 
-    def __init__(self, method, normalize=True, log_transform=True, y_transformer=None, x_transformer=None):
+    def __init__(self, method, normalize=True, log_transform=True, y_transformer=None, x_transformer=None,
+                 n_jobs=None):
         """
 
         :param method: which ML method to use
@@ -61,16 +76,28 @@ class Model:
         :param y_transformer: the customized data transformer for output (a pair of functions with the first for
                training and second for predict)
         :param x_transformer: the customized data transformer for input
+        :param n_jobs: number of threads for the ML methods that fit in parallel (rf and gbm), None for their defaults
         """
-        self._base_model = _get_base_ml_model(method)
+        self._base_model = _get_base_ml_model(method, n_jobs)
         self._normalize = normalize
         self._log_transform = log_transform
         self._xscaler = preprocessing.StandardScaler()
         self._yscaler = preprocessing.StandardScaler()
         self._y_transformer = y_transformer
         self._x_transformer = x_transformer
+        self._compiled = None
+
+    def compile(self):
+        """Precompute the prediction pipeline of the trained model (see compiled_model), which predict then uses
+
+        :return: whether the base model is supported by the compiled pipeline
+        """
+        self._compiled = compiled_model.compile_model(self, _LOGTRANS_EPS)
+        return self._compiled is not None
 
     def train(self, x, y):
+        self._compiled = None
+
         if self._y_transformer is not None:
             y = self._y_transformer[0](x, y)
 
@@ -87,7 +114,63 @@ class Model:
 
         self._base_model.fit(x, y)
 
+    def train_incremental(self, x, y):
+        """Continue training the trained model with (new) data, keeping the normalization of the initial training
+
+        rf grows additional trees on the data, gbm boosts additional rounds starting from the trained trees, and nn
+        continues from the trained weights. The other methods are not supported.
+
+        :param x: input feature
+        :param y: labels
+        :return: whether the method supports incremental training (the model is unchanged if not)
+        """
+        base_model = self._base_model
+        is_gbm = (isinstance(base_model, multioutput.MultiOutputRegressor) and
+                  all(isinstance(e, lgb.LGBMRegressor) for e in base_model.estimators_))
+        if not (isinstance(base_model, (ensemble.RandomForestRegressor, neural_network.MLPRegressor)) or is_gbm):
+            return False
+
+        self._compiled = None
+
+        if self._y_transformer is not None:
+            y = self._y_transformer[0](x, y)
+
+        if self._x_transformer is not None:
+            x = self._x_transformer(x)
+
+        if self._log_transform:
+            x = np.log(x + _LOGTRANS_EPS)
+            y = np.log(y + _LOGTRANS_EPS)
+
+        if self._normalize:
+            x = self._xscaler.transform(x)
+            y = self._yscaler.transform(y)
+
+        if isinstance(base_model, ensemble.RandomForestRegressor):
+            base_model.set_params(warm_start=True, n_estimators=len(base_model.estimators_) + _INCREMENTAL_RF_TREES)
+            base_model.fit(x, y)
+            base_model.set_params(warm_start=False)
+        elif isinstance(base_model, neural_network.MLPRegressor):
+            base_model.set_params(warm_start=True)
+            base_model.fit(x, y)
+            base_model.set_params(warm_start=False)
+        else:
+            estimators = []
+            for i, estimator in enumerate(base_model.estimators_):
+                new_estimator = lgb.LGBMRegressor(**estimator.get_params())
+                new_estimator.set_params(n_estimators=_INCREMENTAL_GBM_ROUNDS)
+                new_estimator.fit(x, y[:, i], init_model=estimator.booster_)
+                estimators.append(new_estimator)
+            base_model.estimators_ = estimators
+
+        return True
+
     def predict(self, x):
+        # Models pickled before compile was introduced do not have the attribute
+        compiled = getattr(self, '_compiled', None)
+        if compiled is not None and (compiled.max_rows is None or len(x) <= compiled.max_rows):
+            return compiled.predict(x)
+
         original_x = x
 
         if self._x_transformer is not None:
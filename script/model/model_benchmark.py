@@ -0,0 +1,501 @@
+#!/usr/bin/env python3
+"""
+Benchmarks of the training time and the inference latency of the modeling scripts on synthetic data
+(see synthetic_data_util).
+
+Invoke with:
+    `model_benchmark.py --output model_benchmark.json`
+
+The results are written in the Google Benchmark JSON format that the microbenchmark ArtifactProcessor consumes, with
+one benchmark per measurement named "<suite>/<test>[/<method>]". The real time is the wall clock time per iteration,
+and items_per_second is the number of the processed rows (or requests) per wall clock second. The cpu time is the CPU
+time of the benchmark process, except for the benchmarks of the trainers and the ModelServer, whose work runs (partly)
+in the worker processes or the ModelServer that the CPU time of the benchmark process does not include. Their cpu time
+is the wall clock time as well, since the ArtifactProcessor tracks the cpu time of the benchmarks.
+"""
+
+import argparse
+import json
+import logging
+import os
+import pickle
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+import zmq
+
+import model
+import model_store
+from data_class import columnar_cache, grouped_op_unit_data, opunit_data
+from global_trainer import GlobalTrainer
+from info import data_info
+from mini_trainer import MiniTrainer
+from training_util import global_data_cache
+from util import logging_util, synthetic_data_util
+
+BENCHMARKS = ["ingestion", "mini_trainer", "model", "global_trainer", "model_server", "retrain_incremental"]
+
+# Methods whose trained models are updated in place by incremental training (see Model.train_incremental)
+INCREMENTAL_TRAINING_METHODS = ["rf", "gbm", "nn"]
+
+# Minimum number of pipeline rows to benchmark the global trainer with (fewer rows leave too few data in the resource
+# intervals to train and test the global models with)
+MIN_GLOBAL_TRAINER_PIPELINE_ROWS = 1000
+
+
+def _measure(fn, iterations, setup=None):
+    """Run fn for a number of iterations
+
+    :param fn: the function to measure
+    :param iterations: number of iterations
+    :param setup: optional function called before each iteration (not measured)
+    :return: (total wall clock seconds, total CPU seconds)
+    """
+    real_time = 0
+    cpu_time = 0
+    for _ in range(iterations):
+        if setup is not None:
+            setup()
+        real_start = time.perf_counter()
+        cpu_start = time.process_time()
+        fn()
+        real_time += time.perf_counter() - real_start
+        cpu_time += time.process_time() - cpu_start
+    return real_time, cpu_time
+
+
+def _generate_predict_x(rng, num_rows):
+    # The features are continuous, so the rows do not repeat
+    x = synthetic_data_util.generate_features(rng, num_rows)
+    return x * rng.uniform(1, 2, x.shape)
+
+
+def _remove_dir(path):
+    shutil.rmtree(path, ignore_errors=True)
+
+
+class BenchmarkResults:
+    """
+    The benchmark results in the Google Benchmark JSON format
+    """
+
+    # Seconds per time unit
+    TIME_UNITS = {"ms": 1e-3, "us": 1e-6}
+
+    def __init__(self, context):
+        """
+        :param context: additional information about the run to record in the context
+        """
+        self.context = dict(context)
+        self.context.update({
+            "date": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S+00:00"),
+            "executable": "model_benchmark",
+            "num_cpus": os.cpu_count(),
+        })
+        self.benchmarks = []
+
+    def add(self, name, iterations, times, items, time_unit="ms", other_processes=False):
+        """Record the result of a benchmark
+
+        :param name: "<suite>/<test>[/<arg>]"
+        :param iterations: number of the measured iterations
+        :param times: (total wall clock seconds, total CPU seconds) of the iterations
+        :param items: total number of the processed items in the iterations
+        :param time_unit: unit of the reported time per iteration
+        :param other_processes: whether the work runs in other processes (the worker processes or the ModelServer), so
+               that the wall clock time is reported as the cpu time, which the ArtifactProcessor tracks
+        """
+        real_time, cpu_time = times
+        if other_processes:
+            cpu_time = real_time
+        unit = BenchmarkResults.TIME_UNITS[time_unit]
+        self.benchmarks.append({
+            "name": name,
+            "iterations": iterations,
+            "real_time": real_time / iterations / unit,
+            "cpu_time": cpu_time / iterations / unit,
+            "time_unit": time_unit,
+            "items_per_second": items / real_time if real_time > 0 else 0,
+        })
+        logging.info("{}: {:.3f} {} per iteration, {:.1f} items/s".format(
+            name, real_time / iterations / unit, time_unit, self.benchmarks[-1]["items_per_second"]))
+
+    def write(self, filename):
+        with open(filename, "w") as f:
+            json.dump({"context": self.context, "benchmarks": self.benchmarks}, f, indent=2)
+
+
+class ModelServerClient:
+    """
+    Client of a ModelServer subprocess that sends the requests the same way as the ModelServerManager (from a ROUTER
+    socket bound to the ipc endpoint)
+    """
+
+    # Identity of the ModelServer socket
+    SERVER_IDENTITY = b"model"
+
+    # Identity of the client on the other end of the ModelServer
+    CLIENT_IDENTITY = b"benchmark"
+
+    def __init__(self, end_point, timeout_ms):
+        """
+        :param end_point: the ipc endpoint path
+        :param timeout_ms: how long to wait for a reply of the ModelServer
+        """
+        self.timeout_ms = timeout_ms
+        self.context = zmq.Context()
+        self.socket = self.context.socket(zmq.ROUTER)
+        self.socket.bind("ipc://{}".format(end_point))
+        script_path = os.path.dirname(os.path.abspath(__file__))
+        self.process = subprocess.Popen([sys.executable, os.path.join(script_path, "model_server.py"), end_point],
+                                        cwd=script_path)
+        self._next_id = 1
+
+        # Wait for the CONNECTED callback of the ModelServer
+        self._recv()
+
+    def _recv(self):
+        if not self.socket.poll(self.timeout_ms):
+            raise RuntimeError("No reply from the ModelServer in {} ms".format(self.timeout_ms))
+        frames = self.socket.recv_multipart()
+        send_id, recv_id, result = frames[2].decode("utf-8").split("-", 2)
+        return int(recv_id), json.loads(result)
+
+    def _send(self, cmd, data, wire_format="JSON", frames=()):
+        send_id = self._next_id
+        self._next_id += 1
+        payload = "{}-0-{}".format(send_id, json.dumps({"cmd": cmd, "data": data, "format": wire_format}))
+        self.socket.send_multipart([ModelServerClient.SERVER_IDENTITY, ModelServerClient.CLIENT_IDENTITY, b"",
+                                    payload.encode("utf-8")] + list(frames), copy=False)
+        return send_id
+
+    def request(self, cmd, data, wire_format="JSON", frames=()):
+        """Send a request to the ModelServer and wait for the reply
+
+        :param cmd: the Command name
+        :param data: the data of the command
+        :param wire_format: the WireFormat name
+        :param frames: the trailing binary frames of the BINARY wire format
+        :return: the result of the reply
+        """
+        send_id = self._send(cmd, data, wire_format, frames)
+        recv_id, response = self._recv()
+        if recv_id != send_id:
+            raise RuntimeError("Reply to request {} while waiting for request {}".format(recv_id, send_id))
+        if not response["success"]:
+            raise RuntimeError("{} failed: {}".format(cmd, response["err"]))
+        return response["result"]
+
+    def close(self):
+        # The ModelServer does not reply to QUIT
+        self._send("QUIT", {})
+        try:
+            self.process.wait(self.timeout_ms / 1000)
+        except subprocess.TimeoutExpired:
+            logging.warning("ModelServer did not quit in {} ms".format(self.timeout_ms))
+            self.process.kill()
+        self.socket.close(linger=0)
+        self.context.term()
+
+
+class ModelBenchmark:
+    """
+    Benchmarks of the modeling scripts on synthetic data files generated in a work directory
+    """
+
+    def __init__(self, work_path, methods, mini_runner_rows, pipeline_rows, train_rows, num_predictions,
+                 batch_size, num_batches, repetitions, num_workers, server_timeout_ms):
+        """
+        :param work_path: the directory to generate the data and to save the models in
+        :param methods: ML methods to benchmark
+        :param mini_runner_rows: number of rows of the mini-runner data file
+        :param pipeline_rows: number of rows of the pipeline data file
+        :param train_rows: number of rows to train the models with
+        :param num_predictions: number of the single-row predictions (or requests) to measure
+        :param batch_size: number of rows of a batched prediction (or request)
+        :param num_batches: number of the batched predictions (or requests) to measure
+        :param repetitions: number of iterations of the ingestion and training benchmarks
+        :param num_workers: number of worker processes of the trainers (defaults to the number of CPUs)
+        :param server_timeout_ms: how long to wait for a reply of the ModelServer
+        """
+        self.work_path = os.path.abspath(work_path)
+        self.methods = methods
+        self.mini_runner_rows = mini_runner_rows
+        self.pipeline_rows = pipeline_rows
+        self.train_rows = train_rows
+        self.num_predictions = num_predictions
+        self.batch_size = batch_size
+        self.num_batches = num_batches
+        self.repetitions = repetitions
+        self.num_workers = num_workers
+        self.server_timeout_ms = server_timeout_ms
+
+        self.mini_runner_path = os.path.join(self.work_path, "mini_runner_input")
+        self.pipeline_path = os.path.join(self.work_path, "global_runner_input")
+        self.results_path = os.path.join(self.work_path, "model_results")
+        for path in [self.mini_runner_path, self.pipeline_path, self.results_path]:
+            os.makedirs(path, exist_ok=True)
+
+        logging.info("Generating {} mini-runner rows and {} pipeline rows".format(mini_runner_rows, pipeline_rows))
+        self.mini_runner_file = synthetic_data_util.write_mini_runner_data(self.mini_runner_path, mini_runner_rows)
+        self.pipeline_file = synthetic_data_util.write_pipeline_data(self.pipeline_path, pipeline_rows)
+        data_info.instance.parse_csv_header(synthetic_data_util.EXECUTION_HEADER, True)
+
+        rng = np.random.default_rng(1)
+        self.train_x, self.train_y = synthetic_data_util.get_training_data(train_rows)
+        self.predict_x = _generate_predict_x(rng, max(num_predictions, batch_size))
+
+        # The mini model map trained with each method (one model shared by all the opunits)
+        self.model_maps = {}
+
+    def _get_model_map_file(self, method):
+        return os.path.join(self.work_path, "mini_model_map_{}.pickle".format(method))
+
+    def _save_model_map(self, method, regressor):
+        self.model_maps[method] = {opunit: regressor for opunit in synthetic_data_util.OPUNITS}
+        with open(self._get_model_map_file(method), "wb") as f:
+            pickle.dump((self.model_maps[method], data_info.instance), f)
+
+    def _get_model_map(self, method):
+        if method not in self.model_maps:
+            regressor = model.Model(method)
+            regressor.train(self.train_x, self.train_y)
+            self._save_model_map(method, regressor)
+        return self.model_maps[method]
+
+    def run_ingestion(self, results):
+        """Benchmark loading the data files, with and without the columnar cache of the CSV files"""
+
+        def clear_columnar_cache(path):
+            return lambda: _remove_dir(os.path.join(path, columnar_cache.CACHE_DIR_NAME))
+
+        def load_mini_runner_data():
+            opunit_data.get_mini_runner_data(self.mini_runner_file, self.results_path, 0, {}, {})
+
+        def load_pipeline_data():
+            grouped_op_unit_data.get_grouped_op_unit_data(self.pipeline_file, 0, 0, 0, 0)
+
+        for suite, fn, path, rows in [("MiniRunner", load_mini_runner_data, self.mini_runner_path,
+                                       self.mini_runner_rows),
+                                      ("Pipeline", load_pipeline_data, self.pipeline_path, self.pipeline_rows)]:
+            results.add("{}/Ingestion".format(suite), self.repetitions,
+                        _measure(fn, self.repetitions, clear_columnar_cache(path)), rows * self.repetitions)
+            results.add("{}/CachedIngestion".format(suite), self.repetitions, _measure(fn, self.repetitions),
+                        rows * self.repetitions)
+
+    def run_mini_trainer(self, results):
+        """Benchmark training the mini models on the mini-runner data with all the methods"""
+
+        def train():
+            trainer = MiniTrainer(self.mini_runner_path, self.results_path, self.methods, 0.2, 0.2, True, 0,
+                                  self.num_workers)
+            trainer.train()
+
+        results.add("MiniTrainer/Train", self.repetitions, _measure(train, self.repetitions),
+                    self.mini_runner_rows * self.repetitions, other_processes=True)
+
+    def run_model(self, results):
+        """Benchmark the training, the single-row predictions and the batched predictions of each method"""
+        single_x = [self.predict_x[i:i + 1] for i in range(self.num_predictions)]
+        batch_x = self.predict_x[:self.batch_size]
+
+        for method in self.methods:
+            regressor = model.Model(method)
+            results.add("Model/Train/{}".format(method), self.repetitions,
+                        _measure(lambda: regressor.train(self.train_x, self.train_y), self.repetitions),
+                        self.train_rows * self.repetitions)
+
+            variants = [""]
+            if regressor.compile():
+                variants.append("Compiled")
+            for variant in variants:
+                x_iter = iter(single_x)
+                results.add("Model/PredictSingle{}/{}".format(variant, method), self.num_predictions,
+                            _measure(lambda: regressor.predict(next(x_iter)), self.num_predictions),
+                            self.num_predictions, "us")
+                results.add("Model/PredictBatch{}/{}".format(variant, method), self.num_batches,
+                            _measure(lambda: regressor.predict(batch_x), self.num_batches),
+                            self.batch_size * self.num_batches, "us")
+
+            self._save_model_map(method, regressor)
+
+    def run_global_trainer(self, results):
+        """Benchmark constructing the global model data from the pipeline data (predicted with the mini models of the
+        first method), and training the global models with each method"""
+        if self.pipeline_rows < MIN_GLOBAL_TRAINER_PIPELINE_ROWS:
+            raise ValueError("The global trainer needs at least {} pipeline rows to train with ({} given)".format(
+                MIN_GLOBAL_TRAINER_PIPELINE_ROWS, self.pipeline_rows))
+        trainer = GlobalTrainer(self.pipeline_path, self.results_path, self.methods, 0.2, 0.1,
+                                self._get_model_map(self.methods[0]), 0, False, False, False, 0, 0, 0,
+                                self.num_workers)
+
+        def clear_caches():
+            _remove_dir(os.path.join(self.pipeline_path, columnar_cache.CACHE_DIR_NAME))
+            _remove_dir(os.path.join(self.pipeline_path, global_data_cache.CACHE_DIR_NAME))
+
+        results.add("GlobalTrainer/PredictOuData", self.repetitions,
+                    _measure(trainer.predict_ou_data, self.repetitions, clear_caches),
+                    self.pipeline_rows * self.repetitions, other_processes=True)
+
+        for method in self.methods:
+            trainer.ml_models = [method]
+            results.add("GlobalTrainer/Train/{}".format(method), self.repetitions,
+                        _measure(trainer.train, self.repetitions), self.pipeline_rows * self.repetitions,
+                        other_processes=True)
+
+    def run_model_server(self, results):
+        """Benchmark the round trips of the single-row and batched inference requests to a ModelServer subprocess
+
+        Every request has new rows, so that the predictions are not served from the prediction cache of the ModelServer.
+        """
+        # Imported here since importing model_server initializes the logging
+        from model_server import Message
+
+        rng = np.random.default_rng(2)
+        opunits = synthetic_data_util.OPUNITS
+
+        def make_batch(binary):
+            # A batch has a group of rows for each opunit
+            groups = np.array_split(_generate_predict_x(rng, self.batch_size), len(opunits))
+            if not binary:
+                return [{"features": x.tolist(), "opunit": opunit.name} for x, opunit in zip(groups, opunits)], []
+            return ([{"features": {Message.FRAME_KEY: i, "shape": list(x.shape)}, "opunit": opunit.name}
+                     for i, (x, opunit) in enumerate(zip(groups, opunits))],
+                    [np.ascontiguousarray(x, dtype=Message.FRAME_DTYPE) for x in groups])
+
+        client = ModelServerClient(os.path.join(self.work_path, "model_server_ipc"), self.server_timeout_ms)
+        try:
+            for method in self.methods:
+                self._get_model_map(method)
+                model_path = self._get_model_map_file(method)
+
+                # Load the model map into the ModelServer cache before measuring
+                client.request("INFER", {"features": _generate_predict_x(rng, 1).tolist(), "opunit": opunits[0].name,
+                                         "model_path": model_path})
+
+                requests = iter([{"features": x.reshape(1, -1).tolist(), "opunit": opunits[i % len(opunits)].name,
+                                  "model_path": model_path}
+                                 for i, x in enumerate(_generate_predict_x(rng, self.num_predictions))])
+                results.add("ModelServer/Infer/{}".format(method), self.num_predictions,
+                            _measure(lambda: client.request("INFER", next(requests)), self.num_predictions),
+                            self.num_predictions, "us", other_processes=True)
+
+                for test, wire_format in [("InferBatch", "JSON"), ("InferBatchBinary", "BINARY")]:
+                    batches = iter([make_batch(wire_format == "BINARY") for _ in range(self.num_batches)])
+
+                    def infer_batch():
+                        batch, frames = next(batches)
+                        client.request("INFER_BATCH", {"requests": batch, "model_path": model_path}, wire_format,
+                                       frames)
+
+                    results.add("ModelServer/{}/{}".format(test, method), self.num_batches,
+                                _measure(infer_batch, self.num_batches), self.batch_size * self.num_batches, "us",
+                                other_processes=True)
+        finally:
+            client.close()
+
+    def run_retrain_incremental(self, results):
+        """Benchmark the RETRAIN_INCREMENTAL job of the ModelServer on a sharded model store, with the methods that new
+        opunits are trained with and the methods that support incremental training
+
+        Every iteration starts from a newly saved store, and the updated store is loaded back and checked to predict all
+        the opunits, so a method that cannot round trip through the store fails the benchmark. The store is also
+        retrained with a batch of only pipeline execution data (multiple opunits per row), whose other opunits fall
+        back to the stored models.
+        """
+        # Imported here since importing model_server initializes the logging
+        from model_server import ModelServer, _retrain_incremental_job
+
+        opunits = synthetic_data_util.OPUNITS
+        pipeline_path = os.path.join(self.work_path, "mini_runner_pipeline_input")
+        os.makedirs(pipeline_path, exist_ok=True)
+        synthetic_data_util.write_pipeline_data(pipeline_path, self.mini_runner_rows,
+                                                filename=synthetic_data_util.MINI_RUNNER_PIPELINE_FILE,
+                                                distinct_opunits=True)
+        for method in dict.fromkeys(ModelServer.INCREMENTAL_METHODS + INCREMENTAL_TRAINING_METHODS):
+            regressor = model.Model(method)
+            regressor.train(self.train_x, self.train_y)
+            store_path = os.path.join(self.work_path, "mini_model_store_{}".format(method))
+
+            def save_store():
+                _remove_dir(store_path)
+                model_store.save_model_store(store_path, {opunit: regressor for opunit in opunits},
+                                             data_info.instance)
+
+            def retrain(seq_files=self.mini_runner_path):
+                succeeded, error = _retrain_incremental_job(method, {"save_path": store_path, "seq_files": seq_files},
+                                                            self.results_path, {})
+                if not succeeded:
+                    raise RuntimeError("RETRAIN_INCREMENTAL of {} on {} failed with {}".format(method, seq_files,
+                                                                                             error))
+
+            def check_store():
+                model_map, _ = model_store.load_model_map(store_path)
+                for opunit in opunits:
+                    y_pred = model_map[opunit].predict(self.predict_x)
+                    if y_pred.shape != (len(self.predict_x), self.train_y.shape[1]) or not np.isfinite(y_pred).all():
+                        raise RuntimeError("The retrained {} model of {} does not predict".format(method, opunit.name))
+
+            results.add("ModelServer/RetrainIncremental/{}".format(method), self.repetitions,
+                        _measure(retrain, self.repetitions, save_store), self.mini_runner_rows * self.repetitions,
+                        other_processes=True)
+            check_store()
+
+            save_store()
+            retrain(pipeline_path)
+            check_store()
+
+
+# ==============================================
+# main
+# ==============================================
+if __name__ == '__main__':
+    aparser = argparse.ArgumentParser(description='Model Benchmark')
+    aparser.add_argument('--output', default='model_benchmark.json', help='File to write the benchmark results')
+    aparser.add_argument('--work_path', default=None,
+                         help='Directory to generate the data in (defaults to a temporary directory)')
+    aparser.add_argument('--benchmarks', nargs='*', type=str, default=BENCHMARKS, choices=BENCHMARKS,
+                         help='Benchmarks to run')
+    aparser.add_argument('--ml_models', nargs='*', type=str, default=["lr", "rf", "gbm"],
+                         help='ML models to benchmark')
+    aparser.add_argument('--mini_runner_rows', type=int, default=100000,
+                         help='Number of rows of the synthetic mini-runner data')
+    aparser.add_argument('--pipeline_rows', type=int, default=100000,
+                         help='Number of rows of the synthetic pipeline data')
+    aparser.add_argument('--train_rows', type=int, default=10000, help='Number of rows to train the models with')
+    aparser.add_argument('--num_predictions', type=int, default=1000,
+                         help='Number of the single-row predictions (and requests) to measure')
+    aparser.add_argument('--batch_size', type=int, default=1000,
+                         help='Number of rows of a batched prediction (and request)')
+    aparser.add_argument('--num_batches', type=int, default=100,
+                         help='Number of the batched predictions (and requests) to measure')
+    aparser.add_argument('--repetitions', type=int, default=3,
+                         help='Number of iterations of the ingestion and training benchmarks')
+    aparser.add_argument('--num_workers', type=int, default=None,
+                         help='Number of worker processes of the trainers (defaults to the number of CPUs)')
+    aparser.add_argument('--server_timeout_ms', type=int, default=60000,
+                         help='How long to wait for a reply of the ModelServer')
+    aparser.add_argument('--log', default='info', help='The logging level')
+    args = aparser.parse_args()
+    if "global_trainer" in args.benchmarks and args.pipeline_rows < MIN_GLOBAL_TRAINER_PIPELINE_ROWS:
+        aparser.error("--pipeline_rows should be at least {} to benchmark the global trainer".format(
+            MIN_GLOBAL_TRAINER_PIPELINE_ROWS))
+
+    logging_util.init_logging(args.log)
+
+    with tempfile.TemporaryDirectory() as tmp_path:
+        benchmark = ModelBenchmark(args.work_path or tmp_path, args.ml_models, args.mini_runner_rows,
+                                   args.pipeline_rows, args.train_rows, args.num_predictions, args.batch_size,
+                                   args.num_batches, args.repetitions, args.num_workers, args.server_timeout_ms)
+        benchmark_results = BenchmarkResults({key: value for key, value in vars(args).items()
+                                              if key not in ("output", "work_path", "log")})
+        for name in args.benchmarks:
+            getattr(benchmark, "run_" + name)(benchmark_results)
+
+    benchmark_results.write(args.output)
+    logging.info("Benchmark results written to {}".format(args.output))
@@ -28,6 +28,10 @@ import logging
 import os
 import pprint
 import pickle
+import time
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
 from pathlib import Path
 
 import numpy as np
@@ -35,6 +39,7 @@ import zmq
 
 from data_class import opunit_data
 from mini_trainer import MiniTrainer
+import model_store
 from util import logging_util
 from type import OpUnit
 from info import data_info
@@ -60,6 +65,10 @@ class Command(Enum):
     QUIT = auto()       # Quit the server
     PRINT = auto()      # Print the message
     INFER = auto()      # Do inference on a trained model
+    INFER_BATCH = auto()  # Do inference on a trained model for multiple opunits at once
+    STATUS = auto()     # Report the status of the training jobs
+    STATS = auto()      # Report the model map cache statistics
+    RETRAIN_INCREMENTAL = auto()  # Update a trained model map with new data
 
     def __str__(self) -> str:
         return self.name
@@ -74,10 +83,39 @@ class Command(Enum):
             return Command.TRAIN
         elif cmd_str == "INFER":
             return Command.INFER
+        elif cmd_str == "INFER_BATCH":
+            return Command.INFER_BATCH
+        elif cmd_str == "STATUS":
+            return Command.STATUS
+        elif cmd_str == "STATS":
+            return Command.STATS
+        elif cmd_str == "RETRAIN_INCREMENTAL":
+            return Command.RETRAIN_INCREMENTAL
         else:
             raise ValueError("Invalid command")
 
 
+class WireFormat(Enum):
+    """
+    How matrices (features and predictions) are carried in a message.
+    A request selects the format with its optional "format" field, and the reply uses the same format.
+    """
+    JSON = auto()       # Matrices are nested lists inside the JSON payload (default)
+    BINARY = auto()     # Matrices are raw little-endian float64 buffers in trailing ZMQ frames
+
+    def __str__(self) -> str:
+        return self.name
+
+    @staticmethod
+    def from_str(fmt_str: str) -> WireFormat:
+        if fmt_str == "JSON":
+            return WireFormat.JSON
+        elif fmt_str == "BINARY":
+            return WireFormat.BINARY
+        else:
+            raise ValueError("Invalid wire format")
+
+
 class Message:
     """
     Message struct for communication with the ModelServer.
@@ -85,34 +123,497 @@ class Message:
     A valid message is :
         "send_id-recv_id-payload"
 
+    With the BINARY wire format, the payload frame is followed by one extra ZMQ frame per matrix, and each matrix
+    in the payload is replaced by a reference of {"__frame__": <index of the trailing frame>, "shape": [rows, cols]}.
+
     Refer to Messenger's documention for the message format
     """
 
+    # Key of a matrix reference to a trailing frame in the BINARY wire format
+    FRAME_KEY = "__frame__"
+
+    # Data type of the matrices in the BINARY wire format
+    FRAME_DTYPE = np.dtype("<f8")
+
     def __init__(self, cmd: Optional[Command] = None,
-                 data: Optional[Dict] = None) -> None:
+                 data: Optional[Dict] = None,
+                 wire_format: WireFormat = WireFormat.JSON) -> None:
         self.cmd = cmd
         self.data = data
+        self.wire_format = wire_format
 
     @staticmethod
-    def from_json(json_str: str) -> Message:
-        d = json.loads(json_str)
+    def from_json(json_str: str, frames: Optional[List] = None) -> Message:
         msg = Message()
         try:
+            d = json.loads(json_str)
             msg.cmd = Command.from_str(d["cmd"])
-            msg.data = d["data"]
-        except (KeyError, ValueError) as e:
+            msg.wire_format = WireFormat.from_str(d.get("format", "JSON"))
+            msg.data = Message._decode_frames(d["data"], frames or [])
+        except (KeyError, ValueError, IndexError, TypeError) as e:
             logging.error(f"Invalid Message : {json_str}")
             return None
 
         return msg
 
     def to_json(self) -> str:
-        return json.dumps(self.__dict__)
+        return json.dumps({"cmd": str(self.cmd), "data": self.data, "format": str(self.wire_format)},
+                          default=Message._json_default)
+
+    @staticmethod
+    def _json_default(obj: Any) -> Any:
+        """
+        Serialize the numpy objects that json does not know about
+        :param obj: object to serialize
+        :return: JSON serializable object
+        """
+        if isinstance(obj, (np.ndarray, np.generic)):
+            return obj.tolist()
+        raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+    @staticmethod
+    def _decode_frames(data: Any, frames: List) -> Any:
+        """
+        Replace the matrix references in the data with arrays viewing the trailing frames (without copying)
+        :param data: decoded JSON data
+        :param frames: buffers of the trailing frames
+        :return: data with the references replaced
+        """
+        if isinstance(data, dict):
+            if Message.FRAME_KEY in data:
+                index = data[Message.FRAME_KEY]
+                # bool is a subclass of int
+                if not isinstance(index, int) or isinstance(index, bool) or not 0 <= index < len(frames):
+                    raise ValueError(f"Invalid frame index {index} of {len(frames)} frames")
+                buf = frames[index]
+                shape = data["shape"]
+                if (not isinstance(shape, list) or
+                        not all(isinstance(n, int) and not isinstance(n, bool) and n >= 0 for n in shape)):
+                    raise ValueError(f"Invalid frame shape {shape}")
+                shape = tuple(shape)
+                if np.prod(shape) * Message.FRAME_DTYPE.itemsize != len(buf):
+                    raise ValueError(f"Frame size {len(buf)} does not match shape {shape}")
+                return np.frombuffer(buf, dtype=Message.FRAME_DTYPE).reshape(shape)
+            return {k: Message._decode_frames(v, frames) for k, v in data.items()}
+        if isinstance(data, list):
+            return [Message._decode_frames(v, frames) for v in data]
+        return data
+
+    @staticmethod
+    def _encode_frames(data: Any, frames: List) -> Any:
+        """
+        Replace the arrays in the data with references to trailing frames, appending their buffers to frames
+        :param data: data to send
+        :param frames: output list of the trailing frame buffers
+        :return: JSON serializable data with the references
+        """
+        if isinstance(data, np.ndarray):
+            arr = np.ascontiguousarray(data, dtype=Message.FRAME_DTYPE)
+            frames.append(arr)
+            return {Message.FRAME_KEY: len(frames) - 1, "shape": list(arr.shape)}
+        if isinstance(data, dict):
+            return {k: Message._encode_frames(v, frames) for k, v in data.items()}
+        if isinstance(data, (list, tuple)):
+            return [Message._encode_frames(v, frames) for v in data]
+        return data
 
     def __str__(self) -> str:
         return pprint.pformat(self.__dict__)
 
 
+class PredictionCache:
+    """
+    LRU cache of the predictions of a model map, keyed by (opunit, feature row rounded to a number of decimals).
+
+    The cache belongs to the ModelMapCache entry of the model map, so the cached predictions are dropped together
+    with the model map when it is reloaded, retrained, or evicted.
+    """
+
+    def __init__(self, max_rows: int, decimals: int) -> None:
+        """
+        :param max_rows: maximum number of cached prediction rows
+        :param decimals: number of decimals that the feature rows are rounded to for the cache key
+        """
+        self._max_rows = max_rows
+        self._decimals = decimals
+        # (opunit, rounded feature row bytes) -> prediction row
+        self._entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def predict(self, opunit: OpUnit, model: Any, features: np.ndarray) -> np.ndarray:
+        """
+        Predict the feature rows with the model, only calling the model for the rows that are not cached
+        :param opunit: opunit of the model
+        :param model: the model of the opunit
+        :param features: 2D feature array
+        :return: the predictions of the rows
+        """
+        if self._max_rows <= 0 or features.ndim != 2 or features.shape[0] == 0:
+            return model.predict(features)
+
+        # Adding 0.0 turns -0.0 into 0.0 so that they share the key
+        rounded = np.ascontiguousarray(np.round(features, self._decimals) + 0.0)
+
+        # Deduplicate the rows at once (viewing each row as a single opaque value), so that the cache is only looked
+        # up once per distinct row
+        row_dtype = np.dtype((np.void, rounded.dtype.itemsize * rounded.shape[1]))
+        unique_rows, first_indexes, inverse, row_counts = np.unique(rounded.view(row_dtype).ravel(), return_index=True,
+                                                                    return_inverse=True, return_counts=True)
+        inverse = inverse.ravel()
+
+        # Visit the distinct rows in the order of their first appearance
+        order = np.argsort(first_indexes)
+        y_unique = [None] * len(unique_rows)
+        missing = []
+        missing_keys = []
+        for u, row_bytes in zip(order.tolist(), unique_rows[order].tolist()):
+            key = (opunit, row_bytes)
+            y = self._entries.get(key)
+            if y is not None:
+                self._entries.move_to_end(key)
+                y_unique[u] = y
+            else:
+                missing.append(u)
+                missing_keys.append(key)
+        num_missing = int(row_counts[missing].sum())
+        self.hits += features.shape[0] - num_missing
+        self.misses += num_missing
+
+        if len(missing) > 0:
+            # Predict each distinct missing row once
+            y_pred = model.predict(features[first_indexes[missing]])
+            for u, key, y in zip(missing, missing_keys, y_pred):
+                y = y.copy()
+                y_unique[u] = y
+                self._entries[key] = y
+            while len(self._entries) > self._max_rows:
+                self._entries.popitem(last=False)
+
+        return np.stack(y_unique)[inverse]
+
+
+class ModelMapCache:
+    """
+    LRU cache of the model maps loaded from disk, keyed by the save path.
+
+    The save path is either a single pickle file or a sharded model store directory, whose models are only loaded
+    when an opunit is queried (see model_store.ModelStore).
+
+    An entry is only served while the file at the save path (or the store manifest) has the same mtime and inode as
+    when it was loaded, so a model map replaced on disk by another process is reloaded. The size of the saved models
+    (only of the models loaded so far for a model store) is used as the estimate of an entry's memory, and the least
+    recently used entries are evicted once the memory budget is exceeded.
+
+    Each entry also holds the PredictionCache of its model map.
+    """
+
+    def __init__(self, budget_bytes: int, compile_models: bool = False, prediction_cache_rows: int = 0,
+                 prediction_cache_decimals: int = 6) -> None:
+        """
+        :param budget_bytes: memory budget for the cached model maps
+        :param compile_models: whether to compile the loaded models for fast inference (see Model.compile)
+        :param prediction_cache_rows: maximum number of cached prediction rows per model map (0 to disable)
+        :param prediction_cache_decimals: number of decimals that the features are rounded to for the prediction cache
+        """
+        self._budget_bytes = budget_bytes
+        self._compile_models = compile_models
+        self._prediction_cache_rows = prediction_cache_rows
+        self._prediction_cache_decimals = prediction_cache_decimals
+        self._used_bytes = 0
+        # save path string -> (model map, size, (mtime_ns, inode), PredictionCache)
+        self._entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+        self.load_time = 0.0
+        # Prediction cache counters of the entries that have been removed
+        self._removed_prediction_hits = 0
+        self._removed_prediction_misses = 0
+
+    @staticmethod
+    def _file_version(stat: os.stat_result) -> Tuple[int, int]:
+        return stat.st_mtime_ns, stat.st_ino
+
+    def get(self, save_path: Path) -> Optional[Dict]:
+        """
+        Get the model map saved at the path, loading it from disk if it is not cached or stale
+        :param save_path: path to the model map
+        :return: None if no model map exists at path, or the model map
+        """
+        key = str(save_path)
+        version_path = save_path / model_store.MANIFEST_FILE if save_path.is_dir() else save_path
+        try:
+            stat = version_path.stat()
+        except FileNotFoundError:
+            self._remove(key)
+            return None
+
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[2] == self._file_version(stat):
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return entry[0]
+            # Replaced on disk since loaded
+            self.invalidations += 1
+            self._remove(key)
+
+        self.misses += 1
+        start = time.perf_counter()
+        if model_store.is_model_store(save_path):
+            model_map = model_store.ModelStore(
+                save_path, self._compile_models,
+                on_load=lambda model_size: self._add_loaded_bytes(key, model_map, model_size))
+            data_info.instance = model_map.data_info
+            size = model_map.size()
+        else:
+            with save_path.open(mode='rb') as f:
+                model_map, data_info.instance = pickle.load(f)
+            size = stat.st_size
+            if self._compile_models:
+                for model in model_map.values():
+                    model.compile()
+        self.load_time += time.perf_counter() - start
+
+        self._insert(key, model_map, size, stat)
+        return model_map
+
+    def predictions(self, save_path: Path) -> Optional[PredictionCache]:
+        """
+        Get the prediction cache of the model map cached for the path (call get first to load or refresh it)
+        :param save_path: path to the model map
+        :return: None if the model map is not cached, or its prediction cache
+        """
+        entry = self._entries.get(str(save_path))
+        return entry[3] if entry is not None else None
+
+    def reload(self, save_path: Path) -> Optional[Dict]:
+        """
+        Replace the cached model map with the one that was just saved at the path
+        :param save_path: path to the model map
+        :return: None if no model map exists at path, or the model map
+        """
+        self._remove(str(save_path))
+        return self.get(save_path)
+
+    def _insert(self, key: str, model_map: Dict, size: int, stat: os.stat_result) -> None:
+        prediction_cache = PredictionCache(self._prediction_cache_rows, self._prediction_cache_decimals)
+        self._entries[key] = (model_map, size, self._file_version(stat), prediction_cache)
+        self._used_bytes += size
+        self._evict()
+
+    def _add_loaded_bytes(self, key: str, model_map: Dict, size: int) -> None:
+        """
+        Account for a model that a cached model store has just loaded
+        :param key: save path string of the entry
+        :param model_map: the model store
+        :param size: size of the loaded model (bytes)
+        """
+        entry = self._entries.get(key)
+        # The store may have been evicted or replaced since
+        if entry is None or entry[0] is not model_map:
+            return
+        self._entries[key] = (model_map, entry[1] + size, entry[2], entry[3])
+        self._used_bytes += size
+        self._evict()
+
+    def _evict(self) -> None:
+        # Evict the least recently used entries, but always keep the most recently used one
+        while self._used_bytes > self._budget_bytes and len(self._entries) > 1:
+            evict_key = next(iter(self._entries))
+            logging.info(f"Evicting model map {evict_key} from the cache")
+            self._remove(evict_key)
+            self.evictions += 1
+
+    def _remove(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._used_bytes -= entry[1]
+            self._removed_prediction_hits += entry[3].hits
+            self._removed_prediction_misses += entry[3].misses
+
+    def stats(self) -> Dict:
+        """
+        :return: the counters of the cache
+        """
+        prediction_hits = self._removed_prediction_hits + sum(entry[3].hits for entry in self._entries.values())
+        prediction_misses = self._removed_prediction_misses + sum(entry[3].misses for entry in self._entries.values())
+        prediction_lookups = prediction_hits + prediction_misses
+        return {
+            "entries": len(self._entries),
+            "used_bytes": self._used_bytes,
+            "budget_bytes": self._budget_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+            "evictions": self.evictions,
+            "load_time": self.load_time,
+            "prediction_rows": sum(len(entry[3]) for entry in self._entries.values()),
+            "prediction_hits": prediction_hits,
+            "prediction_misses": prediction_misses,
+            "prediction_hit_rate": prediction_hits / prediction_lookups if prediction_lookups > 0 else 0.0
+        }
+
+
+class JobStatus(Enum):
+    """
+    Status of a training job submitted to the training worker pool
+    """
+    PENDING = auto()    # Waiting for an idle worker
+    RUNNING = auto()    # Being trained by a worker
+    FINISHED = auto()   # Trained, and the model map is swapped into the cache
+    FAILED = auto()     # Training failed
+
+    def __str__(self) -> str:
+        return self.name
+
+
+class TrainJob:
+    """
+    Book-keeping of a training job on the ModelServer side
+    """
+
+    def __init__(self, job_id: str, save_path: Path, future: Future, reply_id: Optional[int]) -> None:
+        """
+        :param job_id: id of the job returned to the ModelServerManager
+        :param save_path: path where the worker saves the trained model map
+        :param future: future of the training worker
+        :param reply_id: callback id to reply to once the job is done, or None if the TRAIN was replied right away
+        """
+        self.job_id = job_id
+        self.save_path = save_path
+        self.future = future
+        self.reply_id = reply_id
+        self.status = JobStatus.PENDING
+        self.err = ""
+        self.start_time = time.time()
+        self.end_time = None
+        # (number of files trained, total number of files) once the job is done
+        self.progress = None
+
+
+def _get_training_data_path(save_path: Path) -> Path:
+    """
+    :param save_path: path to a model map
+    :return: path to the cached training data of the model map (see MiniTrainer.get_training_data)
+    """
+    return save_path.with_name(str(save_path.stem) + "_training_data.pickle")
+
+
+def _save_model_map(save_path: Path, model_map: Dict, training_data: Dict, sharded: bool) -> None:
+    """
+    Save a trained model map and its training data.
+    The files are written to a temporary file first and then renamed, so readers never see a partial file.
+    :param save_path: path to save the model map at
+    :param model_map: the trained model map
+    :param training_data: the training data of the models, to refit them with in a later RETRAIN_INCREMENTAL
+    :param sharded: if True, save the model map as a sharded model store directory
+    """
+    # The training data is saved first, so that it is never older than the model map
+    training_data_path = _get_training_data_path(save_path)
+    tmp_path = training_data_path.with_name(training_data_path.name + ".tmp")
+    with tmp_path.open(mode='wb') as f:
+        pickle.dump(training_data, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, training_data_path)
+
+    if sharded:
+        # One file per opunit, so that the ModelServer only loads the queried opunits
+        model_store.save_model_store(save_path, model_map, data_info.instance)
+    else:
+        # Pickle dump the model
+        tmp_path = save_path.with_name(save_path.name + ".tmp")
+        with tmp_path.open(mode='wb') as f:
+            pickle.dump((model_map, data_info.instance), f)
+        os.replace(tmp_path, save_path)
+
+
+def _make_trainer(seq_files: str, result_path: Path, methods: List[str]) -> MiniTrainer:
+    # Share the CPUs between the concurrent training jobs
+    num_workers = max(1, (os.cpu_count() or 1) // ModelServer.TRAIN_POOL_SIZE)
+    return MiniTrainer(seq_files, result_path, methods, ModelServer.TEST_RATIO, ModelServer.TRIM_RATIO,
+                       ModelServer.EXPOSE_ALL, ModelServer.TXN_SAMPLE_INTERVAL, num_workers)
+
+
+def _train_job(job_id: str, data: Dict, result_path: Path, progress: Dict) -> Tuple[bool, str]:
+    """
+    Train a model map in a training worker process, and save it at the save path.
+    :param job_id: id of the job
+    :param data: TRAIN command data (see ModelServer._train_model)
+    :param result_path: directory for the model metric results
+    :param progress: shared map from job id to (number of files trained, total number of files)
+    :return: if training succeeds, {True and empty string}, else {False, error message}
+    """
+    def report_progress(done: int, total: int) -> None:
+        progress[job_id] = (done, total)
+
+    save_path = Path(data["save_path"])
+    try:
+        trainer = _make_trainer(data["seq_files"], result_path, data["methods"])
+        # Perform training from MiniTrainer and input files directory
+        model_map = trainer.train(report_progress)
+        _save_model_map(save_path, model_map, trainer.get_training_data(), data.get("sharded", False))
+    except ValueError as e:
+        logging.error(f"Model Not found : {e}")
+        return False, "FAIL_MODEL_NOT_FOUND"
+    except KeyError as e:
+        logging.error(f"Data format wrong for TRAIN: {e}")
+        return False, "FAIL_DATA_FORMAT_ERROR"
+    except Exception as e:
+        logging.error(f"Training failed. {e}")
+        return False, "FAIL_TRAINING_FAILED"
+
+    return True, ""
+
+
+def _retrain_incremental_job(job_id: str, data: Dict, result_path: Path, progress: Dict) -> Tuple[bool, str]:
+    """
+    Update the model map saved at the save path with new data in a training worker process, and replace it.
+    The model map that the ModelServer serves is untouched until the updated one is swapped in.
+    :param job_id: id of the job
+    :param data: RETRAIN_INCREMENTAL command data (see ModelServer._retrain_incremental)
+    :param result_path: directory for the model metric results
+    :param progress: shared map from job id to (number of files trained, total number of files)
+    :return: if retraining succeeds, {True and empty string}, else {False, error message}
+    """
+    def report_progress(done: int, total: int) -> None:
+        progress[job_id] = (done, total)
+
+    save_path = Path(data["save_path"])
+    try:
+        sharded = data.get("sharded", model_store.is_model_store(save_path))
+        # The models of a sharded model store are loaded into writable copies, since the incremental training updates
+        # their arrays in place (e.g., the weights of nn)
+        model_map, data_info.instance = model_store.load_model_map(save_path, writable=True)
+
+        training_data = None
+        training_data_path = _get_training_data_path(save_path)
+        if training_data_path.exists():
+            with training_data_path.open(mode='rb') as f:
+                training_data = pickle.load(f)
+
+        trainer = _make_trainer(data["seq_files"], result_path, data.get("methods", ModelServer.INCREMENTAL_METHODS))
+        model_map = trainer.train_incremental(model_map, training_data, report_progress)
+        _save_model_map(save_path, model_map, trainer.get_training_data(), sharded)
+    except ValueError as e:
+        logging.error(f"Model Not found : {e}")
+        return False, "FAIL_MODEL_NOT_FOUND"
+    except KeyError as e:
+        logging.error(f"Data format wrong for RETRAIN_INCREMENTAL: {e}")
+        return False, "FAIL_DATA_FORMAT_ERROR"
+    except Exception as e:
+        logging.error(f"Incremental retraining failed. {e}")
+        return False, "FAIL_TRAINING_FAILED"
+
+    return True, ""
+
+
 class ModelServer:
     """
     ModelServer(MS) class that runs in a loop to handle commands from the ModelServerManager from C++
@@ -124,10 +625,35 @@ class ModelServer:
     EXPOSE_ALL = True
     TXN_SAMPLE_INTERVAL = 49
 
-    def __init__(self, end_point: str) -> ModelServer:
+    # Methods to train the opunits that have no model yet with in RETRAIN_INCREMENTAL
+    INCREMENTAL_METHODS = ["lr", "rf", "gbm"]
+
+    # Number of worker processes for training
+    TRAIN_POOL_SIZE = 2
+
+    # Number of the most recent finished (or failed) training jobs that are kept to report with STATUS
+    MAX_DONE_TRAIN_JOBS = 100
+
+    # How long to wait for a message before checking the training jobs (ms)
+    POLL_TIMEOUT_MS = 100
+
+    # Default memory budget of the model map cache (bytes)
+    CACHE_BUDGET_BYTES = 4 * 1024 * 1024 * 1024
+
+    # Whether to compile the loaded models into the fast inference path (see Model.compile)
+    COMPILE_MODELS = True
+
+    # Maximum number of cached prediction rows per model map (0 to disable the prediction cache)
+    PREDICTION_CACHE_ROWS = 100000
+
+    # Number of decimals that the features are rounded to for the prediction cache keys
+    PREDICTION_CACHE_DECIMALS = 6
+
+    def __init__(self, end_point: str, cache_budget_bytes: int = CACHE_BUDGET_BYTES) -> ModelServer:
         """
         Initialize the ModelServer by connecting to the ZMQ IPC endpoint
         :param end_point:  IPC endpoint
+        :param cache_budget_bytes: memory budget of the model map cache
         """
         # Establish ZMQ connection
         self.context = zmq.Context()
@@ -141,11 +667,20 @@ class ModelServer:
         # If the ModelServer is closing
         self._closing = False
 
+        # Training worker pool. Workers are spawned rather than forked so that they do not inherit the ZMQ context.
+        mp_context = multiprocessing.get_context("spawn")
+        self._train_pool = ProcessPoolExecutor(max_workers=ModelServer.TRAIN_POOL_SIZE, mp_context=mp_context)
+        self._mp_manager = mp_context.Manager()
+        self._train_progress = self._mp_manager.dict()
+        self._train_jobs = dict()
+        self._next_job_id = 0
+
         # Register the exit callback
         atexit.register(self.cleanup_zmq)
 
         # Gobal model map cache
-        self.cache = dict()
+        self.cache = ModelMapCache(cache_budget_bytes, ModelServer.COMPILE_MODELS, ModelServer.PREDICTION_CACHE_ROWS,
+                                   ModelServer.PREDICTION_CACHE_DECIMALS)
 
         # Notify the ModelServerManager that I am connected
         self._send_msg(0, 0, ModelServer._make_response(
@@ -153,23 +688,32 @@ class ModelServer:
 
     def cleanup_zmq(self):
         """
-        Close the socket when the script exits
+        Close the socket and the training workers when the script exits
         :return:
         """
+        for job in self._train_jobs.values():
+            job.future.cancel()
+        self._train_pool.shutdown(wait=False)
+        self._mp_manager.shutdown()
         self.socket.close()
         self.context.destroy()
 
-    def _send_msg(self, send_id: int, recv_id: int, data: Dict) -> None:
+    def _send_msg(self, send_id: int, recv_id: int, data: Dict,
+                  wire_format: WireFormat = WireFormat.JSON) -> None:
         """
         Send a message to the socket.
         :param send_id: id on this end, 0 for now
         :param recv_id: callback id to invoke on the other end
         :param data: payload of the message in JSON
+        :param wire_format: how the matrices in the payload are sent
         :return:
         """
-        json_result = json.dumps(data)
+        frames = []
+        if wire_format == WireFormat.BINARY:
+            data = Message._encode_frames(data, frames)
+        json_result = json.dumps(data, default=Message._json_default)
         msg = f"{send_id}-{recv_id}-{json_result}"
-        self.socket.send_multipart([''.encode('utf-8'), msg.encode('utf-8')])
+        self.socket.send_multipart([''.encode('utf-8'), msg.encode('utf-8')] + frames, copy=False)
 
     @staticmethod
     def _make_response(action: Callback, result: Any, success: bool, err: str = "") -> Dict:
@@ -189,7 +733,7 @@ class ModelServer:
         }
 
     @staticmethod
-    def _parse_msg(payload: str) -> Tuple[int, int, Message]:
+    def _parse_msg(payload: str, frames: Optional[List] = None) -> Tuple[int, int, Message]:
         logging.debug("PY RECV: " + payload)
         tokens = payload.split('-', 2)
 
@@ -202,7 +746,7 @@ class ModelServer:
                 f"Invalid message payload format: {payload}, ids not int.")
             return -1, -1, None
 
-        msg = Message.from_json(tokens[2])
+        msg = Message.from_json(tokens[2], frames)
         return msg_id, recv_id, msg
 
     @staticmethod
@@ -218,22 +762,66 @@ class ModelServer:
         return [opunit_data.OpUnitData(
             OpUnit(x[0]), x[1][0], x[1][1]) for x in raw_data]
 
-    def _train_model(self, data: Dict) -> Tuple[bool, str]:
+    def _train_model(self, data: Dict, send_id: int) -> Tuple[bool, str]:
         """
-        Train a model with the given model name and seq_files directory
+        Submit a job to the training worker pool to train a model with the given model name and seq_files directory.
+        The model map in the cache keeps serving inference until the job finishes and the new one is swapped in.
         :param data: {
             methods: [lr, XXX, ...],
             seq_files: PATH_TO_SEQ_FILES_FOLDER, or None
             save_path: PATH_TO_SAVE_MODEL_MAP
+            sharded: (optional) if True, save the model map as a sharded model store directory at save_path
+            wait: (optional) if True, reply only once training is done instead of with the job id right away
+        }
+        :param send_id: callback id of the request to reply to
+        :return: if submitting succeeds, {True and the job id}, else {False, error message}
+        """
+        # Check the data format up-front, since the worker only reports failures later
+        _ml_models = data["methods"]
+        _seq_files_dir = data["seq_files"]
+        save_path = Path(data["save_path"])
+
+        return self._submit_train_job(_train_job, data, save_path, send_id)
+
+    def _retrain_incremental(self, data: Dict, send_id: int) -> Tuple[bool, str]:
+        """
+        Submit a job to the training worker pool to update a trained model map with only the new seq files.
+        Each opunit in the new data continues training from its current model if the method supports it (see
+        Model.train_incremental), and is otherwise refit on the cached training data of the model map together with
+        the new data. The updated model map atomically replaces the one at save_path, and is swapped into the cache.
+        :param data: {
+            seq_files: PATH_TO_NEW_SEQ_FILES_FOLDER
+            save_path: PATH_TO_TRAINED_MODEL_MAP
+            methods: (optional) methods to train the opunits without a model with (default INCREMENTAL_METHODS)
+            sharded: (optional) whether to save the model map as a sharded model store (default as it is saved)
+            wait: (optional) if True, reply only once retraining is done instead of with the job id right away
         }
-        :return: if training succeeds, {True and empty string}, else {False, error message}
+        :param send_id: callback id of the request to reply to
+        :return: if submitting succeeds, {True and the job id}, else {False, error message}
         """
-        ml_models = data["methods"]
-        seq_files_dir = data["seq_files"]
-        save_path = data["save_path"]
+        # Check the data format up-front, since the worker only reports failures later
+        _seq_files_dir = data["seq_files"]
+        save_path = Path(data["save_path"])
+
+        if not save_path.exists():
+            return False, "MODEL_MAP_NOT_TRAINED"
+        # Each update starts from the saved model map, so concurrent jobs on the same model map would lose updates
+        for job in self._train_jobs.values():
+            if job.save_path == save_path and job.status not in (JobStatus.FINISHED, JobStatus.FAILED):
+                return False, "FAIL_JOB_IN_PROGRESS"
 
+        return self._submit_train_job(_retrain_incremental_job, data, save_path, send_id)
+
+    def _submit_train_job(self, job_fn: Any, data: Dict, save_path: Path, send_id: int) -> Tuple[bool, str]:
+        """
+        Submit a training job to the training worker pool
+        :param job_fn: the job function (_train_job or _retrain_incremental_job)
+        :param data: command data of the job
+        :param save_path: path where the worker saves the trained model map
+        :param send_id: callback id of the request to reply to
+        :return: if submitting succeeds, {True and the job id}, else {False, error message}
+        """
         # Do path checking up-front
-        save_path = Path(save_path)
         save_dir = save_path.parent
         try:
             # Exist ok, and Creates parent if ok
@@ -247,22 +835,95 @@ class ModelServer:
             str(save_file_name) + "_metric_results")
         result_path.mkdir(parents=True, exist_ok=True)
 
-        test_ratio = ModelServer.TEST_RATIO
-        trim = ModelServer.TRIM_RATIO
-        expose_all = ModelServer.EXPOSE_ALL
-        txn_sample_interval = ModelServer.TXN_SAMPLE_INTERVAL
+        job_id = str(self._next_job_id)
+        self._next_job_id += 1
+        future = self._train_pool.submit(job_fn, job_id, data, result_path, self._train_progress)
+        reply_id = send_id if data.get("wait", False) else None
+        self._train_jobs[job_id] = TrainJob(job_id, save_path, future, reply_id)
+        logging.info(f"Submitted training job {job_id} for {str(save_path)}")
 
-        trainer = MiniTrainer(seq_files_dir, result_path, ml_models,
-                              test_ratio, trim, expose_all, txn_sample_interval)
-        # Perform training from MiniTrainer and input files directory
-        model_map = trainer.train()
-        self.cache[str(save_path)] = model_map
+        return True, job_id
 
-        # Pickle dump the model
-        with save_path.open(mode='wb') as f:
-            pickle.dump((model_map, data_info.instance), f)
+    def _reap_train_jobs(self) -> None:
+        """
+        Update the status of the training jobs. The model map of a finished job replaces the cached one, and the
+        deferred reply is sent for a job submitted with "wait". Only the MAX_DONE_TRAIN_JOBS most recent finished (or
+        failed) jobs are kept.
+        :return:
+        """
+        for job in self._train_jobs.values():
+            if job.status in (JobStatus.FINISHED, JobStatus.FAILED):
+                continue
+            if not job.future.done():
+                if job.future.running():
+                    job.status = JobStatus.RUNNING
+                continue
 
-        return True, ""
+            job.end_time = time.time()
+            job.progress = self._train_progress.pop(job.job_id, (0, 0))
+            try:
+                ok, err = job.future.result()
+            except Exception as e:
+                # The worker process died
+                logging.error(f"Training job {job.job_id} failed. {e}")
+                ok, err = False, "FAIL_TRAINING_FAILED"
+
+            if ok:
+                # Swap in the new model map. The old one keeps being used until it is replaced in the cache.
+                try:
+                    self.cache.reload(job.save_path)
+                except Exception as e:
+                    # A corrupt or partially written model map must not stop the server
+                    logging.error(f"Loading the model map of training job {job.job_id} failed. {e}")
+                    ok, err = False, "FAIL_MODEL_LOAD_ERROR"
+
+            if ok:
+                job.status = JobStatus.FINISHED
+                logging.info(f"Training job {job.job_id} finished in {job.end_time - job.start_time:.1f}s")
+            else:
+                job.status = JobStatus.FAILED
+                job.err = err
+
+            if job.reply_id is not None:
+                self._send_msg(0, job.reply_id, self._make_response(Callback.NOOP, "", ok, err))
+
+        # The jobs are in the submission order
+        done_job_ids = [job.job_id for job in self._train_jobs.values()
+                        if job.status in (JobStatus.FINISHED, JobStatus.FAILED)]
+        for job_id in done_job_ids[:max(0, len(done_job_ids) - ModelServer.MAX_DONE_TRAIN_JOBS)]:
+            del self._train_jobs[job_id]
+
+    def _job_status(self, data: Dict) -> Tuple[Dict, bool, str]:
+        """
+        Report the status of training jobs
+        :param data: {
+            job_id: (optional) id of the job to report, all the jobs are reported if not given (only the
+                    MAX_DONE_TRAIN_JOBS most recent finished or failed jobs are kept)
+        }
+        :return: {map from job id to {status, progress, elapsed seconds, save_path, err}, if succeeds, error message}
+        """
+        self._reap_train_jobs()
+
+        job_id = data.get("job_id") if isinstance(data, dict) else None
+        if job_id is None:
+            jobs = self._train_jobs.values()
+        elif job_id in self._train_jobs:
+            jobs = [self._train_jobs[job_id]]
+        else:
+            return {}, False, "INVALID_JOB_ID"
+
+        result = {}
+        for job in jobs:
+            end_time = job.end_time if job.end_time is not None else time.time()
+            result[job.job_id] = {
+                "status": str(job.status),
+                "progress": list(job.progress if job.progress is not None
+                                 else self._train_progress.get(job.job_id, (0, 0))),
+                "elapsed": end_time - job.start_time,
+                "save_path": str(job.save_path),
+                "err": job.err
+            }
+        return result, True, ""
 
     def _load_model_map(self, save_path: str) -> Optional[Dict]:
         """
@@ -273,38 +934,27 @@ class ModelServer:
         """
         save_path = Path(save_path)
 
-        # Check model exists
-        if not save_path.exists():
+        # Load from cache, or into cache if not cached or stale
+        model = self.cache.get(save_path)
+        if model is None:
             return None
 
-        # use the path string as the key of the cache
-        save_path_str = str(save_path)
-
-        # Load from cache
-        if self.cache.get(save_path_str, None) is not None:
-            return self.cache[save_path_str]
-
-        # Load into cache
-        with save_path.open(mode='rb') as f:
-            model, data_info.instance = pickle.load(f)
-
-            # TODO(ricky): model checking here?
-            if len(model) == 0:
-                logging.warning(f"Empty model at {str(save_path)}")
-                return None
+        # TODO(ricky): model checking here?
+        if len(model) == 0:
+            logging.warning(f"Empty model at {str(save_path)}")
+            return None
 
-            self.cache[save_path_str] = model
-            return model
+        return model
 
-    def _infer(self, data: Dict) -> Tuple[List, bool, str]:
+    def _infer(self, data: Dict) -> Tuple[np.ndarray, bool, str]:
         """
         Do inference on the model, give the data file, and the model_map_path
         :param data: {
-            features: 2D float arrays [[float]],
+            features: 2D float arrays [[float]] (or a frame reference with the BINARY wire format),
             opunit: Opunit integer for the model
             model_path: model path
         }
-        :return: {List of predictions, if inference succeeds, error message}
+        :return: {Array of predictions, if inference succeeds, error message}
         """
         features = data["features"]
         opunit = data["opunit"]
@@ -319,7 +969,7 @@ class ModelServer:
             logging.error(f"{opunit} is not a valid Opunit name")
             return [], False, "INVALID_OPUNIT"
 
-        features = np.array(features)
+        features = np.asarray(features, dtype=float)
         logging.debug(f"Using model on {opunit}")
 
         # Load the model map
@@ -335,30 +985,98 @@ class ModelServer:
             logging.error(f"Model for {opunit} doesn't exist")
             return [], False, "MODEL_NOT_FOUND"
 
-        y_pred = model.predict(features)
+        y_pred = self.cache.predictions(Path(model_path)).predict(opunit, model, features)
+
+        return y_pred, True, ""
+
+    def _infer_batch(self, data: Dict) -> Tuple[List[np.ndarray], bool, str]:
+        """
+        Do inference on the model for a batch of (opunit, features) groups in a single request.
+        Rows of the groups that share the same opunit are stacked and predicted with one call to the model.
+        :param data: {
+            requests: [{
+                features: 2D float arrays [[float]] (or a frame reference with the BINARY wire format),
+                opunit: Opunit name for the model
+            }, ...],
+            model_path: model path
+        }
+        :return: {List of prediction arrays for each group in the request order, if inference succeeds, error message}
+        """
+        requests = data["requests"]
+        model_path = data["model_path"]
+
+        # Parameter validation, and group the request indexes by opunit
+        opunit_groups = {}
+        opunit_widths = {}
+        features_list = []
+        for i, request in enumerate(requests):
+            opunit = request["opunit"]
+            if not isinstance(opunit, str):
+                return [], False, "INVALID_OPUNIT"
+            try:
+                opunit = OpUnit[opunit]
+            except KeyError as e:
+                logging.error(f"{opunit} is not a valid Opunit name")
+                return [], False, "INVALID_OPUNIT"
+
+            # The groups of an opunit are stacked, so they need to be 2D with the same number of columns
+            features = np.asarray(request["features"], dtype=float)
+            if features.ndim != 2:
+                logging.error(f"Features of request {i} are not 2D (shape {features.shape})")
+                return [], False, "FAIL_DATA_FORMAT_ERROR"
+            if opunit_widths.setdefault(opunit, features.shape[1]) != features.shape[1]:
+                logging.error(f"Features of request {i} have {features.shape[1]} columns instead of "
+                              f"{opunit_widths[opunit]} like the other features of {opunit.name}")
+                return [], False, "FAIL_DATA_FORMAT_ERROR"
+            features_list.append(features)
+            opunit_groups.setdefault(opunit, []).append(i)
+
+        # Load the model map
+        model_map = self._load_model_map(model_path)
+        if model_map is None:
+            logging.error(
+                f"Model map at {str(model_path)} has not been trained")
+            return [], False, "MODEL_MAP_NOT_TRAINED"
+
+        prediction_cache = self.cache.predictions(Path(model_path))
+        results = [None] * len(requests)
+        for opunit, indexes in opunit_groups.items():
+            model = model_map.get(opunit)
+            if model is None:
+                logging.error(f"Model for {opunit} doesn't exist")
+                return [], False, "MODEL_NOT_FOUND"
 
-        return y_pred.tolist(), True, ""
+            logging.debug(f"Using model on {opunit} for {len(indexes)} requests")
+            features = np.concatenate([features_list[i] for i in indexes], axis=0)
+            y_pred = prediction_cache.predict(opunit, model, features)
 
-    def _recv(self) -> str:
+            # Scatter the predictions back to each group in the request order
+            offsets = np.cumsum([features_list[i].shape[0] for i in indexes])[:-1]
+            for i, group_pred in zip(indexes, np.split(y_pred, offsets)):
+                results[i] = group_pred
+
+        return results, True, ""
+
+    def _recv(self) -> Tuple[str, List]:
         """
         Receive from the ZMQ socket. This is a blocking call.
 
-        :return: Message paylod
+        :return: Message paylod, and the buffers of any trailing binary frames
         """
-        identity = self.socket.recv()
-        _delim = self.socket.recv()
-        payload = self.socket.recv()
+        frames = self.socket.recv_multipart(copy=False)
+        identity, _delim, payload = frames[0].bytes, frames[1].bytes, frames[2].bytes
         logging.debug(f"Python recv: {str(identity)}, {str(payload)}")
 
-        return payload.decode("ascii")
+        return payload.decode("ascii"), [f.buffer for f in frames[3:]]
 
-    def _execute_cmd(self, cmd: Command, data: Dict) -> Tuple[Dict, bool]:
+    def _execute_cmd(self, cmd: Command, data: Dict, send_id: int) -> Tuple[Optional[Dict], bool]:
         """
         Execute a command from the ModelServerManager
         :param cmd:
         :param data:
+        :param send_id: callback id of the request on the other end
         :return: Tuple {
-            message string to sent back,
+            message string to sent back, or None if the reply is deferred,
             if continue the server
         }
         """
@@ -372,29 +1090,56 @@ class ModelServer:
             return self._make_response(Callback.NOOP, "", True), False
         elif cmd == Command.TRAIN:
             try:
-                ok, res = self._train_model(data)
+                ok, res = self._train_model(data, send_id)
                 if ok:
+                    if data.get("wait", False):
+                        # Replied by _reap_train_jobs once the training is done
+                        return None, True
                     response = self._make_response(Callback.NOOP, res, True)
                 else:
                     response = self._make_response(Callback.NOOP, "", False, res)
-            except ValueError as e:
-                logging.error(f"Model Not found : {e}")
-                response = self._make_response(
-                    Callback.NOOP, "", False, "FAIL_MODEL_NOT_FOUND")
             except KeyError as e:
                 logging.error(f"Data format wrong for TRAIN: {e}")
                 response = self._make_response(
                     Callback.NOOP, "", False, "FAIL_DATA_FORMAT_ERROR")
-            except Exception as e:
-                logging.error(f"Training failed. {e}")
+
+            return response, True
+        elif cmd == Command.RETRAIN_INCREMENTAL:
+            try:
+                ok, res = self._retrain_incremental(data, send_id)
+                if ok:
+                    if data.get("wait", False):
+                        # Replied by _reap_train_jobs once the retraining is done
+                        return None, True
+                    response = self._make_response(Callback.NOOP, res, True)
+                else:
+                    response = self._make_response(Callback.NOOP, "", False, res)
+            except KeyError as e:
+                logging.error(f"Data format wrong for RETRAIN_INCREMENTAL: {e}")
                 response = self._make_response(
-                    Callback.NOOP, "", False, "FAIL_TRAINING_FAILED")
+                    Callback.NOOP, "", False, "FAIL_DATA_FORMAT_ERROR")
 
+            return response, True
+        elif cmd == Command.STATUS:
+            result, ok, err = self._job_status(data)
+            response = self._make_response(Callback.NOOP, result, ok, err)
+            return response, True
+        elif cmd == Command.STATS:
+            response = self._make_response(Callback.NOOP, self.cache.stats(), True)
             return response, True
         elif cmd == Command.INFER:
             result, ok, err = self._infer(data)
             response = self._make_response(Callback.NOOP, result, ok, err)
             return response, True
+        elif cmd == Command.INFER_BATCH:
+            try:
+                result, ok, err = self._infer_batch(data)
+            except (KeyError, ValueError, TypeError) as e:
+                # e.g., features that are not a numeric matrix
+                logging.error(f"Data format wrong for INFER_BATCH: {e}")
+                result, ok, err = [], False, "FAIL_DATA_FORMAT_ERROR"
+            response = self._make_response(Callback.NOOP, result, ok, err)
+            return response, True
 
     def run_loop(self):
         """
@@ -404,7 +1149,10 @@ class ModelServer:
 
         while(1):
             try:
-                payload = self._recv()
+                if not self.socket.poll(ModelServer.POLL_TIMEOUT_MS):
+                    self._reap_train_jobs()
+                    continue
+                payload, frames = self._recv()
             except UnicodeError as e:
                 logging.warning(f"Failed to decode : {e.reason}")
                 continue
@@ -417,18 +1165,20 @@ class ModelServer:
                     self._closing = True
                     continue
 
-            send_id, recv_id, msg = self._parse_msg(payload)
+            send_id, recv_id, msg = self._parse_msg(payload, frames)
             if msg is None:
                 continue
             else:
-                result, cont = self._execute_cmd(msg.cmd, msg.data)
+                self._reap_train_jobs()
+                result, cont = self._execute_cmd(msg.cmd, msg.data, send_id)
                 if not cont:
                     logging.info("Shutting down.")
                     break
 
                 # Currently not expecting to invoke any callback on ModelServer
                 # side, so second parameter 0
-                self._send_msg(0, send_id, result)
+                if result is not None:
+                    self._send_msg(0, send_id, result, msg.wire_format)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,192 @@
+"""Sharded on-disk store for the mini model maps.
+
+A store is a directory with one pickle file per opunit model plus a small JSON manifest, so that a reader only needs
+to load the opunits that it actually uses. The numpy buffers of a model are pickled out-of-band (pickle protocol 5)
+into a separate file, which is memory-mapped when the model is loaded instead of being copied into the heap.
+
+The manifest is written last and atomically replaced, so a reader always sees a complete version of the store. The
+files of the previous version are kept when a new version is saved, so that a reader that opened the previous manifest
+can still load the opunits that it has not loaded yet. Older versions are removed.
+"""
+
+import json
+import mmap
+import os
+import pickle
+import re
+import time
+from collections.abc import Mapping
+from pathlib import Path
+
+from type import OpUnit
+
+# Name of the manifest file in the store directory
+MANIFEST_FILE = "manifest.json"
+
+# Alignment of the out-of-band buffers in the buffer file (bytes)
+_BUFFER_ALIGNMENT = 64
+
+# Names of the versioned files of a store: <opunit>.<version>.{pickle,buffers} and data_info.<version>.pickle
+_VERSIONED_FILE_PATTERN = re.compile(r"^(?P<name>[a-z0-9_]+)\.(?P<version>[0-9a-f]+)\.(pickle|buffers)$")
+_VERSIONED_FILE_NAMES = {opunit.name.lower() for opunit in OpUnit} | {"data_info"}
+
+
+def is_model_store(path):
+    """Check whether the path is a sharded model store
+
+    :param path: the path to check
+    :return: True if the path is a store directory
+    """
+    return (Path(path) / MANIFEST_FILE).is_file()
+
+
+def save_model_store(path, model_map, data_info_instance):
+    """Save the model map as a sharded model store (replacing the previous version of the store if it exists)
+
+    :param path: the store directory
+    :param model_map: the map from OpUnit to the mini model
+    :param data_info_instance: the DataInfo that the models are trained with
+    """
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    version = "{:x}".format(time.time_ns())
+    previous_version = None
+    if is_model_store(path):
+        with open(path / MANIFEST_FILE, "r") as f:
+            previous_version = json.load(f)["version"]
+
+    shards = {}
+    for opunit, model in model_map.items():
+        name = "{}.{}".format(opunit.name.lower(), version)
+        buffers = []
+
+        def collect_buffer(buf):
+            try:
+                buffers.append(buf.raw())
+            except BufferError:
+                # Non-contiguous buffers are kept in-band
+                return True
+            return False
+
+        payload = pickle.dumps(model, protocol=5, buffer_callback=collect_buffer)
+
+        offsets = []
+        with open(path / (name + ".buffers"), "wb") as f:
+            for buf in buffers:
+                f.write(b"\0" * (-f.tell() % _BUFFER_ALIGNMENT))
+                offsets.append((f.tell(), buf.nbytes))
+                f.write(buf)
+        with open(path / (name + ".pickle"), "wb") as f:
+            f.write(payload)
+
+        shards[opunit.name] = {"pickle": name + ".pickle", "buffers": name + ".buffers", "offsets": offsets,
+                               "size": len(payload) + sum(size for _, size in offsets)}
+
+    data_info_file = "data_info.{}.pickle".format(version)
+    with open(path / data_info_file, "wb") as f:
+        pickle.dump(data_info_instance, f)
+
+    manifest = {"version": version, "data_info": data_info_file, "opunits": shards}
+    tmp_manifest = path / (MANIFEST_FILE + ".tmp")
+    with open(tmp_manifest, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_manifest, path / MANIFEST_FILE)
+
+    # Remove the store files of the versions before the previous one (the other files in the directory are not
+    # touched). Readers that already mapped them keep them alive until closed.
+    for file in path.iterdir():
+        match = _VERSIONED_FILE_PATTERN.match(file.name)
+        if (match is not None and match.group("name") in _VERSIONED_FILE_NAMES and
+                match.group("version") not in (version, previous_version)):
+            file.unlink()
+
+
+def load_model_map(path, writable=False):
+    """Load a model map saved either as a single pickle file or as a sharded model store
+
+    :param path: the pickle file or the store directory
+    :param writable: whether the models of a sharded model store are loaded into writable copies (e.g., to continue
+           training them) instead of read-only memory-mapped buffers. All the models are loaded at once if so.
+    :return: (the map from OpUnit to the mini model, the DataInfo that the models are trained with)
+    """
+    if is_model_store(path):
+        store = ModelStore(path, writable=writable)
+        if writable:
+            return dict(store), store.data_info
+        return store, store.data_info
+
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+
+class ModelStore(Mapping):
+    """
+    Read-only map from OpUnit to the mini model backed by a sharded model store, loading each model on first access
+    """
+
+    def __init__(self, path, compile_models=False, writable=False, on_load=None):
+        """
+        :param path: the store directory
+        :param compile_models: whether to compile each model for fast inference once loaded (see Model.compile)
+        :param writable: whether to copy the buffers of each model into the heap instead of memory-mapping them
+               read-only (the numpy arrays of a model cannot be modified in place otherwise)
+        :param on_load: called with the size of each model (bytes) once it is loaded, if not None
+        """
+        self.path = Path(path)
+        self._compile_models = compile_models
+        self._writable = writable
+        self._on_load = on_load
+        with open(self.path / MANIFEST_FILE, "r") as f:
+            manifest = json.load(f)
+        self.version = manifest["version"]
+        self._shards = {OpUnit[name]: shard for name, shard in manifest["opunits"].items()}
+        self._models = {}
+
+        with open(self.path / manifest["data_info"], "rb") as f:
+            self.data_info = pickle.load(f)
+
+    def size(self):
+        """
+        :return: the total size of the models that have been loaded from the store (bytes)
+        """
+        return sum(self._shards[opunit]["size"] for opunit in self._models)
+
+    def loaded_opunits(self):
+        """
+        :return: the opunits whose models have been loaded
+        """
+        return list(self._models.keys())
+
+    def _load(self, opunit):
+        shard = self._shards[opunit]
+        buffers = []
+        with open(self.path / shard["buffers"], "rb") as f:
+            if len(shard["offsets"]) > 0:
+                # The mapping stays alive as long as the buffers of the loaded model reference it
+                view = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+                buffers = [view[offset:offset + size] for offset, size in shard["offsets"]]
+                if self._writable:
+                    buffers = [bytearray(buf) for buf in buffers]
+        with open(self.path / shard["pickle"], "rb") as f:
+            return pickle.loads(f.read(), buffers=buffers)
+
+    def __getitem__(self, opunit):
+        if opunit not in self._models:
+            if opunit not in self._shards:
+                raise KeyError(opunit)
+            model = self._load(opunit)
+            if self._compile_models:
+                model.compile()
+            self._models[opunit] = model
+            if self._on_load is not None:
+                self._on_load(self._shards[opunit]["size"])
+        return self._models[opunit]
+
+    def __iter__(self):
+        return iter(self._shards)
+
+    def __len__(self):
+        return len(self._shards)
+
+    def __contains__(self, opunit):
+        return opunit in self._shards
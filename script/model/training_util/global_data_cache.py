@@ -0,0 +1,111 @@
+"""Versioned cache for the stages of the global model data construction.
+
+Each stage (the loaded GroupedOpUnitData, the mini-model predictions, the GlobalResourceData, and the intervals of the
+GlobalImpactData) is pickled separately under a key that hashes everything the stage depends on, including the key of
+the stage before it. A change of the input CSV files, the mini models, or the parameters therefore only recomputes the
+stages from the first one affected, and a stale cache is never reused.
+"""
+
+import glob
+import hashlib
+import json
+import logging
+import os
+import pickle
+
+from data_class import columnar_cache
+from model_store import ModelStore
+
+# Name of the cache directory created in the input directory
+CACHE_DIR_NAME = ".global_model_data_cache"
+
+# Version of the cached data layout (part of every key, so bumping it invalidates all the caches)
+_CACHE_VERSION = 2
+
+
+def get_key(*parts):
+    """Hash the parts that a stage depends on into its key
+
+    :param parts: JSON serializable values (e.g., the key of the previous stage and the parameters of this stage)
+    :return: the hex digest key
+    """
+    return hashlib.sha1(json.dumps([_CACHE_VERSION] + list(parts), sort_keys=True).encode()).hexdigest()
+
+
+def hash_input_files(input_path):
+    """Hash the content of the CSV files in the input directory
+
+    :param input_path: the input directory
+    :return: the hex digest of the files
+    """
+    sha = hashlib.sha1()
+    for filename in sorted(glob.glob(os.path.join(input_path, '*.csv'))):
+        sha.update(os.path.basename(filename).encode())
+        sha.update(columnar_cache.get_content_hash(filename).encode())
+    return sha.hexdigest()
+
+
+def hash_model_map(model_map):
+    """Hash the mini models
+
+    :param model_map: the map from OpUnit to the mini model (a dict, or a ModelStore)
+    :return: the hex digest of the models
+    """
+    sha = hashlib.sha1()
+    if isinstance(model_map, ModelStore):
+        # A store version is never reused for different models
+        sha.update(str(model_map.path.resolve()).encode())
+        sha.update(model_map.version.encode())
+    else:
+        for opunit in sorted(model_map, key=lambda o: o.name):
+            sha.update(opunit.name.encode())
+            sha.update(pickle.dumps(model_map[opunit]))
+    return sha.hexdigest()
+
+
+class StageCache:
+    """
+    The cached stages of the global model data of an input directory
+    """
+
+    def __init__(self, input_path):
+        """
+        :param input_path: the input directory
+        """
+        self.path = os.path.join(input_path, CACHE_DIR_NAME)
+
+    def _get_file(self, stage, key):
+        return os.path.join(self.path, "{}.{}.pickle".format(stage, key))
+
+    def load(self, stage, key):
+        """Load the data of a stage
+
+        :param stage: the name of the stage
+        :param key: the key of the stage
+        :return: the cached data, or None if the stage is not cached with this key
+        """
+        try:
+            with open(self._get_file(stage, key), 'rb') as f:
+                data = pickle.load(f)
+        except OSError:
+            return None
+        logging.info("Loaded the cached {} stage of the global model data".format(stage))
+        return data
+
+    def save(self, stage, key, data):
+        """Save the data of a stage, replacing the other versions of the stage
+
+        :param stage: the name of the stage
+        :param key: the key of the stage
+        :param data: the data to cache
+        """
+        os.makedirs(self.path, exist_ok=True)
+        cache_file = self._get_file(stage, key)
+        tmp_file = "{}.{}.tmp".format(cache_file, os.getpid())
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, cache_file)
+
+        for file in glob.glob(self._get_file(stage, '*')):
+            if file != cache_file:
+                os.remove(file)
@@ -1,25 +1,41 @@
 import logging
 import copy
 import glob
-import math
+import multiprocessing
 import os
 import numpy as np
 import tqdm
-import pickle
+from concurrent.futures import ProcessPoolExecutor
 
 from util import io_util
+from training_util import global_data_cache
 from info import hardware_info
 from info import data_info
 from data_class import global_model_data, grouped_op_unit_data
 import global_model_config
 from type import OpUnit, ConcurrentCountingMode, Target, ExecutionFeature
 
+# Number of GroupedOpUnitData to match with the intervals at a time (bounds the memory of the overlap pairs)
+_OVERLAP_CHUNK_SIZE = 1 << 18
+
+# Number of GroupedOpUnitData to predict (and log the prediction results of) at a time
+_PREDICT_CHUNK_SIZE = 1 << 16
+
+# Maximum default number of worker processes to load the input files with
+_MAX_DEFAULT_LOAD_WORKERS = 4
+
+# Total size of the input files that the default number of worker processes load at once (bytes). Every worker holds
+# the data of a whole file and sends it back to the parent process, so the memory grows with the files loaded at once.
+_DEFAULT_LOAD_BUDGET_BYTES = 1 << 30
+
 
 def get_data(input_path, mini_model_map, model_results_path, warmup_period, use_query_predict_cache, add_noise,
-             predict_ou_only, ee_sample_interval, txn_sample_interval, network_sample_interval):
+             predict_ou_only, ee_sample_interval, txn_sample_interval, network_sample_interval, num_workers=None):
     """Get the data for the global models
 
-    Read from the cache if exists, otherwise save the constructed data to the cache.
+    Each stage of the construction (the grouped OU data, the predictions, the GlobalResourceData, and the intervals of
+    the GlobalImpactData) is read from the cache if it exists with the same inputs, otherwise constructed and saved to
+    the cache (see global_data_cache).
 
     :param input_path: input data file path
     :param mini_model_map: mini models used for prediction
@@ -31,193 +47,272 @@ def get_data(input_path, mini_model_map, model_results_path, warmup_period, use_
     :param ee_sample_interval: sampling interval for the EE OUs
     :param txn_sample_interval: sampling interval for the transaction OUs
     :param network_sample_interval: sampling interval for the network OUs
-    :return: (GlobalResourceData list, GlobalImpactData list)
+    :param num_workers: number of worker processes to load the input files with (defaults to a small number sized by
+           the input files, see _get_default_num_workers)
+    :return: (GlobalResourceData list, GlobalImpactDataStore)
     """
-    cache_file = input_path + '/global_model_data.pickle'
-    if os.path.exists(cache_file):
-        with open(cache_file, 'rb') as pickle_file:
-            resource_data_list, impact_data_list, = pickle.load(pickle_file)
+    cache = global_data_cache.StageCache(input_path)
+    data_key = global_data_cache.get_key("data", global_data_cache.hash_input_files(input_path), warmup_period,
+                                         ee_sample_interval, txn_sample_interval, network_sample_interval)
+    prediction_key = global_data_cache.get_key("prediction", data_key,
+                                               global_data_cache.hash_model_map(mini_model_map),
+                                               use_query_predict_cache, add_noise)
+    resource_key = global_data_cache.get_key("resource", prediction_key, global_model_config.INTERVAL_SIZE,
+                                             global_model_config.INTERVAL_START, global_model_config.INTERVAL_SEGMENT,
+                                             hardware_info.PHYSICAL_CORE_NUM)
+    impact_key = global_data_cache.get_key("impact", resource_key)
+
+    data_list = cache.load("data", data_key)
+    if data_list is None:
+        data_list = _get_data_list(input_path, warmup_period, ee_sample_interval, txn_sample_interval,
+                                   network_sample_interval, num_workers)
+        cache.save("data", data_key, data_list)
+
+    # Always predict (and log the prediction results) when only predicting the grouped OU data
+    y_preds = None if predict_ou_only else cache.load("prediction", prediction_key)
+    if y_preds is None:
+        _predict_grouped_opunit_data(data_list, mini_model_map, model_results_path, use_query_predict_cache,
+                                     add_noise)
+        logging.info("Finished GroupedOpUnitData prediction with the mini models")
+        cache.save("prediction", prediction_key, data_list.y_pred)
     else:
-        data_list = _get_grouped_opunit_data_with_prediction(input_path, mini_model_map, model_results_path,
-                                                             warmup_period, use_query_predict_cache, add_noise,
-                                                             ee_sample_interval, txn_sample_interval,
-                                                             network_sample_interval)
+        data_list.y_pred = y_preds
 
-        if not predict_ou_only:
-            resource_data_list, impact_data_list = _construct_interval_based_global_model_data(data_list,
-                                                                                               model_results_path)
+    if predict_ou_only:
+        return None, None
 
-            with open(cache_file, 'wb') as file:
-                pickle.dump((resource_data_list, impact_data_list), file)
-        else:
-            return None, None
+    resource_data_list = cache.load("resource", resource_key)
+    if resource_data_list is None:
+        resource_data_list = _construct_global_resource_data(data_list, model_results_path)
+        cache.save("resource", resource_key, resource_data_list)
 
-    return resource_data_list, impact_data_list
+    impact_intervals = cache.load("impact", impact_key)
+    if impact_intervals is None:
+        impact_intervals = _find_impact_intervals(data_list, resource_data_list)
+        cache.save("impact", impact_key, impact_intervals)
 
+    impact_data_list = global_model_data.GlobalImpactDataStore(data_list, resource_data_list, *impact_intervals)
 
-def _get_grouped_opunit_data_with_prediction(input_path, mini_model_map, model_results_path, warmup_period,
-                                             use_query_predict_cache, add_noise, ee_sample_interval,
-                                             txn_sample_interval, network_sample_interval):
-    """Get the grouped opunit data with the predicted metrics and elapsed time
+    return resource_data_list, impact_data_list
 
-    :param input_path: input data file path
-    :param mini_model_map: mini models used for prediction
-    :param model_results_path: directory path to log the result information
-    :param warmup_period: warmup period for pipeline data
-    :return: The list of the GroupedOpUnitData objects
-    """
-    data_list = _get_data_list(input_path, warmup_period, ee_sample_interval, txn_sample_interval,
-                               network_sample_interval)
-    _predict_grouped_opunit_data(data_list, mini_model_map, model_results_path, use_query_predict_cache, add_noise)
-    logging.info("Finished GroupedOpUnitData prediction with the mini models")
-    return data_list
 
+def _construct_global_resource_data(data_list, model_results_path):
+    """Construct the GlobalResourceData used for the global model training
 
-def _construct_interval_based_global_model_data(data_list, model_results_path):
-    """Construct the GlobalImpactData used for the global model training
+    The interval start times form a sorted index, so the intervals that each data overlaps with are a contiguous range
+    of the index found with a binary search. The overlap ratios of all the (interval, data) pairs are then accumulated
+    per interval and per core with array operations.
 
-    :param data_list: The list of GroupedOpUnitData objects
+    :param data_list: The GroupedOpUnitDataStore
     :param model_results_path: directory path to log the result information
-    :return: (GlobalResourceData list, GlobalImpactData list)
+    :return: the GlobalResourceData list (ordered by the interval start time)
     """
     prediction_path = "{}/global_resource_data.csv".format(model_results_path)
     io_util.create_csv_file(prediction_path, ["Elapsed us", "# Concurrent OpUnit Groups"])
 
-    start_time_list = sorted([d.get_start_time(ConcurrentCountingMode.INTERVAL) for d in data_list])
-    rounded_start_time_list = [_round_to_second(start_time_list[0])]
-    # Map from interval start time to the data in this interval
-    interval_data_map = {rounded_start_time_list[0]: []}
-    # Get all the interval start times and initialize the map
-    for t in start_time_list:
-        rounded_time = _round_to_second(t)
-        if rounded_time > rounded_start_time_list[-1]:
-            rounded_start_time_list.append(rounded_time)
-            interval_data_map[rounded_time] = []
-
-    for data in tqdm.tqdm(data_list, desc="Find Interval Data"):
-        # For each data, find the intervals that might overlap with it
-        interval_start_time = _round_to_second(data.get_start_time(ConcurrentCountingMode.EXACT) -
-                                               global_model_config.INTERVAL_SIZE + global_model_config.INTERVAL_SEGMENT)
-        while interval_start_time <= data.get_end_time(ConcurrentCountingMode.ESTIMATED):
-            if interval_start_time in interval_data_map:
-                interval_data_map[interval_start_time].append(data)
-            interval_start_time += global_model_config.INTERVAL_SEGMENT
+    exact_start_times = data_list.get_start_times(ConcurrentCountingMode.EXACT)
+    estimated_start_times = data_list.get_start_times(ConcurrentCountingMode.ESTIMATED)
+    estimated_end_times = data_list.get_end_times(ConcurrentCountingMode.ESTIMATED)
+    interval_start_times = _round_to_second(data_list.get_start_times(ConcurrentCountingMode.INTERVAL))
 
-    # Get the global resource data
-    resource_data_map = {}
-    for start_time in tqdm.tqdm(rounded_start_time_list, desc="Construct GlobalResourceData"):
-        resource_data_map[start_time] = _get_global_resource_data(start_time, interval_data_map[start_time],
-                                                                  prediction_path)
+    # All the interval start times (sorted)
+    rounded_start_times = np.unique(interval_start_times)
+    num_intervals = len(rounded_start_times)
+    num_targets = data_list.y.shape[1]
 
-    # Now construct the global impact data
-    impact_data_list = []
-    for data in data_list:
-        interval_start_time = _round_to_second(data.get_start_time(ConcurrentCountingMode.INTERVAL))
-        resource_data_list = []
-        while interval_start_time <= data.get_end_time(ConcurrentCountingMode.ESTIMATED):
-            if interval_start_time in resource_data_map:
-                resource_data_list.append(resource_data_map[interval_start_time])
-            interval_start_time += global_model_config.INTERVAL_SIZE
+    # The adjusted resource metrics per interval, and per interval and logical core.
+    # TODO: Assuming each physical core has two logical cores via hyper threading for now. Can extend to other scenarios
+    physical_core_num = hardware_info.PHYSICAL_CORE_NUM
+    num_cores = 2 * physical_core_num
+    concurrent_counts = np.zeros(num_intervals, dtype=np.int64)
+    adjusted_y = np.zeros((num_intervals, num_targets))
+    adjusted_x = np.zeros((num_intervals * num_cores, num_targets))
+
+    for chunk_start in tqdm.trange(0, len(data_list), _OVERLAP_CHUNK_SIZE, desc="Find Interval Data"):
+        chunk = slice(chunk_start, chunk_start + _OVERLAP_CHUNK_SIZE)
+        # A data is in the intervals that start on the segment grid from this time to its estimated end time
+        first_start_times = _round_to_second(exact_start_times[chunk] - global_model_config.INTERVAL_SIZE +
+                                             global_model_config.INTERVAL_SEGMENT)
+        data_idx, interval_idx = _find_overlapping_intervals(rounded_start_times, first_start_times,
+                                                             estimated_end_times[chunk])
+        on_segment = (rounded_start_times[interval_idx] - first_start_times[data_idx]) % \
+            global_model_config.INTERVAL_SEGMENT == 0
+        data_idx = data_idx[on_segment]
+        interval_idx = interval_idx[on_segment]
+
+        y = data_list.y[chunk][data_idx]
+        y_pred = data_list.y_pred[chunk][data_idx]
+        cpu_ids = data_list.cpu_id[chunk][data_idx]
+        cpu_ids = np.where(cpu_ids > physical_core_num, cpu_ids - physical_core_num, cpu_ids)
+        # Multiply the resource metrics and the mini-model predictions based on the sampling interval
+        sample_intervals = data_list.sample_interval[chunk][data_idx][:, np.newaxis] + 1
+
+        data_start_times = estimated_start_times[chunk][data_idx]
+        data_end_times = estimated_end_times[chunk][data_idx]
+        start_times = rounded_start_times[interval_idx]
+        end_times = start_times + global_model_config.INTERVAL_SIZE - 1
+        ratios = (np.minimum(end_times, data_end_times) - np.maximum(start_times, data_start_times) + 1) / (
+            data_end_times - data_start_times + 2)
+        ratios = ratios[:, np.newaxis]
+
+        # bincount adds the pairs in the data order
+        concurrent_counts += np.bincount(interval_idx, minlength=num_intervals)
+        weighted_y = y * ratios * sample_intervals
+        weighted_y_pred = y_pred * ratios * sample_intervals
+        core_idx = interval_idx * num_cores + cpu_ids
+        for i in range(num_targets):
+            adjusted_y[:, i] += np.bincount(interval_idx, weights=weighted_y[:, i], minlength=num_intervals)
+            adjusted_x[:, i] += np.bincount(core_idx, weights=weighted_y_pred[:, i],
+                                            minlength=num_intervals * num_cores)
 
-        impact_data_list.append(global_model_data.GlobalImpactData(data, resource_data_list))
+    # change the number to per time unit (us) utilization
+    elapsed_us = global_model_config.INTERVAL_SIZE
+    adjusted_y /= elapsed_us
+    adjusted_x /= elapsed_us
+    adjusted_x = adjusted_x.reshape(num_intervals, num_cores, num_targets)
 
-    return list(resource_data_map.values()), impact_data_list
+    sum_adjusted_x = np.sum(adjusted_x, axis=1)
+    std_adjusted_x = np.std(adjusted_x, axis=1)
+    ratio_error = abs(adjusted_y - sum_adjusted_x) / (adjusted_y + 1e-6)
 
+    io_util.write_csv_results(prediction_path, [elapsed_us] * num_intervals,
+                              ([count] + list(sum_x) + [""] + list(y) + [""] + list(error)
+                               for count, sum_x, y, error in zip(concurrent_counts, sum_adjusted_x, adjusted_y,
+                                                                 ratio_error)))
 
-def _round_to_second(time):
-    """
-    :param time: in us
-    :return: time in us rounded to the earliest second
-    """
-    return time - time % 1000000
+    # Get the global resource data
+    resource_data_list = []
+    for i in tqdm.trange(num_intervals, desc="Construct GlobalResourceData"):
+        resource_data_list.append(global_model_data.GlobalResourceData(
+            rounded_start_times[i].item(), adjusted_x[i], np.concatenate((sum_adjusted_x[i], std_adjusted_x[i])),
+            adjusted_y[i]))
 
+    return resource_data_list
 
-def _get_global_resource_data(start_time, concurrent_data_list, log_path):
-    """Get the input feature and the target output for the global resource utilization metrics during an interval
 
-    The calculation is adjusted by the overlapping ratio between the opunit groups and the time range.
+def _find_impact_intervals(data_list, resource_data_list):
+    """Find the intervals for the GlobalImpactData of each GroupedOpUnitData, which are the intervals from the
+    interval start time of the data to its estimated end time
 
-    :param start_time: of the interval
-    :param concurrent_data_list: the concurrent running opunit groups
-    :param log_path: the file path to log the data construction results
-    :return: (the input feature, the resource utilization on the other logical core of the same physical core,
-    the output resource targets)
+    :param data_list: The GroupedOpUnitDataStore
+    :param resource_data_list: The GlobalResourceData list (ordered by the interval start time)
+    :return: (the interval offsets, the interval indexes), where the interval (GlobalResourceData) indexes of data i
+             are interval_indexes[interval_offsets[i]:interval_offsets[i + 1]]
     """
-    # Define a secondary_counting_mode corresponding to the concurrent_counting_mode to derive the concurrent operations
-    # in different scenarios
-    end_time = start_time + global_model_config.INTERVAL_SIZE - 1
-    elapsed_us = global_model_config.INTERVAL_SIZE
-
-    # The adjusted resource metrics per logical core.
-    # TODO: Assuming each physical core has two logical cores via hyper threading for now. Can extend to other scenarios
-    physical_core_num = hardware_info.PHYSICAL_CORE_NUM
-    adjusted_x_list = [0] * 2 * physical_core_num
-    adjusted_y = 0
-    logging.debug(concurrent_data_list)
-    logging.debug("{} {}".format(start_time, end_time))
-
-    for data in concurrent_data_list:
-        data_start_time = data.get_start_time(ConcurrentCountingMode.ESTIMATED)
-        data_end_time = data.get_end_time(ConcurrentCountingMode.ESTIMATED)
-        ratio = _calculate_range_overlap(start_time, end_time, data_start_time, data_end_time) / (data_end_time -
-                                                                                                  data_start_time + 2)
-        # print(start_time, end_time, data_start_time, data_end_time, data_end_time - data_start_time + 1)
-        sample_interval = data.sample_interval
-        logging.debug("{} {} {}".format(data_start_time, data_end_time, ratio))
-        logging.debug("{} {}".format(data.y, data.y_pred))
-        logging.debug("Sampling interval: {}".format(sample_interval))
-        # Multiply the resource metrics based on the sampling interval
-        adjusted_y += data.y * ratio * (sample_interval + 1)
-        cpu_id = data.cpu_id
-        if cpu_id > physical_core_num:
-            cpu_id -= physical_core_num
-        # Multiply the mini-model predictions based on the sampling interval
-        adjusted_x_list[cpu_id] += data.y_pred * ratio * (sample_interval + 1)
+    estimated_end_times = data_list.get_end_times(ConcurrentCountingMode.ESTIMATED)
+    interval_start_times = _round_to_second(data_list.get_start_times(ConcurrentCountingMode.INTERVAL))
+    rounded_start_times = np.array([d.start_time for d in resource_data_list])
+    num_intervals = len(rounded_start_times)
 
-    # change the number to per time unit (us) utilization
-    for x in adjusted_x_list:
-        x /= elapsed_us
-    adjusted_y /= elapsed_us
+    num_steps = np.maximum(np.floor((estimated_end_times - interval_start_times) /
+                                    global_model_config.INTERVAL_SIZE).astype(np.int64) + 1, 0)
+    data_idx = np.repeat(np.arange(len(data_list)), num_steps)
+    step_times = interval_start_times[data_idx] + _get_range_offsets(num_steps) * global_model_config.INTERVAL_SIZE
+    interval_idx = np.minimum(np.searchsorted(rounded_start_times, step_times), num_intervals - 1)
+    found = rounded_start_times[interval_idx] == step_times
+    interval_nums = np.bincount(data_idx[found], minlength=len(data_list))
+    return np.concatenate(([0], np.cumsum(interval_nums))), interval_idx[found]
 
-    sum_adjusted_x = np.sum(adjusted_x_list, axis=0)
-    std_adjusted_x = np.std(adjusted_x_list, axis=0)
-
-    ratio_error = abs(adjusted_y - sum_adjusted_x) / (adjusted_y + 1e-6)
 
-    logging.debug(sum_adjusted_x)
-    logging.debug(adjusted_y)
-    logging.debug("")
+def _round_to_second(time):
+    """
+    :param time: in us (a number or a numpy array)
+    :return: time in us rounded to the earliest second
+    """
+    return time - time % 1000000
 
-    io_util.write_csv_result(log_path, elapsed_us, [len(concurrent_data_list)] + list(sum_adjusted_x) + [""] +
-                             list(adjusted_y) + [""] + list(ratio_error))
 
-    adjusted_x = np.concatenate((sum_adjusted_x, std_adjusted_x))
+def _find_overlapping_intervals(interval_start_times, first_start_times, last_start_times):
+    """Find the intervals whose start time is within the range of each data
 
-    return global_model_data.GlobalResourceData(start_time, adjusted_x_list, adjusted_x, adjusted_y)
+    :param interval_start_times: the sorted interval start times
+    :param first_start_times: the earliest interval start time of each data
+    :param last_start_times: the latest interval start time of each data
+    :return: (the data index, the interval index) of all the pairs, ordered by the data
+    """
+    lower = np.searchsorted(interval_start_times, first_start_times, side='left')
+    upper = np.searchsorted(interval_start_times, last_start_times, side='right')
+    counts = np.maximum(upper - lower, 0)
+    data_idx = np.repeat(np.arange(len(counts)), counts)
+    interval_idx = np.repeat(lower, counts) + _get_range_offsets(counts)
+    return data_idx, interval_idx
 
 
-def _calculate_range_overlap(start_timel, end_timel, start_timer, end_timer):
-    return min(end_timel, end_timer) - max(start_timel, start_timer) + 1
+def _get_range_offsets(counts):
+    """
+    :param counts: the number of elements in each range
+    :return: the offsets of the elements within their ranges, i.e., concatenate(arange(c) for c in counts)
+    """
+    offsets = np.arange(np.sum(counts))
+    return offsets - np.repeat(np.cumsum(counts) - counts, counts)
 
 
 def _get_data_list(input_path, warmup_period, ee_sample_interval, txn_sample_interval,
-                   network_sample_interval):
-    """Get the list of all the operating units (or groups of operating units) stored in GlobalData objects
+                   network_sample_interval, num_workers=None):
+    """Get all the operating units (or groups of operating units) stored in a GroupedOpUnitDataStore
+
+    The files are parsed concurrently in a pool of worker processes, and merged in the order of the file names.
 
     :param input_path: input data file path
     :param warmup_period: warmup period for pipeline data
-    :return: the list of all the operating units (or groups of operating units) stored in GlobalData objects
+    :param num_workers: number of worker processes to load the files with (defaults to _get_default_num_workers, and
+           1 loads the files in the current process)
+    :return: the GroupedOpUnitDataStore of all the operating units (or groups of operating units)
     """
-    data_list = []
+    builder = grouped_op_unit_data.GroupedOpUnitDataBuilder()
+    filenames = sorted(glob.glob(os.path.join(input_path, '*.csv')))
+    if num_workers is None:
+        num_workers = _get_default_num_workers(filenames)
+    num_workers = min(num_workers, len(filenames))
 
     # First get the data for all mini runners
-    for filename in glob.glob(os.path.join(input_path, '*.csv')):
-        data_list += grouped_op_unit_data.get_grouped_op_unit_data(filename, warmup_period,
-                                                                   ee_sample_interval, txn_sample_interval,
-                                                                   network_sample_interval)
-        logging.info("Loaded file: {}".format(filename))
+    if num_workers <= 1:
+        for filename in filenames:
+            for store in grouped_op_unit_data.iter_grouped_op_unit_data(filename, warmup_period, ee_sample_interval,
+                                                                        txn_sample_interval, network_sample_interval):
+                builder.extend(store)
+            logging.info("Loaded file: {}".format(filename))
+        return builder.build()
+
+    # Workers are spawned rather than forked since LightGBM may hang in forked processes
+    with ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        futures = [pool.submit(_load_grouped_op_unit_data, filename, warmup_period, ee_sample_interval,
+                               txn_sample_interval, network_sample_interval, data_info.instance)
+                   for filename in filenames]
+        for filename, future in zip(filenames, futures):
+            builder.extend(future.result())
+            logging.info("Loaded file: {}".format(filename))
+
+    return builder.build()
+
+
+def _get_default_num_workers(filenames):
+    """Get the default number of worker processes to load the input files with
+
+    The number is bounded by _MAX_DEFAULT_LOAD_WORKERS and the number of CPUs, and is reduced until the largest files
+    that the workers may load at once fit in _DEFAULT_LOAD_BUDGET_BYTES (a single worker loads any file).
+
+    :param filenames: the input files
+    :return: the number of worker processes
+    """
+    sizes = sorted((os.path.getsize(filename) for filename in filenames), reverse=True)
+    max_workers = min(_MAX_DEFAULT_LOAD_WORKERS, os.cpu_count() or 1, len(sizes))
+    num_workers = 1
+    while num_workers < max_workers and sum(sizes[:num_workers + 1]) <= _DEFAULT_LOAD_BUDGET_BYTES:
+        num_workers += 1
+    return num_workers
+
 
-    return data_list
+def _load_grouped_op_unit_data(filename, warmup_period, ee_sample_interval, txn_sample_interval,
+                               network_sample_interval, data_info_instance):
+    """Load the GroupedOpUnitData of a file (runs in the worker processes of _get_data_list)
+
+    :param data_info_instance: the DataInfo of the mini models, installed in the worker process
+    :return: the GroupedOpUnitDataStore of the file
+    """
+    data_info.instance = data_info_instance
+    return grouped_op_unit_data.get_grouped_op_unit_data(filename, warmup_period, ee_sample_interval,
+                                                         txn_sample_interval, network_sample_interval)
 
 
 def _add_estimation_noise(opunit, x):
@@ -243,7 +338,7 @@ def _predict_grouped_opunit_data(data_list, mini_model_map, model_results_path,
     """Use the mini-runner to predict the resource consumptions for all the GlobalData, and record the prediction
     result in place
 
-    :param data_list: The list of the GroupedOpUnitData objects
+    :param data_list: The GroupedOpUnitDataStore
     :param mini_model_map: The trained mini models
     :param model_results_path: file path to log the prediction results
     :param use_query_predict_cache: whether cache the prediction result based on the query for acceleration
@@ -268,102 +363,43 @@ def _predict_grouped_opunit_data(data_list, mini_model_map, model_results_path,
     current_query_id = None
     query_y = None
     query_y_pred = None
-
-    # Have to use a prediction cache when having lots of global data...
-    prediction_cache = {}
-
-    # use a prediction cache based on queries to accelerate
-    query_prediction_cache = {}
+    query_labels, query_rows = [], []
+    prediction_labels, prediction_rows = [], []
 
     # First run a prediction on the global running data with the mini model results
-    for i, data in enumerate(tqdm.tqdm(data_list, desc="Predict GroupedOpUnitData")):
+    pipeline_y_preds = _batch_predict_grouped_opunit_data(data_list, mini_model_map, use_query_predict_cache,
+                                                          add_noise)
+    data_list.y_pred = pipeline_y_preds
+
+    for data, pipeline_y in zip(data_list, pipeline_y_preds):
         y = data.y
-        if data.name[0] != 'q' or (data.name not in query_prediction_cache) or not use_query_predict_cache:
-            logging.debug("{} pipeline elapsed time: {}".format(data.name, y[-1]))
-
-            pipeline_y_pred = 0
-            for opunit_feature in data.opunit_features:
-                opunit = opunit_feature[0]
-                opunit_model = mini_model_map[opunit]
-                x = np.array(opunit_feature[1]).reshape(1, -1)
-
-                if add_noise:
-                    _add_estimation_noise(opunit, x[0])
-
-                key = (opunit, x.tobytes())
-                if key not in prediction_cache:
-                    y_pred = opunit_model.predict(x)
-                    y_pred = np.clip(y_pred, 0, None)
-                    prediction_cache[key] = y_pred
-                else:
-                    y_pred = prediction_cache[key]
-                logging.debug("Predicted {} elapsed time with feature {}: {}".format(opunit_feature[0].name,
-                                                                                     x[0], y_pred[0, -1]))
-
-                if opunit in data_info.instance.MEM_ADJUST_OPUNITS:
-                    # Compute the number of "slots" (based on row feature or cardinality feature
-                    num_tuple = opunit_feature[1][data_info.instance.input_csv_index[ExecutionFeature.NUM_ROWS]]
-                    if opunit == OpUnit.AGG_BUILD:
-                        num_tuple = opunit_feature[1][data_info.instance.input_csv_index[ExecutionFeature.EST_CARDINALITIES]]
-
-                    # SORT/AGG/HASHJOIN_BUILD all allocate a "pointer" buffer
-                    # that contains the first pow2 larger than num_tuple entries
-                    pow_high = 2 ** math.ceil(math.log(num_tuple, 2))
-                    buffer_size = pow_high * data_info.instance.POINTER_SIZE
-                    if opunit == OpUnit.AGG_BUILD and num_tuple <= 256:
-                        # For AGG_BUILD, if slots <= AggregationHashTable::K_DEFAULT_INITIAL_TABLE_SIZE
-                        # the buffer is not recorded as part of the pipeline
-                        buffer_size = 0
-
-                    pred_mem = y_pred[0][data_info.instance.target_csv_index[Target.MEMORY_B]]
-                    if pred_mem <= buffer_size:
-                        logging.debug("{} feature {} {} with prediction {} exceeds buffer {}"
-                                      .format(data.name, opunit_feature, opunit_feature[1], y_pred[0], buffer_size))
-
-                    # For hashjoin_build, there is still some inaccuracy due to the
-                    # fact that we do not know about the hash table's load factor.
-                    scale = data_info.instance.input_csv_index[ExecutionFeature.MEM_FACTOR]
-                    adj_mem = (pred_mem - buffer_size) * opunit_feature[1][scale] + buffer_size
-
-                    # Don't modify prediction cache
-                    y_pred = copy.deepcopy(y_pred)
-                    y_pred[0][data_info.instance.target_csv_index[Target.MEMORY_B]] = adj_mem
-
-                pipeline_y_pred += y_pred[0]
-
-            pipeline_y = copy.deepcopy(pipeline_y_pred)
-
-            query_prediction_cache[data.name] = pipeline_y
-        else:
-            pipeline_y_pred = query_prediction_cache[data.name]
-            pipeline_y = copy.deepcopy(pipeline_y_pred)
 
         # Grouping when we're predicting queries
         if data.name[0] == 'q':
             query_id = data.name[1:data.name.rfind(" p")]
             if query_id != current_query_id:
                 if current_query_id is not None:
-                    io_util.write_csv_result(query_prediction_path, current_query_id, [""] + list(query_y) + [""] +
-                                             list(query_y_pred) + [""] +
-                                             list(abs(query_y - query_y_pred) / (query_y + 1)))
+                    query_labels.append(current_query_id)
+                    query_rows.append([""] + list(query_y) + [""] + list(query_y_pred) + [""] +
+                                      list(abs(query_y - query_y_pred) / (query_y + 1)))
 
                 current_query_id = query_id
                 query_y = copy.deepcopy(y)
-                query_y_pred = copy.deepcopy(pipeline_y_pred)
+                query_y_pred = copy.deepcopy(pipeline_y)
             else:
                 query_y += y
-                query_y_pred += pipeline_y_pred
+                query_y_pred += pipeline_y
 
-        data.y_pred = pipeline_y
         logging.debug("{} pipeline prediction: {}".format(data.name, pipeline_y))
         logging.debug("{} pipeline predicted time: {}".format(data.name, pipeline_y[-1]))
         ratio_error = abs(y - pipeline_y) / (y + 1)
         logging.debug("|Actual - Predict| / Actual: {}".format(ratio_error[-1]))
 
-        io_util.write_csv_result(prediction_path, data.name, [""] + list(y) + [""] + list(pipeline_y) + [""] +
-                                 list(ratio_error))
-
-        logging.debug("")
+        prediction_labels.append(data.name)
+        prediction_rows.append([""] + list(y) + [""] + list(pipeline_y) + [""] + list(ratio_error))
+        if len(prediction_rows) == _PREDICT_CHUNK_SIZE:
+            io_util.write_csv_results(prediction_path, prediction_labels, prediction_rows)
+            prediction_labels, prediction_rows = [], []
 
         # Record cumulative numbers
         if data.name not in actual_pipelines:
@@ -385,6 +421,9 @@ def _predict_grouped_opunit_data(data_list, mini_model_map, model_results_path,
 
         num_pipelines += 1
 
+    io_util.write_csv_results(query_prediction_path, query_labels, query_rows)
+    io_util.write_csv_results(prediction_path, prediction_labels, prediction_rows)
+
     total_elapsed_err = 0
     for pipeline in actual_pipelines:
         actual = actual_pipelines[pipeline]
@@ -408,3 +447,138 @@ def _predict_grouped_opunit_data(data_list, mini_model_map, model_results_path,
                                                                total_predicted[-1], ratio_error[-1], total_elapsed_err,
                                                                1] +
                              [""] + list(total_actual) + [""] + list(total_predicted) + [""] + list(ratio_error))
+
+
+def _batch_predict_grouped_opunit_data(data_list, mini_model_map, use_query_predict_cache, add_noise):
+    """Predict the pipeline resource consumptions of all the GroupedOpUnitData in chunks of _PREDICT_CHUNK_SIZE data
+
+    The predictions of the distinct feature rows of every opunit are cached across the chunks, so each feature row is
+    only predicted once.
+
+    :param data_list: The GroupedOpUnitDataStore
+    :param mini_model_map: The trained mini models
+    :param use_query_predict_cache: whether cache the prediction result based on the query for acceleration
+    :param add_noise: whether to add noise to the cardinality estimations
+    :return: the predicted pipeline metrics (one row per data)
+    """
+    num_targets = data_list.y.shape[1]
+    pipeline_y_preds = np.empty((len(data_list), num_targets))
+    # Map from opunit to (map from feature bytes to prediction index, predictions)
+    prediction_cache = {}
+    # The index of the data that each data takes the prediction from (with the query prediction cache)
+    source_indexes = np.arange(len(data_list))
+    query_source_index = {}
+
+    for chunk_start in tqdm.trange(0, len(data_list), _PREDICT_CHUNK_SIZE, desc="Predict GroupedOpUnitData"):
+        chunk_end = min(chunk_start + _PREDICT_CHUNK_SIZE, len(data_list))
+        pipeline_y_preds[chunk_start:chunk_end] = _batch_predict_chunk(
+            data_list, chunk_start, chunk_end, mini_model_map, use_query_predict_cache, add_noise, prediction_cache,
+            source_indexes, query_source_index)
+
+    return pipeline_y_preds[source_indexes]
+
+
+def _batch_predict_chunk(data_list, chunk_start, chunk_end, mini_model_map, use_query_predict_cache, add_noise,
+                         prediction_cache, source_indexes, query_source_index):
+    """Predict the pipeline resource consumptions of a chunk of the GroupedOpUnitData in two phases
+
+    The first phase collects the feature rows of every opunit in the chunk that are not predicted yet, so each mini
+    model only predicts once on a batch. The second phase scatters the predictions back to the opunits in the data,
+    applies the memory adjustment, and sums the opunit predictions per data.
+
+    :param data_list: The GroupedOpUnitDataStore
+    :param chunk_start: the index of the first data in the chunk
+    :param chunk_end: the index to stop the chunk at
+    :param mini_model_map: The trained mini models
+    :param use_query_predict_cache: whether cache the prediction result based on the query for acceleration
+    :param add_noise: whether to add noise to the cardinality estimations
+    :param prediction_cache: map from opunit to (map from feature bytes to prediction index, predictions), updated
+    :param source_indexes: the index of the data that each data takes the prediction from, updated
+    :param query_source_index: map from query name to the index of its first data, updated
+    :return: the predicted pipeline metrics of the chunk (the data that take the prediction from another data are 0)
+    """
+    # Map from opunit to the feature rows to predict
+    new_rows = {}
+    # The opunits in the chunk (the opunit value, its prediction index, the data it belongs to in the chunk)
+    opunit_values, row_indexes, data_indexes = [], [], []
+    # The opunits that need memory adjustment (the position in the opunits above, the tuple number, the memory factor)
+    mem_adjust_positions, mem_adjust_agg_builds, mem_adjust_tuples, mem_adjust_factors = [], [], [], []
+
+    num_rows_index = data_info.instance.input_csv_index[ExecutionFeature.NUM_ROWS]
+    cardinality_index = data_info.instance.input_csv_index[ExecutionFeature.EST_CARDINALITIES]
+    mem_factor_index = data_info.instance.input_csv_index[ExecutionFeature.MEM_FACTOR]
+    for i in range(chunk_start, chunk_end):
+        data = data_list[i]
+        if data.name[0] == 'q' and use_query_predict_cache:
+            if data.name in query_source_index:
+                source_indexes[i] = query_source_index[data.name]
+                continue
+            query_source_index[data.name] = i
+
+        for opunit, feature in data.opunit_features:
+            x = np.array(feature)
+            if add_noise:
+                _add_estimation_noise(opunit, x)
+
+            if opunit not in prediction_cache:
+                prediction_cache[opunit] = ({}, np.zeros((0, data_list.y.shape[1])))
+            row_index = prediction_cache[opunit][0]
+            key = x.tobytes()
+            if key not in row_index:
+                row_index[key] = len(row_index)
+                new_rows.setdefault(opunit, []).append(x)
+
+            if opunit in data_info.instance.MEM_ADJUST_OPUNITS:
+                # Compute the number of "slots" (based on row feature or cardinality feature
+                mem_adjust_positions.append(len(opunit_values))
+                mem_adjust_agg_builds.append(opunit == OpUnit.AGG_BUILD)
+                mem_adjust_tuples.append(feature[cardinality_index if opunit == OpUnit.AGG_BUILD else num_rows_index])
+                mem_adjust_factors.append(feature[mem_factor_index])
+
+            opunit_values.append(opunit.value)
+            row_indexes.append(row_index[key])
+            data_indexes.append(i - chunk_start)
+
+    # Predict all the new rows of each opunit at once
+    for opunit, rows in new_rows.items():
+        y_pred = mini_model_map[opunit].predict(np.array(rows))
+        y_pred = np.clip(y_pred, 0, None)
+        logging.debug("Predicted {} with {} distinct features".format(opunit.name, len(rows)))
+        row_index, predictions = prediction_cache[opunit]
+        prediction_cache[opunit] = (row_index, np.concatenate((predictions, y_pred)))
+
+    # Scatter the predictions to the opunits in the data
+    num_targets = data_list.y.shape[1]
+    opunit_y_preds = np.zeros((len(opunit_values), num_targets))
+    opunit_values = np.array(opunit_values, dtype=np.int64)
+    row_indexes = np.array(row_indexes, dtype=np.int64)
+    for value in np.unique(opunit_values):
+        positions = opunit_values == value
+        opunit_y_preds[positions] = prediction_cache[OpUnit(value)][1][row_indexes[positions]]
+
+    if len(mem_adjust_positions) > 0:
+        # SORT/AGG/HASHJOIN_BUILD all allocate a "pointer" buffer
+        # that contains the first pow2 larger than num_tuple entries
+        mem_adjust_tuples = np.array(mem_adjust_tuples, dtype=np.float64)
+        buffer_sizes = 2 ** np.ceil(np.log2(mem_adjust_tuples)) * data_info.instance.POINTER_SIZE
+        # For AGG_BUILD, if slots <= AggregationHashTable::K_DEFAULT_INITIAL_TABLE_SIZE
+        # the buffer is not recorded as part of the pipeline
+        buffer_sizes[np.array(mem_adjust_agg_builds, dtype=bool) & (mem_adjust_tuples <= 256)] = 0
+
+        mem_index = data_info.instance.target_csv_index[Target.MEMORY_B]
+        pred_mems = opunit_y_preds[mem_adjust_positions, mem_index]
+        logging.debug("{} memory predictions exceed their buffers".format(np.sum(pred_mems <= buffer_sizes)))
+
+        # For hashjoin_build, there is still some inaccuracy due to the
+        # fact that we do not know about the hash table's load factor.
+        opunit_y_preds[mem_adjust_positions, mem_index] = ((pred_mems - buffer_sizes) *
+                                                           np.array(mem_adjust_factors) + buffer_sizes)
+
+    # Sum the opunit predictions of each data (bincount adds them in the opunit order)
+    data_indexes = np.array(data_indexes, dtype=np.int64)
+    pipeline_y_preds = np.empty((chunk_end - chunk_start, num_targets))
+    for i in range(num_targets):
+        pipeline_y_preds[:, i] = np.bincount(data_indexes, weights=opunit_y_preds[:, i],
+                                             minlength=chunk_end - chunk_start)
+
+    return pipeline_y_preds
@@ -14,6 +14,19 @@ def write_csv_result(path, label, data):
         writer.writerow([label] + list(data))
 
 
+def write_csv_results(path, labels, data):
+    """Write rows of result data in csv format with a single write
+
+    :param path: write destination
+    :param labels: the labels (first column) of the rows
+    :param data: the rest columns of the rows
+    :return:
+    """
+    with open(path, "a") as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerows([label] + list(row) for label, row in zip(labels, data))
+
+
 def create_csv_file(path, header):
     """Create a new csv file with header (replace any existing one)
 
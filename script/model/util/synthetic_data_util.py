@@ -0,0 +1,188 @@
+"""Generators of synthetic mini-runner and pipeline data files for benchmarking the modeling scripts.
+
+The files have the same CSV layout as the data files of the runners (the ExecutionFeature columns followed by the
+Target columns), so they go through the same loading, training and prediction paths as the real data.
+"""
+
+import os
+
+import numpy as np
+
+import global_model_config
+from info import hardware_info
+from type import OpUnit, Target, ExecutionFeature
+
+# Name of the generated mini-runner data file
+MINI_RUNNER_FILE = "execution_seq0.csv"
+
+# Name of the generated pipeline data file
+PIPELINE_FILE = "pipeline.csv"
+
+# Name of the generated mini-runner execution data file with multiple opunits per row
+MINI_RUNNER_PIPELINE_FILE = "execution_seq1.csv"
+
+# The columns of the generated data files
+EXECUTION_HEADER = ([f.name.lower() for f in ExecutionFeature if f <= ExecutionFeature.NUM_CONCURRENT] +
+                    [t.name.lower() for t in Target])
+
+# The opunits in the generated data
+OPUNITS = (OpUnit.SEQ_SCAN, OpUnit.OP_INTEGER_PLUS_OR_MINUS, OpUnit.OP_REAL_COMPARE, OpUnit.HASHJOIN_BUILD,
+           OpUnit.AGG_BUILD, OpUnit.SORT_BUILD)
+
+# The input features that vary per opunit in a pipeline (the others are shared by the opunits of the pipeline)
+_PER_OPUNIT_FEATURES = (ExecutionFeature.NUM_ROWS, ExecutionFeature.KEY_SIZES, ExecutionFeature.EST_CARDINALITIES)
+
+# Per-tuple cost of the targets after CPU_ID (cpu_cycles, instructions, cache_ref, cache_miss, ref_cpu_cycles,
+# block_read, block_write, memory_b, elapsed_us). The memory is per distinct key byte instead.
+_TARGET_COSTS = np.array([200, 400, 20, 2, 180, 0, 0, 1, 0.1])
+
+# Maximum number of the opunits in a pipeline
+_MAX_PIPELINE_OPUNITS = 3
+
+# Minimum number of the resource intervals of the global models (global_model_config.INTERVAL_SIZE) that the pipelines
+# are spread over, so that the global models have enough intervals to train with however few the rows are
+_MIN_PIPELINE_INTERVALS = 50
+
+
+def _num_input_features():
+    return ExecutionFeature.NUM_CONCURRENT - ExecutionFeature.CPU_FREQ + 1
+
+
+def generate_features(rng, num_rows):
+    """Generate the input features of single opunits
+
+    The features take a limited number of distinct values like the mini-runner sweeps, so the mini-runner data has
+    repeated measurements of the same features.
+
+    :param rng: the numpy random Generator
+    :param num_rows: number of rows to generate
+    :return: the input features (one row per opunit in the ExecutionFeature order from CPU_FREQ)
+    """
+    x = np.zeros((num_rows, _num_input_features()))
+
+    def set_feature(feature, values):
+        x[:, feature - ExecutionFeature.CPU_FREQ] = values
+
+    num_tuples = 2 ** rng.integers(0, 20, num_rows)
+    set_feature(ExecutionFeature.CPU_FREQ, 2000)
+    set_feature(ExecutionFeature.EXEC_MODE, 1)
+    set_feature(ExecutionFeature.NUM_ROWS, num_tuples)
+    set_feature(ExecutionFeature.KEY_SIZES, rng.choice([4, 8, 16], num_rows))
+    set_feature(ExecutionFeature.NUM_KEYS, rng.choice([1, 2, 4], num_rows))
+    set_feature(ExecutionFeature.EST_CARDINALITIES, np.maximum(1, num_tuples // rng.choice([1, 2, 10], num_rows)))
+    set_feature(ExecutionFeature.MEM_FACTOR, 1)
+    set_feature(ExecutionFeature.NUM_LOOPS, 1)
+    return x
+
+
+def generate_targets(rng, opunits, x):
+    """Generate the targets (after CPU_ID) of single opunits, which scale with the number of tuples
+
+    :param rng: the numpy random Generator
+    :param opunits: the opunit index (into OPUNITS) of each row
+    :param x: the input features generated by generate_features
+    :return: the targets (one row per opunit)
+    """
+    num_tuples = x[:, ExecutionFeature.NUM_ROWS - ExecutionFeature.CPU_FREQ]
+    key_bytes = (x[:, ExecutionFeature.EST_CARDINALITIES - ExecutionFeature.CPU_FREQ] *
+                 x[:, ExecutionFeature.KEY_SIZES - ExecutionFeature.CPU_FREQ])
+    memory_index = Target.MEMORY_B - Target.CPU_CYCLES
+
+    y = (num_tuples * (1 + np.asarray(opunits)))[:, np.newaxis] * _TARGET_COSTS
+    y[:, memory_index] = key_bytes * _TARGET_COSTS[memory_index]
+    return y * rng.lognormal(0, 0.1, y.shape)
+
+
+def get_training_data(num_rows, seed=0):
+    """Generate the (x, y) data of an opunit model
+
+    :param num_rows: number of rows to generate
+    :param seed: the random seed
+    :return: (input features, targets after CPU_ID)
+    """
+    rng = np.random.default_rng(seed)
+    x = generate_features(rng, num_rows)
+    return x, generate_targets(rng, rng.integers(0, len(OPUNITS), num_rows), x)
+
+
+def _format_value(value):
+    return "{:g}".format(value)
+
+
+def _write_rows(filename, rows):
+    with open(filename, "w") as f:
+        f.write(",".join(EXECUTION_HEADER) + "\n")
+        for row in rows:
+            f.write(",".join(row) + "\n")
+
+
+def write_mini_runner_data(input_path, num_rows, seed=0):
+    """Write a mini-runner execution data file with one opunit per row
+
+    :param input_path: the directory to write the MINI_RUNNER_FILE in
+    :param num_rows: number of rows to generate
+    :param seed: the random seed
+    :return: the path of the file
+    """
+    rng = np.random.default_rng(seed)
+    opunits = rng.integers(0, len(OPUNITS), num_rows)
+    x = generate_features(rng, num_rows)
+    y = generate_targets(rng, opunits, x)
+    start_times = 1000000 + np.cumsum(rng.integers(1, 1000, num_rows))
+
+    def rows():
+        for i in range(num_rows):
+            yield ([str(i), "0", "1", OPUNITS[opunits[i]].name] + [_format_value(v) for v in x[i]] +
+                   [str(start_times[i]), "0"] + [_format_value(v) for v in y[i]])
+
+    filename = os.path.join(input_path, MINI_RUNNER_FILE)
+    _write_rows(filename, rows())
+    return filename
+
+
+def write_pipeline_data(input_path, num_rows, num_queries=100, seed=0, filename=PIPELINE_FILE,
+                        distinct_opunits=False):
+    """Write a pipeline data file of concurrently running pipelines with multiple opunits per row
+
+    The start times of the pipelines span at least _MIN_PIPELINE_INTERVALS resource intervals of the global models.
+
+    :param input_path: the directory to write the file in
+    :param num_rows: number of rows to generate
+    :param num_queries: number of distinct queries that the pipelines belong to
+    :param seed: the random seed
+    :param filename: name of the file (e.g., MINI_RUNNER_PIPELINE_FILE for a mini-runner execution data file)
+    :param distinct_opunits: whether the opunits of a pipeline are distinct, like in the mini-runner data
+    :return: the path of the file
+    """
+    rng = np.random.default_rng(seed)
+    num_opunits = rng.integers(1, _MAX_PIPELINE_OPUNITS + 1, num_rows)
+    offsets = np.concatenate(([0], np.cumsum(num_opunits)))
+    if distinct_opunits:
+        opunits = np.concatenate([rng.choice(len(OPUNITS), n, replace=False) for n in num_opunits])
+    else:
+        opunits = rng.integers(0, len(OPUNITS), offsets[-1])
+    x = generate_features(rng, offsets[-1])
+    opunit_y = generate_targets(rng, opunits, x)
+    # The targets of a pipeline are the total of its opunits
+    y = np.add.reduceat(opunit_y, offsets[:-1], axis=0)
+    query_ids = rng.integers(10, 10 + num_queries, num_rows)
+    steps = rng.integers(1, 1000, num_rows)
+    min_span = _MIN_PIPELINE_INTERVALS * global_model_config.INTERVAL_SIZE
+    start_times = 1000000 + np.cumsum(steps * max(1, -(-min_span // int(steps.sum()))))
+    cpu_ids = rng.integers(0, hardware_info.PHYSICAL_CORE_NUM * 2, num_rows)
+    per_opunit = {feature - ExecutionFeature.CPU_FREQ for feature in _PER_OPUNIT_FEATURES}
+
+    def rows():
+        for i in range(num_rows):
+            start, end = offsets[i], offsets[i + 1]
+            features = []
+            for j in range(x.shape[1]):
+                values = x[start:end, j] if j in per_opunit else x[start:start + 1, j]
+                features.append(";".join(_format_value(v) for v in values))
+            yield ([str(query_ids[i]), str(query_ids[i] % 3), str(end - start),
+                    ";".join(OPUNITS[k].name for k in opunits[start:end])] + features +
+                   [str(start_times[i]), str(cpu_ids[i])] + [_format_value(v) for v in y[i]])
+
+    filename = os.path.join(input_path, filename)
+    _write_rows(filename, rows())
+    return filename
@@ -198,6 +198,9 @@ bool ModelServerManager::TrainWith(const std::vector<std::string> &methods, cons
   j["data"]["methods"] = methods;
   j["data"]["seq_files"] = seq_files_dir;
   j["data"]["save_path"] = save_path;
+  // Training runs in the ModelServer's worker pool. Ask for the reply once training is done so the future completes
+  // with the training result rather than the job id.
+  j["data"]["wait"] = true;
 
   // Callback to notify the waiter for result, or failure to parse the result.
   auto callback = [&, future](common::ManagedPointer<messenger::Messenger> messenger, std::string_view sender_id,